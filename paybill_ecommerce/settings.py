@@ -2,6 +2,7 @@
 # Add to your settings.py
 
 import os
+import tempfile
 from pathlib import Path
 from decouple import config  # pip install python-decouple
 
@@ -74,6 +75,18 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Under ASGI each request writes from its own thread; take the write
+        # lock up front and wait for it rather than failing with "database
+        # is locked" when two checkouts overlap.
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # A file rather than shared-cache memory, so tests that write from
+        # several threads wait on the lock the same way production does
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -121,13 +134,88 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
+# Cache shared by every web worker and management command: cart counts,
+# catalog pages and facets, cache versions, payment events and the M-Pesa
+# token. A per-process cache (Django's locmem default) would leave other
+# workers with stale entries after an invalidation. The default is a
+# directory on this host; a database cache would queue every cache write
+# behind SQLite's single write lock. When workers run on several hosts use
+# Redis, e.g. CACHE_BACKEND=django.core.cache.backends.redis.RedisCache and
+# CACHE_LOCATION=redis://127.0.0.1:6379/1.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('CACHE_LOCATION', default=os.path.join(tempfile.gettempdir(), 'paybill_ecommerce_cache')),
+    }
+}
+if CACHES['default']['BACKEND'].endswith('FileBasedCache'):
+    # Culling (past 300 entries by default) evicts cache versions along with pages
+    CACHES['default']['OPTIONS'] = {'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=20000, cast=int)}
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# ============================================
+# PRODUCT VIEW COUNTER
+# ============================================
+# Product views are buffered in memory and written in bulk; a crash loses
+# at most this many seconds (or this many views) of counts.
+VIEW_COUNT_FLUSH_INTERVAL = config('VIEW_COUNT_FLUSH_INTERVAL', default=30, cast=int)
+VIEW_COUNT_MAX_PENDING = config('VIEW_COUNT_MAX_PENDING', default=1000, cast=int)
+
+# Anonymous catalog pages are cached for at most this many seconds; they are
+# invalidated earlier whenever a product, category, brand or review changes.
+CATALOG_PAGE_CACHE_TIMEOUT = config('CATALOG_PAGE_CACHE_TIMEOUT', default=300, cast=int)
+
 # ============================================
 # M-PESA CONFIGURATION
 # ============================================
 MPESA_ENVIRONMENT = config('MPESA_ENVIRONMENT', default='sandbox')
 
+# Overrides the Daraja host picked from MPESA_ENVIRONMENT (e.g. a local stub)
+MPESA_BASE_URL = config('MPESA_BASE_URL', default='')
+
+# Access tokens are refreshed this many seconds before they expire
+MPESA_TOKEN_REFRESH_MARGIN = config('MPESA_TOKEN_REFRESH_MARGIN', default=300, cast=int)
+
+# Pooled keep-alive HTTP client for Daraja (connections per host, seconds)
+MPESA_HTTP_POOL_SIZE = config('MPESA_HTTP_POOL_SIZE', default=10, cast=int)
+MPESA_CONNECT_TIMEOUT = config('MPESA_CONNECT_TIMEOUT', default=5, cast=float)
+MPESA_READ_TIMEOUT = config('MPESA_READ_TIMEOUT', default=60, cast=float)
+MPESA_HTTP_RETRIES = config('MPESA_HTTP_RETRIES', default=3, cast=int)
+# Concurrent Daraja requests per process from async views
+MPESA_ASYNC_MAX_CONNECTIONS = config('MPESA_ASYNC_MAX_CONNECTIONS', default=100, cast=int)
+
+# STK pushes are sent by `manage.py stk_worker`. Retryable failures are
+# retried after STK_PUSH_RETRY_DELAY seconds, doubling each attempt.
+STK_WORKER_THREADS = config('STK_WORKER_THREADS', default=4, cast=int)
+STK_PUSH_MAX_ATTEMPTS = config('STK_PUSH_MAX_ATTEMPTS', default=5, cast=int)
+STK_PUSH_RETRY_DELAY = config('STK_PUSH_RETRY_DELAY', default=5, cast=int)
+
+# The checkout page waits on a Server-Sent Events stream for the payment
+# outcome. Streams end after PAYMENT_EVENTS_TIMEOUT seconds and send a
+# keepalive every PAYMENT_EVENTS_KEEPALIVE, re-reading the payment from the
+# database each time for outcomes applied by other processes; waiters also
+# check the cache for published outcomes every PAYMENT_EVENTS_POLL_INTERVAL.
+PAYMENT_EVENTS_TIMEOUT = config('PAYMENT_EVENTS_TIMEOUT', default=120, cast=int)
+PAYMENT_EVENTS_KEEPALIVE = config('PAYMENT_EVENTS_KEEPALIVE', default=15, cast=int)
+PAYMENT_EVENTS_POLL_INTERVAL = config('PAYMENT_EVENTS_POLL_INTERVAL', default=1.0, cast=float)
+
+# M-Pesa callbacks are journaled and acknowledged at once; the
+# process_callbacks command applies up to CALLBACK_BATCH_SIZE per transaction.
+CALLBACK_BATCH_SIZE = config('CALLBACK_BATCH_SIZE', default=100, cast=int)
+
+# Stock taken by an order is held this many seconds; the
+# release_reservations command cancels orders still unpaid after that.
+STOCK_RESERVATION_TTL = config('STOCK_RESERVATION_TTL', default=900, cast=int)
+
+# reconcile_payments queries Daraja for payments still pending
+# RECONCILE_AFTER seconds after checkout, from RECONCILE_WORKERS threads
+# at no more than RECONCILE_RATE queries per second. Keep RECONCILE_AFTER
+# well under STOCK_RESERVATION_TTL.
+RECONCILE_AFTER = config('RECONCILE_AFTER', default=180, cast=int)
+RECONCILE_WORKERS = config('RECONCILE_WORKERS', default=4, cast=int)
+RECONCILE_RATE = config('RECONCILE_RATE', default=5.0, cast=float)
+
 # M-Pesa Consumer Key and Secret (from Daraja Portal)
 MPESA_CONSUMER_KEY = config('MPESA_CONSUMER_KEY', default='')
 MPESA_CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET', default='')
@@ -1,10 +1,10 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from django.db.models import Sum
 from .models import (
     Category, Brand, Product, ProductImage, ProductSpecification,
     ProductVariant, Review, ReviewImage, Wishlist, Order, OrderItem,
-    OrderStatusHistory, MpesaPayment, Cart, CartItem, Coupon, Address
+    OrderStatusHistory, MpesaPayment, StkPushJob, MpesaCallback, StockReservation, Cart, CartItem, Coupon,
+    Address
 )
 
 
@@ -57,7 +57,7 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ['name', 'description', 'sku']
     prepopulated_fields = {'slug': ('name',)}
     list_editable = ['is_active', 'is_featured', 'price']
-    readonly_fields = ['view_count', 'sold_count', 'created_at', 'updated_at']
+    readonly_fields = ['view_count', 'sold_count', 'rating_avg', 'rating_count', 'created_at', 'updated_at']
     inlines = [ProductImageInline, ProductSpecificationInline, ProductVariantInline]
     
     fieldsets = (
@@ -84,7 +84,7 @@ class ProductAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
         ('Statistics', {
-            'fields': ('view_count', 'sold_count', 'created_at', 'updated_at'),
+            'fields': ('view_count', 'sold_count', 'rating_avg', 'rating_count', 'created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
     )
@@ -282,6 +282,30 @@ class MpesaPaymentAdmin(admin.ModelAdmin):
     )
 
 
+@admin.register(StkPushJob)
+class StkPushJobAdmin(admin.ModelAdmin):
+    list_display = ['payment', 'status', 'attempts', 'run_after', 'last_error', 'updated_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['payment__order__order_number', 'payment__phone_number']
+    readonly_fields = ['payment', 'attempts', 'locked_at', 'last_error', 'created_at', 'updated_at']
+
+
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ['checkout_request_id', 'received_at', 'processed_at', 'result']
+    list_filter = ['processed_at', 'received_at']
+    search_fields = ['checkout_request_id', 'body']
+    readonly_fields = ['body', 'checkout_request_id', 'received_at', 'processed_at', 'result']
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ['order', 'product', 'variant', 'quantity', 'status', 'expires_at']
+    list_filter = ['status', 'expires_at']
+    search_fields = ['order__order_number', 'product__name']
+    readonly_fields = ['order', 'payment', 'product', 'variant', 'quantity', 'created_at', 'updated_at']
+
+
 class CartItemInline(admin.TabularInline):
     model = CartItem
     extra = 0
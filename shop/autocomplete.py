@@ -0,0 +1,257 @@
+"""
+In-memory autocomplete for /api/search-suggestions/.
+
+Product, brand and category names are split into words and kept in one
+sorted array of ``(word, kind, id)`` keys, so a prefix lookup is two
+bisects plus a scan of the matching slice. Hits are ranked by popularity
+(``sold_count`` / ``view_count``); for short, very common prefixes the top
+hits are cached so a two-letter query doesn't scan thousands of keys.
+
+The index is built from the database once per process, updated
+incrementally by signals after each committed Product/Brand/Category
+change, and rebuilt (at most every MIN_REBUILD_INTERVAL seconds) when
+another process bumps the shared version key. View and sales counts
+change through UPDATEs that send no signals, so it is also rebuilt every
+SCORE_REFRESH_INTERVAL seconds to pick up their scores.
+"""
+import heapq
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+
+from . import cache
+from .models import Brand, Category, Product
+
+VERSION_NAMESPACE = 'autocomplete'
+
+# Top hits are precomputed for prefixes up to SHORT_PREFIX characters and
+# cached on first use for longer prefixes whose slice exceeds the threshold.
+SHORT_PREFIX = 3
+TOP_CACHE_THRESHOLD = 500
+TOP_CACHE_SIZE = 50
+
+MIN_REBUILD_INTERVAL = 60
+SCORE_REFRESH_INTERVAL = 15 * 60
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def words(text):
+    return WORD_RE.findall((text or '').lower())
+
+
+def product_score(sold_count, view_count):
+    return (sold_count or 0) * 10 + (view_count or 0)
+
+
+@dataclass(frozen=True)
+class Entry:
+    kind: str
+    id: int
+    name: str
+    slug: str
+    score: int
+    words: frozenset
+
+    def as_suggestion(self):
+        return {'id': self.id, 'name': self.name, 'type': self.kind, 'slug': self.slug}
+
+
+class AutocompleteIndex:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._built_at = 0
+        self._entries = {}
+        self._keys = []
+        self._top = {}
+        self._version = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    # Building
+
+    def load(self, entries):
+        """Replace the whole index with the given entries"""
+        keys = sorted(
+            (word, entry.kind, entry.id)
+            for entry in entries
+            for word in entry.words
+        )
+        # Short prefixes match huge slices, so compute their top hits up front:
+        # walk entries from most to least popular and fill each prefix's list.
+        top = {}
+        for entry in sorted(entries, key=lambda e: e.score, reverse=True):
+            prefixes = {w[:i] for w in entry.words for i in range(1, min(len(w), SHORT_PREFIX) + 1)}
+            for prefix in prefixes:
+                hits = top.setdefault(prefix, [])
+                if len(hits) < TOP_CACHE_SIZE:
+                    hits.append(entry)
+
+        with self._lock:
+            self._entries = {(e.kind, e.id): e for e in entries}
+            self._keys = keys
+            self._top = top
+
+    def rebuild(self):
+        """Load every active product, brand and category from the database"""
+        entries = [
+            Entry('product', pk, name, slug or '', product_score(sold, views), frozenset(words(name)))
+            for pk, name, slug, sold, views in Product.objects.filter(is_active=True).values_list(
+                'id', 'name', 'slug', 'sold_count', 'view_count'
+            ).iterator(chunk_size=2000)
+        ]
+        popularity = Coalesce(Sum(F('products__sold_count') * 10 + F('products__view_count')), 0)
+        brands = Brand.objects.filter(is_active=True).annotate(score=popularity)
+        entries.extend(
+            Entry('brand', pk, name, '', score, frozenset(words(name)))
+            for pk, name, score in brands.values_list('id', 'name', 'score')
+        )
+        categories = Category.objects.filter(is_active=True).annotate(score=popularity)
+        entries.extend(
+            Entry('category', pk, name, slug or '', score, frozenset(words(name)))
+            for pk, name, slug, score in categories.values_list('id', 'name', 'slug', 'score')
+        )
+
+        version = cache.get_version(VERSION_NAMESPACE)
+        self.load(entries)
+        self._version = version
+        self._built_at = time.monotonic()
+
+    def is_stale(self):
+        if self._version is None:
+            return True
+        age = time.monotonic() - self._built_at
+        if age < MIN_REBUILD_INTERVAL:
+            return False
+        return age >= SCORE_REFRESH_INTERVAL or cache.get_version(VERSION_NAMESPACE) != self._version
+
+    def ensure_current(self):
+        """(Re)build if never built, another process changed the catalog or the scores are due"""
+        if not self.is_stale():
+            return
+        with self._build_lock:
+            if self.is_stale():
+                self.rebuild()
+
+    # Incremental updates
+
+    def upsert(self, entry):
+        with self._lock:
+            self._remove_locked(entry.kind, entry.id)
+            self._entries[(entry.kind, entry.id)] = entry
+            for word in entry.words:
+                insort(self._keys, (word, entry.kind, entry.id))
+                self._invalidate_top(word)
+
+    def remove(self, kind, pk):
+        with self._lock:
+            self._remove_locked(kind, pk)
+
+    def _remove_locked(self, kind, pk):
+        entry = self._entries.pop((kind, pk), None)
+        if entry is None:
+            return
+        for word in entry.words:
+            key = (word, kind, pk)
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+            self._invalidate_top(word)
+
+    def _invalidate_top(self, word):
+        for i in range(1, len(word) + 1):
+            self._top.pop(word[:i], None)
+
+    # Lookup
+
+    def suggest(self, query, limit=10):
+        terms = words(query)
+        if not terms:
+            return []
+
+        # Scan the slice of the most selective (longest) term and require
+        # every other term to prefix one of the entry's words.
+        probe = max(terms, key=len)
+        others = [t for t in terms if t != probe]
+
+        def matches(entry):
+            return all(any(w.startswith(t) for w in entry.words) for t in others)
+
+        with self._lock:
+            if not others and probe in self._top:
+                return [e.as_suggestion() for e in self._top[probe][:limit]]
+
+            lo = bisect_left(self._keys, (probe,))
+            hi = bisect_left(self._keys, (probe + '\uffff',), lo)
+            candidates = {
+                (kind, pk): self._entries[(kind, pk)]
+                for _, kind, pk in self._keys[lo:hi]
+            }
+
+            if not others and hi - lo > TOP_CACHE_THRESHOLD:
+                top = heapq.nlargest(TOP_CACHE_SIZE, candidates.values(), key=lambda e: e.score)
+                self._top[probe] = top
+                return [e.as_suggestion() for e in top[:limit]]
+
+        hits = (e for e in candidates.values() if matches(e))
+        return [e.as_suggestion() for e in heapq.nlargest(limit, hits, key=lambda e: e.score)]
+
+
+autocomplete = AutocompleteIndex()
+
+
+def suggest(query, limit=10):
+    autocomplete.ensure_current()
+    return autocomplete.suggest(query, limit)
+
+
+def bump_version():
+    """Tell other processes their index is stale, without rebuilding our own"""
+    version = cache.bump_version(VERSION_NAMESPACE)
+    with autocomplete._lock:
+        # Anything but our own increment means another process changed the
+        # catalog too; keep the old version so ensure_current() rebuilds
+        if autocomplete._version is not None and version == autocomplete._version + 1:
+            autocomplete._version = version
+
+
+def product_changed(product):
+    if product.is_active:
+        autocomplete.upsert(Entry(
+            'product', product.pk, product.name, product.slug or '',
+            product_score(product.sold_count, product.view_count), frozenset(words(product.name)),
+        ))
+    else:
+        autocomplete.remove('product', product.pk)
+    bump_version()
+
+
+def product_removed(product_id):
+    autocomplete.remove('product', product_id)
+    bump_version()
+
+
+def group_changed(kind, instance):
+    """A brand or category was saved; keep its popularity score"""
+    existing = autocomplete._entries.get((kind, instance.pk))
+    if instance.is_active:
+        autocomplete.upsert(Entry(
+            kind, instance.pk, instance.name, getattr(instance, 'slug', None) or '',
+            existing.score if existing else 0, frozenset(words(instance.name)),
+        ))
+    else:
+        autocomplete.remove(kind, instance.pk)
+    bump_version()
+
+
+def group_removed(kind, pk):
+    autocomplete.remove(kind, pk)
+    bump_version()
@@ -0,0 +1,96 @@
+"""
+Cache helpers shared by the context processors and views.
+
+Keys live in versioned namespaces: bumping a namespace's version makes
+every key written under the old version unreachable, which is how whole
+groups of entries (e.g. everything derived from the category tree) are
+invalidated without tracking the individual keys. Versions and entries
+must live in the cache shared by all processes (settings.CACHES), or an
+invalidation in one worker would leave the others stale until expiry.
+"""
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Sum
+
+from .models import CartItem, Category
+
+CATEGORY_TREE_TIMEOUT = 60 * 60
+CART_COUNT_TIMEOUT = 60 * 60 * 24
+
+
+def get_version(namespace):
+    return cache.get_or_set(f'version:{namespace}', 1, None)
+
+
+def bump_version(namespace):
+    try:
+        return cache.incr(f'version:{namespace}')
+    except ValueError:
+        cache.set(f'version:{namespace}', 2, None)
+        return 2
+
+
+def versioned_key(namespace, *parts):
+    return ':'.join([namespace, str(get_version(namespace)), *map(str, parts)])
+
+
+def get_category_tree():
+    """All categories, cached until a Category is saved or deleted"""
+    key = versioned_key('categories', 'all')
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(Category.objects.all())
+        cache.set(key, categories, CATEGORY_TREE_TIMEOUT)
+    return categories
+
+
+def get_category_nav():
+    """
+    Active categories depth-first, each followed by its subcategories, with
+    siblings in display order. Built from the cached tree and cached with it.
+    """
+    key = versioned_key('categories', 'nav')
+    nav = cache.get(key)
+    if nav is None:
+        children = defaultdict(list)
+        for category in get_category_tree():
+            children[category.parent_id].append(category)
+        nav, pending = [], children[None][::-1]
+        while pending:
+            category = pending.pop()
+            if category.is_active:
+                nav.append(category)
+                pending.extend(children[category.pk][::-1])
+        cache.set(key, nav, CATEGORY_TREE_TIMEOUT)
+    return nav
+
+
+def invalidate_category_tree():
+    bump_version('categories')
+
+
+def cart_count_key(user_id):
+    return f'cart_count:{user_id}'
+
+
+def get_cart_count(user):
+    """Number of items in the user's cart, cached until the cart changes"""
+    if not user.is_authenticated:
+        return 0
+    key = cart_count_key(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = CartItem.objects.filter(cart__user=user).aggregate(
+            total=Sum('quantity')
+        )['total'] or 0
+        cache.set(key, count, CART_COUNT_TIMEOUT)
+    return count
+
+
+def set_cart_count(user_id, count):
+    cache.set(cart_count_key(user_id), count, CART_COUNT_TIMEOUT)
+
+
+def invalidate_cart_count(user_id):
+    cache.delete(cart_count_key(user_id))
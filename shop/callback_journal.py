@@ -0,0 +1,116 @@
+"""
+Journal of M-Pesa STK callbacks.
+
+mpesa_callback only appends the raw body to MpesaCallback and replies to
+Safaricom, so a slow database never makes Daraja time out and retry. The
+process_callbacks command then applies pending entries in batches, one
+transaction per batch, through payments.apply_stk_callback.
+
+Applying is idempotent (a payment only ever leaves 'pending' once), so an
+entry processed twice, a duplicate delivery, or a full replay of the
+journal only changes payments that are still missing their outcome.
+"""
+import json
+import logging
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import MpesaCallback
+from .payments import apply_stk_callback
+
+logger = logging.getLogger(__name__)
+
+
+def parse(body):
+    """The stkCallback object from a callback body, or None if it isn't one"""
+    try:
+        stk_callback = json.loads(body).get('Body', {}).get('stkCallback', {})
+    except (ValueError, AttributeError):
+        return None
+    if not isinstance(stk_callback, dict) or not stk_callback.get('CheckoutRequestID'):
+        return None
+    return stk_callback
+
+
+def entry_for(body):
+    body = body.decode('utf-8', errors='replace') if isinstance(body, bytes) else body
+    stk_callback = parse(body) or {}
+    return MpesaCallback(body=body, checkout_request_id=stk_callback.get('CheckoutRequestID'))
+
+
+def record(body):
+    entry = entry_for(body)
+    entry.save()
+    return entry
+
+
+async def arecord(body):
+    entry = entry_for(body)
+    await entry.asave()
+    return entry
+
+
+def apply(entry):
+    """Apply one journal entry; returns the outcome stored on it"""
+    stk_callback = parse(entry.body)
+    if stk_callback is None:
+        logger.error(f"Callback {entry.pk} has no CheckoutRequestID")
+        return 'Invalid callback data'
+    try:
+        return apply_stk_callback(stk_callback)['ResultDesc']
+    except Exception as e:
+        logger.error(f"Callback {entry.pk} could not be applied: {str(e)}")
+        return f'Error: {str(e)}'[:255]
+
+
+def apply_batch(entries):
+    with transaction.atomic():
+        for entry in entries:
+            entry.result = apply(entry)
+            entry.processed_at = timezone.now()
+        MpesaCallback.objects.bulk_update(entries, ['result', 'processed_at'])
+    return entries
+
+
+def process_pending(limit):
+    """Apply up to ``limit`` unprocessed entries, oldest first"""
+    entries = list(MpesaCallback.objects.filter(processed_at__isnull=True).order_by('id')[:limit])
+    return apply_batch(entries) if entries else []
+
+
+def replay(batch_size, since=None):
+    """
+    Apply every journal entry again, in order, to restore payments whose
+    outcome was lost or never applied. Returns the number of entries.
+    """
+    entries = MpesaCallback.objects.order_by('id')
+    if since is not None:
+        entries = entries.filter(received_at__gte=since)
+
+    count = 0
+    batch = []
+    for entry in entries.iterator(chunk_size=batch_size):
+        batch.append(entry)
+        if len(batch) == batch_size:
+            count += len(apply_batch(batch))
+            batch = []
+    if batch:
+        count += len(apply_batch(batch))
+    return count
+
+
+def lag(now=None):
+    """Backlog size, age of the oldest pending entry and the latest processing delay, in seconds"""
+    now = now or timezone.now()
+    pending = MpesaCallback.objects.filter(processed_at__isnull=True)
+    oldest = pending.order_by('id').values_list('received_at', flat=True).first()
+    latest = (
+        MpesaCallback.objects.filter(processed_at__isnull=False)
+        .order_by('-id').values_list('received_at', 'processed_at').first()
+    )
+    return {
+        'pending': pending.count(),
+        'oldest_pending_age': (now - oldest).total_seconds() if oldest else 0.0,
+        'last_processing_delay': (latest[1] - latest[0]).total_seconds() if latest else None,
+    }
@@ -1,22 +1,13 @@
-from .models import Category, Cart
+from .cache import get_cart_count, get_category_tree
 
 def cart_processor(request):
     """Add cart information to all templates"""
-    cart_count = 0
-    if request.user.is_authenticated:
-        try:
-            cart = Cart.objects.get(user=request.user)
-            cart_count = cart.total_items
-        except Cart.DoesNotExist:
-            cart_count = 0
-    
     return {
-        'cart_count': cart_count
+        'cart_count': get_cart_count(request.user)
     }
 
 def categories_processor(request):
     """Add all categories to all templates"""
-    categories = Category.objects.all()
     return {
-        'all_categories': categories
-    }
\ No newline at end of file
+        'all_categories': get_category_tree()
+    }
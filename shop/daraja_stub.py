@@ -0,0 +1,146 @@
+"""
+Local stand-in for the Daraja API, used by the tests and benchmark commands.
+
+Serves /oauth/v1/generate, /mpesa/stkpush/v1/processrequest and
+/mpesa/stkpushquery/v1/query on a random localhost port in a background
+thread, over TLS when given an ``ssl.SSLContext``. Point MPESA_BASE_URL at ``stub.url`` to use it.
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class DarajaStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without TCP_NODELAY a
+    # keep-alive client waits on delayed ACKs for every response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        stub = self.server.stub
+        if not self.path.startswith('/oauth/v1/generate'):
+            return self.send_json(404, {'errorMessage': 'Not found'})
+        time.sleep(stub.delay)
+        self.send_json(200, {'access_token': stub.issue_token(), 'expires_in': str(stub.expires_in)})
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.path.startswith(('/mpesa/stkpush/v1/processrequest', '/mpesa/stkpushquery/v1/query')):
+            return self.send_json(404, {'errorMessage': 'Not found'})
+
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        if token not in stub.valid_tokens:
+            return self.send_json(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+
+        time.sleep(stub.delay)
+        request = json.loads(body or b'{}')
+        if self.path.startswith('/mpesa/stkpushquery/v1/query'):
+            return self.stk_query(stub, request)
+
+        stub.stk_requests.append(request)
+        n = len(stub.stk_requests)
+        if stub.stk_status != 200:
+            return self.send_json(stub.stk_status, {'errorCode': '500.003.02', 'errorMessage': 'System is busy'})
+        self.send_json(200, {
+            'MerchantRequestID': f'stub-merchant-{n}',
+            'CheckoutRequestID': f'ws_CO_stub_{n}',
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        })
+
+
+    def stk_query(self, stub, request):
+        checkout_request_id = request.get('CheckoutRequestID')
+        with stub._lock:
+            stub.query_requests.append(checkout_request_id)
+        if checkout_request_id not in stub.query_results:
+            return self.send_json(500, {
+                'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed',
+            })
+        result_code, result_desc = stub.query_results[checkout_request_id]
+        self.send_json(200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': 'stub-merchant',
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': str(result_code),
+            'ResultDesc': result_desc,
+        })
+
+
+class DarajaStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open many connections at once
+    request_queue_size = 256
+
+    def handle_error(self, request, client_address):
+        # A client that stopped waiting (read timeout) isn't a stub error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class DarajaStub:
+    """
+    ``delay`` (seconds) is added to every response. ``revoke_tokens()``
+    makes every issued token fail with 401, as Daraja does after a
+    credential rotation. STK pushes are recorded and then answered with
+    ``stk_status`` (200 for success). STK Push Query answers "being processed" unless
+    ``query_results[checkout_request_id]`` holds a (ResultCode, ResultDesc).
+    """
+
+    def __init__(self, delay=0, expires_in=3599, ssl_context=None):
+        self.delay = delay
+        self.expires_in = expires_in
+        self.token_requests = 0
+        self.valid_tokens = set()
+        self.stk_requests = []
+        self.stk_status = 200
+        self.query_results = {}
+        self.query_requests = []
+        self._lock = threading.Lock()
+        self.server = DarajaStubServer(('127.0.0.1', 0), DarajaStubHandler)
+        self.server.stub = self
+        scheme = 'http'
+        if ssl_context:
+            self.server.socket = ssl_context.wrap_socket(self.server.socket, server_side=True)
+            scheme = 'https'
+        self.url = f'{scheme}://127.0.0.1:{self.server.server_port}'
+
+    def issue_token(self):
+        with self._lock:
+            self.token_requests += 1
+            token = f'stub-token-{self.token_requests}'
+            self.valid_tokens.add(token)
+        return token
+
+    def revoke_tokens(self):
+        self.valid_tokens.clear()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,158 @@
+"""
+Faceted filter counts for the product listing sidebars.
+
+One grouped query per filter set: the products matching every filter
+except brand and category, grouped by (brand, category), with conditional
+counts for the price buckets, rating buckets and flags and the price
+range. There is one row per brand/category pair that has products, so the
+result is small; it is cached per normalized filter key. The facets are
+summed from those rows in Python:
+
+* brand counts honour the category filter but not the brand filter, and
+  category counts the other way round, so the sidebar keeps offering the
+  alternatives to the current choice;
+* the result total, price range, buckets and flags honour both.
+
+Category counts include subcategories at any depth (via the cached
+category paths).
+"""
+from collections import Counter
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Min, Q
+
+from .cache import get_category_tree
+from .models import Brand, Product
+
+# [min_price, max_price) in KSh, so a price on a boundary is counted once
+PRICE_BUCKETS = [(None, 1000), (1000, 5000), (5000, 20000), (20000, 50000), (50000, None)]
+# The smallest price difference Product.price can hold
+PRICE_STEP = Decimal(1).scaleb(-Product._meta.get_field('price').decimal_places)
+RATING_BUCKETS = (4, 3, 2, 1)
+# Keyed by the product_list query parameter that applies the filter
+FLAGS = {
+    'featured': Q(is_featured=True),
+    'bestseller': Q(is_bestseller=True),
+    'new_arrival': Q(is_new_arrival=True),
+    'free_shipping': Q(free_shipping=True),
+    'in_stock': Q(stock__gt=0),
+}
+
+
+def price_filter(low, high):
+    condition = Q()
+    if low is not None:
+        condition &= Q(price__gte=low)
+    if high is not None:
+        condition &= Q(price__lt=high)
+    return condition
+
+
+def rating_filter(stars):
+    # Cards show the average rounded to one decimal, so 3.96 counts as 4 stars
+    return Q(rating_avg__gte=stars - 0.05)
+
+
+def facet_rows(queryset):
+    """Counts per (brand, category) for ``queryset``: the one query behind the facets"""
+    aggregates = {'total': Count('pk'), 'price_min': Min('price'), 'price_max': Max('price')}
+    for i, (low, high) in enumerate(PRICE_BUCKETS):
+        aggregates[f'price_{i}'] = Count('pk', filter=price_filter(low, high))
+    for stars in RATING_BUCKETS:
+        aggregates[f'rating_{stars}'] = Count('pk', filter=rating_filter(stars))
+    for name, condition in FLAGS.items():
+        aggregates[name] = Count('pk', filter=condition)
+    return list(queryset.order_by().values('brand_id', 'category_id').annotate(**aggregates))
+
+
+@dataclass
+class PriceBucket:
+    min_price: object
+    max_price: object
+    count: int
+
+    @property
+    def link_max_price(self):
+        """The inclusive max_price product_list takes for the bucket's open upper bound"""
+        if self.max_price is None:
+            return None
+        return Decimal(self.max_price) - PRICE_STEP
+
+
+@dataclass
+class Facets:
+    total: int
+    price_min: object
+    price_max: object
+    brands: Counter
+    categories: Counter
+    price_buckets: list
+    ratings: list
+    flags: dict
+
+    def brand_list(self):
+        """(brand, count) for the active brands with matching products, by name"""
+        brands = Brand.objects.filter(pk__in=[pk for pk, n in self.brands.items() if n], is_active=True)
+        return [(brand, self.brands[brand.pk]) for brand in brands.order_by('name')]
+
+    def category_list(self, categories):
+        """(category, count) for those of ``categories`` with matching products"""
+        return [(category, self.categories[category.pk]) for category in categories if self.categories[category.pk]]
+
+
+def summarize(rows, brand=None, category=None):
+    paths = {c.pk: c.path for c in get_category_tree()}
+
+    def in_brand(row):
+        return brand is None or row['brand_id'] == brand.pk
+
+    def in_category(row):
+        if category is None:
+            return True
+        if not category.path:
+            return row['category_id'] == category.pk
+        return paths.get(row['category_id'], '').startswith(category.path)
+
+    brands, categories, matching = Counter(), Counter(), []
+    for row in rows:
+        if in_category(row) and row['brand_id'] is not None:
+            brands[row['brand_id']] += row['total']
+        if in_brand(row):
+            # The product's category and each of its ancestors
+            for pk in paths.get(row['category_id'], '').split('/')[:-1]:
+                categories[int(pk)] += row['total']
+            if in_category(row):
+                matching.append(row)
+
+    def total(field):
+        return sum(row[field] for row in matching)
+
+    prices = [row['price_min'] for row in matching] + [row['price_max'] for row in matching]
+    return Facets(
+        total=total('total'),
+        price_min=min(prices, default=None),
+        price_max=max(prices, default=None),
+        brands=brands,
+        categories=categories,
+        price_buckets=[
+            PriceBucket(low, high, total(f'price_{i}')) for i, (low, high) in enumerate(PRICE_BUCKETS)
+        ],
+        ratings=[(stars, total(f'rating_{stars}')) for stars in RATING_BUCKETS],
+        flags={name: total(name) for name in FLAGS},
+    )
+
+
+def get_facets(queryset, key, brand=None, category=None):
+    """
+    Facets for ``queryset`` (every filter applied except brand and
+    category) narrowed to ``brand`` and ``category``. ``key`` must identify
+    the filter set and change with the catalog (page_cache.catalog_summary_key).
+    """
+    rows = cache.get(key)
+    if rows is None:
+        rows = facet_rows(queryset)
+        cache.set(key, rows, settings.CATALOG_PAGE_CACHE_TIMEOUT)
+    return summarize(rows, brand, category)
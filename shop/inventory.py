@@ -0,0 +1,178 @@
+"""
+Stock reservation for orders.
+
+Stock is taken with one conditional UPDATE per line
+(``SET stock = stock - q WHERE id = ... AND stock >= q``), so two
+checkouts racing for the last units can't both succeed: the database
+applies the updates one after the other and the second matches no row.
+Every line takes from Product.stock, the product's total, and a line for
+a variant also from ProductVariant.stock, so a product whose variants
+sell out drops out of the in_stock filter. Lines are updated in product
+then variant primary key order so concurrent checkouts lock rows in the
+same order.
+
+Call reserve() inside the order's transaction and roll back (raise) when
+it reports failed lines, then hold() the stock for the order. Stock is
+therefore always the quantity available to sell (on hand minus active
+reservations), and the in_stock filter stays a plain ``stock > 0``. A
+held reservation is consumed when the order is paid, or released (stock
+put back) when the payment fails or the reservation expires unpaid.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import page_cache
+from .models import OrderItem, Product, ProductVariant, StockReservation
+
+
+class InsufficientStock(Exception):
+    """Raised by reserve_or_fail(); ``lines`` are the ones that couldn't be filled"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        super().__init__(', '.join(line_label(line) for line in lines))
+
+
+def line_label(line):
+    return f"{line.product.name} - {line.variant.name}" if line.variant_id else line.product.name
+
+
+def stock_rows(line):
+    """The querysets whose stock a cart or order line draws on"""
+    rows = [Product.objects.filter(pk=line.product_id)]
+    if line.variant_id:
+        rows.append(ProductVariant.objects.filter(pk=line.variant_id))
+    return rows
+
+
+def lock_order(line):
+    return (line.product_id, line.variant_id or 0)
+
+
+def adjust_line(line, sign):
+    """Move one line's quantity on each of its rows; False (and nothing moved) if one was short"""
+    done = []
+    for rows in stock_rows(line):
+        matching = rows.filter(stock__gte=line.quantity) if sign < 0 else rows
+        if not matching.update(stock=F('stock') + sign * line.quantity):
+            for taken in done:
+                taken.update(stock=F('stock') - sign * line.quantity)
+            return False
+        done.append(rows)
+    return True
+
+
+def adjust(lines, sign):
+    """Add (sign=1) or take (sign=-1) each line's quantity; returns the lines that were short"""
+    failed = []
+    moved = defaultdict(int)
+    for line in sorted(lines, key=lock_order):
+        if adjust_line(line, sign):
+            moved[line.product_id] += line.quantity
+        else:
+            failed.append(line)
+    if availability_changed(moved, sign):
+        transaction.on_commit(lambda: page_cache.invalidate(page_cache.PRODUCTS))
+    return failed
+
+
+def availability_changed(moved, sign):
+    """
+    Whether a product just sold out (sign=-1) or came back in stock (sign=1).
+
+    Cached catalog pages only go stale for the in_stock filter, the facets
+    and the "Out of Stock" badge then; an "Only N left" count may lag by
+    up to the page cache timeout rather than flushing every page on each
+    checkout.
+    """
+    if not moved:
+        return False
+    stock = dict(Product.objects.filter(pk__in=moved).values_list('pk', 'stock'))
+    if sign < 0:
+        return any(stock[pk] <= 0 for pk in moved)
+    return any(stock[pk] == quantity for pk, quantity in moved.items())
+
+
+def reserve(lines):
+    return adjust(lines, -1)
+
+
+def reserve_or_fail(lines):
+    failed = reserve(lines)
+    if failed:
+        raise InsufficientStock(failed)
+
+
+def release(lines):
+    """Put the stock of cancelled order lines back"""
+    adjust(lines, 1)
+
+
+def hold(order, payment, cart_items):
+    """Record the stock reserve() took for an order, for STOCK_RESERVATION_TTL seconds"""
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    return StockReservation.objects.bulk_create([
+        StockReservation(
+            order=order,
+            payment=payment,
+            product_id=item.product_id,
+            variant_id=item.variant_id,
+            quantity=item.quantity,
+            expires_at=expires_at,
+        )
+        for item in cart_items
+    ])
+
+
+def consume(order):
+    """The order is paid: its held stock is sold"""
+    order.reservations.filter(status='active').update(status='consumed', updated_at=timezone.now())
+
+
+def release_order_stock(order):
+    """Put back the stock an unpaid order still holds"""
+    reservations = list(order.reservations.filter(status='active'))
+    if reservations:
+        release(reservations)
+        StockReservation.objects.filter(pk__in=[r.pk for r in reservations]).update(
+            status='released', updated_at=timezone.now()
+        )
+    elif not order.reservations.exists():
+        # Placed before reservations were recorded
+        release(order.items.all())
+
+
+def expired_orders(limit, now=None):
+    """Ids of up to ``limit`` orders holding stock past its expiry"""
+    return list(
+        StockReservation.objects.filter(status='active', expires_at__lte=now or timezone.now())
+        .values_list('order_id', flat=True).distinct()[:limit]
+    )
+
+
+def unit_price(cart_item):
+    price = cart_item.product.price
+    if cart_item.variant_id:
+        price += cart_item.variant.price_adjustment or 0
+    return price
+
+
+def create_order_items(order, cart_items):
+    """Copy cart lines onto the order in one INSERT"""
+    return OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            product=item.product,
+            variant=item.variant,
+            quantity=item.quantity,
+            price=unit_price(item),
+            product_name=line_label(item),
+            product_sku=(item.variant.sku if item.variant_id else None) or item.product.sku,
+        )
+        for item in cart_items
+    ])
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import httpx
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from shop.daraja_stub import DarajaStub
+from shop.models import Cart, CartItem, Category, Product
+
+CSRF_TOKEN = 'benchmarkbenchmarkbenchmarkbench'
+CHECKOUT_FORM = {'phone_number': '254712345678', 'account_number': 'LOAD', 'delivery_address': 'Nairobi'}
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-tests the async checkout view in one ASGI application (one event loop) against '
+        'a slow local Daraja stub, then the same load through the sync WSGI handler on a pool '
+        'of threads. Runs against a throwaway database that is destroyed afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=200)
+        parser.add_argument('--delay', type=float, default=1.0, help='Seconds the stub takes per STK push')
+        parser.add_argument('--threads', type=int, default=4, help='WSGI threads to compare against')
+
+    def handle(self, *args, **options):
+        # Created and migrated the way the test runner does it, so no
+        # orders, payments or users end up in the real database or cache
+        old_config = setup_databases(
+            verbosity=0, interactive=False, aliases={DEFAULT_DB_ALIAS}, serialized_aliases=set()
+        )
+        try:
+            with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+                self.benchmark(options['checkouts'], options['delay'], options['threads'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def benchmark(self, count, delay, threads):
+        category = Category.objects.create(name='Load test', slug='load-test-checkout')
+        product = Product.objects.create(
+            category=category, name='Load test item', slug='load-test-item',
+            description='Load test', price=Decimal('10.00'), stock=count * 2,
+        )
+        async_sessions = self.sessions(product, 'async', count)
+        sync_sessions = self.sessions(product, 'sync', count)
+
+        with DarajaStub(delay=delay) as stub, override_settings(MPESA_BASE_URL=stub.url):
+            started = time.perf_counter()
+            results = asyncio.run(self.run_checkouts(async_sessions))
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'{count} concurrent checkouts with a {delay:.1f}s Daraja: {self.sent(results)} STK pushes '
+                f'sent in {elapsed:.2f}s on one event loop'
+            )
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(threads) as pool:
+                results = list(pool.map(self.sync_checkout, sync_sessions))
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'The same load through the WSGI handler on {threads} threads: {self.sent(results)} STK pushes '
+                f'sent in {elapsed:.2f}s'
+            )
+
+    def sessions(self, product, prefix, count):
+        """Session ids of ``count`` new users, each with ``product`` in their cart"""
+        users = User.objects.bulk_create(User(username=f'loadtest-{prefix}-{i}') for i in range(count))
+        sessions = []
+        for user in users:
+            CartItem.objects.create(cart=Cart.objects.create(user=user), product=product, quantity=1)
+            client = Client()
+            client.force_login(user)
+            sessions.append(client.cookies['sessionid'].value)
+        return sessions
+
+    def sent(self, results):
+        return sum(1 for r in results if r.get('checkout_request_id'))
+
+    async def run_checkouts(self, sessions):
+        transport = httpx.ASGITransport(app=get_asgi_application())
+        async with httpx.AsyncClient(transport=transport, base_url='http://localhost', timeout=None) as client:
+            return await asyncio.gather(*(self.checkout(client, session) for session in sessions))
+
+    async def checkout(self, client, session):
+        response = await client.post(
+            '/checkout/',
+            data=CHECKOUT_FORM,
+            cookies={'sessionid': session, 'csrftoken': CSRF_TOKEN},
+            headers={'X-CSRFToken': CSRF_TOKEN},
+        )
+        return response.json()
+
+    def sync_checkout(self, session):
+        client = Client()
+        client.cookies['sessionid'] = session
+        try:
+            return client.post('/checkout/', data=CHECKOUT_FORM).json()
+        finally:
+            close_old_connections()
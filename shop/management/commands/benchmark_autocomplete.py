@@ -0,0 +1,99 @@
+import random
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from shop.autocomplete import AutocompleteIndex
+from shop.models import Brand, Category, Product
+from shop.search import apply_search, get_backend
+
+WORDS = [
+    'samsung', 'galaxy', 'apple', 'iphone', 'pro', 'max', 'ultra', 'lenovo', 'thinkpad',
+    'sony', 'bravia', 'smart', 'tv', 'wireless', 'headphones', 'leather', 'case', 'charger',
+    'cotton', 'shirt', 'running', 'shoes', 'blender', 'kettle', 'stainless', 'steel', 'novel',
+    'football', 'yoga', 'mat', 'lipstick', 'serum', 'lego', 'puzzle', 'tyre', 'engine', 'oil',
+]
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks /api/search-suggestions/ lookups: in-memory autocomplete index vs the '
+        'database (LIKE and full-text). Synthetic products are created inside a '
+        'transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            self.create_catalog(rng, options['products'])
+            queries = [
+                rng.choice(WORDS)[:rng.randint(2, 6)] for _ in range(options['queries'])
+            ]
+
+            index = AutocompleteIndex()
+            started = time.perf_counter()
+            index.rebuild()
+            self.stdout.write(
+                f'Built autocomplete index with {len(index)} entries in '
+                f'{time.perf_counter() - started:.2f}s'
+            )
+
+            self.report('LIKE (previous implementation)', queries, self.like_lookup)
+            self.report('Full-text search', queries, self.search_lookup)
+            self.report('In-memory autocomplete', queries, index.suggest)
+            self.report('In-memory autocomplete (warm)', queries, index.suggest)
+
+            transaction.set_rollback(True)
+
+    def create_catalog(self, rng, count):
+        self.stdout.write(f'Creating {count} synthetic products...')
+        category = Category.objects.create(name='Benchmark', slug='benchmark-autocomplete')
+        brand = Brand.objects.create(name='Benchmark Brand')
+        products = []
+        for i in range(count):
+            name = ' '.join(rng.sample(WORDS, 4)) + f' {i}'
+            products.append(Product(
+                category=category, brand=brand, name=name, slug=f'bench-{i}',
+                description=f'{name} ' + ' '.join(rng.sample(WORDS, 10)),
+                price=Decimal(rng.randint(100, 100000)), stock=10,
+                sold_count=rng.randint(0, 1000), view_count=rng.randint(0, 10000),
+            ))
+        Product.objects.bulk_create(products, batch_size=2000)
+        get_backend().rebuild()
+
+    def like_lookup(self, query):
+        return list(Product.objects.filter(
+            Q(name__icontains=query) | Q(description__icontains=query),
+            is_active=True
+        ).values('id', 'name')[:10])
+
+    def search_lookup(self, query):
+        products = apply_search(Product.objects.filter(is_active=True), query)
+        return list(products.order_by('-search_rank', '-sold_count').values('id', 'name')[:10])
+
+    def report(self, label, queries, lookup):
+        samples = []
+        for query in queries:
+            started = time.perf_counter()
+            lookup(query)
+            samples.append((time.perf_counter() - started) * 1e6)
+
+        self.stdout.write(
+            f'{label:32} p50={percentile(samples, 50):10.1f}us  '
+            f'p99={percentile(samples, 99):10.1f}us  mean={statistics.mean(samples):10.1f}us'
+        )
@@ -0,0 +1,81 @@
+import os
+import ssl
+import statistics
+import subprocess
+import tempfile
+import time
+
+import requests
+import urllib3
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.daraja_stub import DarajaStub
+from shop.management.commands.benchmark_autocomplete import percentile
+from shop.mpesa import DarajaClient
+
+STK_PATH = '/mpesa/stkpush/v1/processrequest'
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks STK push calls against a local Daraja stub: a new connection per call '
+        '(bare requests.post) vs the pooled keep-alive DarajaClient.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=300)
+        parser.add_argument(
+            '--tls', action='store_true',
+            help='Serve the stub over HTTPS with a throwaway self-signed certificate (needs openssl)'
+        )
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp:
+            ssl_context = self.self_signed_context(tmp) if options['tls'] else None
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+            with DarajaStub(ssl_context=ssl_context) as stub:
+                headers = {'Authorization': f'Bearer {stub.issue_token()}'}
+                count = options['requests']
+
+                self.report('New connection per call', count, lambda: requests.post(
+                    stub.url + STK_PATH, json={}, headers=headers, timeout=5, verify=False
+                ))
+
+                client = DarajaClient(base_url=stub.url)
+                self.report('Pooled DarajaClient', count, lambda: client.post(
+                    STK_PATH, json={}, headers=headers, verify=False
+                ))
+                stats = client.stats()[STK_PATH]
+                self.stdout.write(
+                    f"DarajaClient opened {stats['new_connections']} connection(s) for "
+                    f"{stats['requests']} requests ({stats['reused_connections']} reused)"
+                )
+                client.close()
+
+    def self_signed_context(self, directory):
+        cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+        try:
+            subprocess.run([
+                'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                '-subj', '/CN=127.0.0.1', '-keyout', key, '-out', cert,
+            ], check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise CommandError(f'Could not create a certificate with openssl: {e}')
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        return context
+
+    def report(self, label, count, call):
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            response = call()
+            samples.append((time.perf_counter() - started) * 1e3)
+            if response.status_code != 200:
+                raise CommandError(f'{label}: stub returned {response.status_code}')
+
+        self.stdout.write(
+            f'{label:26} p50={percentile(samples, 50):7.2f}ms  '
+            f'p99={percentile(samples, 99):7.2f}ms  mean={statistics.mean(samples):7.2f}ms'
+        )
@@ -0,0 +1,69 @@
+import time
+import tracemalloc
+from decimal import Decimal
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client
+
+from shop import page_cache
+from shop.models import Category, Product
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures the peak Python memory of one /products/ request as the catalog grows, '
+        'next to loading the whole filtered listing (what product_list used to do before '
+        'paginating). Synthetic products are created inside a transaction that is rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+        parser.add_argument('--query', default='sort=price_low', help='Query string of the listing to request')
+
+    def handle(self, *args, **options):
+        client = Client()
+        url = f'/products/?{options["query"]}'
+
+        with transaction.atomic():
+            category = Category.objects.create(name='Benchmark', slug='benchmark-product-list')
+            # Template loading and first-request setup shouldn't count
+            client.get(url)
+
+            created = 0
+            for size in sorted(options['sizes']):
+                Product.objects.bulk_create(
+                    (self.product(category, i) for i in range(created, size)), batch_size=2000
+                )
+                created = size
+                # bulk_create sends no signals; make sure the page is rendered, not served from cache
+                page_cache.invalidate(*page_cache.CATALOG_TAGS)
+
+                view_peak, view_time = self.measure(lambda: client.get(url))
+                list_peak, list_time = self.measure(
+                    lambda: list(Product.objects.filter(is_active=True).with_card_data(AnonymousUser()))
+                )
+                self.stdout.write(
+                    f'{size:>8} products  product_list: peak {view_peak / 1024:8.0f} KiB {view_time * 1000:8.1f}ms  '
+                    f'whole listing: peak {list_peak / 1024:8.0f} KiB {list_time * 1000:8.1f}ms'
+                )
+
+            transaction.set_rollback(True)
+
+    def product(self, category, i):
+        return Product(
+            category=category, name=f'Benchmark product {i}', slug=f'bench-list-{i}',
+            description='Benchmark product', price=Decimal(100 + i % 5000), stock=i % 20,
+            sold_count=i % 997, view_count=i % 1013,
+        )
+
+    def measure(self, work):
+        """Peak traced allocation in bytes and elapsed seconds (with tracing on) of work()"""
+        tracemalloc.start()
+        started = time.perf_counter()
+        work()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak, elapsed
@@ -0,0 +1,32 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.statements import REPORT_FIELDS, StatementError, StatementImport, read_statement
+
+
+class Command(BaseCommand):
+    help = 'Matches an M-Pesa Paybill statement export (CSV/XLSX) against payments and reports discrepancies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', help='Path to the statement export (.csv or .xlsx)')
+        parser.add_argument('--report', help='Write the discrepancy report to this CSV file (default: stdout)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help='Match and report without updating payments')
+
+    def handle(self, *args, **options):
+        report_file = open(options['report'], 'w', newline='') if options['report'] else self.stdout
+        try:
+            report = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS)
+            report.writeheader()
+            statement_import = StatementImport(report, options['batch_size'], options['dry_run'])
+            counts = statement_import.run(read_statement(options['statement']))
+        except (OSError, StatementError) as e:
+            raise CommandError(str(e))
+        finally:
+            if options['report']:
+                report_file.close()
+
+        summary = ', '.join(f'{counts[kind]} {kind}' for kind in sorted(counts) if kind != 'rows')
+        self.stderr.write(f"{counts['rows']} paid-in row(s): {summary or 'nothing to do'}"
+                          + (' (dry run)' if options['dry_run'] else ''))
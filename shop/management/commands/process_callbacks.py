@@ -0,0 +1,55 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from shop import callback_journal
+
+
+class Command(BaseCommand):
+    help = 'Applies journaled M-Pesa callbacks to payments and orders in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.CALLBACK_BATCH_SIZE)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true', help='Process the pending callbacks and exit')
+        parser.add_argument('--lag', action='store_true', help='Report the processing backlog and exit')
+        parser.add_argument('--replay', action='store_true', help='Apply the whole journal again and exit')
+        parser.add_argument('--since', help='With --replay, only entries received at or after this ISO datetime')
+
+    def handle(self, *args, **options):
+        if options['lag']:
+            return self.report_lag()
+        if options['replay']:
+            return self.replay(options['batch_size'], options['since'])
+
+        self.stdout.write('Callback processor started')
+        while True:
+            entries = callback_journal.process_pending(options['batch_size'])
+            if entries:
+                lag = callback_journal.lag()
+                self.stdout.write(
+                    f"Applied {len(entries)} callback(s); {lag['pending']} pending, "
+                    f"oldest {lag['oldest_pending_age']:.1f}s"
+                )
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['poll_interval'])
+
+    def report_lag(self):
+        lag = callback_journal.lag()
+        delay = lag['last_processing_delay']
+        self.stdout.write(f"Pending callbacks: {lag['pending']}")
+        self.stdout.write(f"Oldest pending: {lag['oldest_pending_age']:.1f}s")
+        self.stdout.write(f"Last processing delay: {'n/a' if delay is None else f'{delay:.1f}s'}")
+
+    def replay(self, batch_size, since):
+        if since:
+            parsed = parse_datetime(since)
+            if parsed is None:
+                raise CommandError(f'Invalid --since datetime: {since}')
+            since = parsed
+        count = callback_journal.replay(batch_size, since=since)
+        self.stdout.write(self.style.SUCCESS(f'Replayed {count} callback(s)'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shop.models import Product
+from shop.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product full-text search index'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        self.stdout.write(f'Rebuilding search index ({backend.__class__.__name__})...')
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {Product.objects.count()} products'))
@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Looks up payments still pending without a callback via the STK Push Query API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.RECONCILE_WORKERS)
+        parser.add_argument('--rate', type=float, default=settings.RECONCILE_RATE, help='Max queries per second')
+        parser.add_argument('--older-than', type=int, help='Seconds since checkout (default RECONCILE_AFTER)')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help='Keep running, one pass every --poll-interval')
+        parser.add_argument('--poll-interval', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        while True:
+            outcomes = reconcile.reconcile(
+                options['batch_size'], options['workers'], options['rate'], options['older_than']
+            )
+            self.stdout.write(
+                f'Checked {sum(outcomes.values())} payment(s): '
+                + (', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items())) or 'none stale')
+            )
+            if not options['loop']:
+                break
+            time.sleep(options['poll_interval'])
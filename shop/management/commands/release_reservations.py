@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop import payments
+
+
+class Command(BaseCommand):
+    help = 'Cancels unpaid orders whose stock reservation has expired and puts the stock back'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--poll-interval', type=float, default=30.0)
+        parser.add_argument('--once', action='store_true', help='Release the expired reservations and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            expired = payments.expire_reservations(options['batch_size'])
+            if expired:
+                self.stdout.write(f'Released expired reservations of {expired} order(s)')
+            # A short batch means the backlog is cleared
+            if expired < options['batch_size']:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
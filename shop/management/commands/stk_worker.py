@@ -0,0 +1,56 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from shop import stk_queue
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Sends queued M-Pesa STK push requests, retrying failures with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=settings.STK_WORKER_THREADS)
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true', help='Process the ready jobs and exit')
+
+    def handle(self, *args, **options):
+        threads = options['threads']
+        self.stdout.write(f'STK worker started with {threads} thread(s)')
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            while True:
+                jobs = stk_queue.claim(limit=threads * 2)
+                if jobs:
+                    if threads == 1:
+                        statuses = [self.run_job(job) for job in jobs]
+                    else:
+                        statuses = list(pool.map(self.run_job_in_thread, jobs))
+                    self.stdout.write(
+                        f'Processed {len(jobs)} job(s): '
+                        + ', '.join(f'{statuses.count(s)} {s}' for s in sorted(set(statuses)))
+                    )
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['poll_interval'])
+
+    def run_job(self, job):
+        try:
+            return stk_queue.process(job)
+        except Exception as e:
+            # The push may have gone out before the crash, so don't send it again
+            logger.error(f"STK job {job.pk} crashed: {str(e)}")
+            stk_queue.mark_unknown(job, str(e))
+            return job.status
+
+    def run_job_in_thread(self, job):
+        try:
+            return self.run_job(job)
+        finally:
+            close_old_connections()
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS shop_product_fts USING fts5("
+    "name, description, category, brand, tokenize='unicode61 remove_diacritics 2')"
+)
+SQLITE_POPULATE = (
+    "INSERT INTO shop_product_fts (rowid, name, description, category, brand) "
+    "SELECT p.id, p.name, p.description, c.name, COALESCE(b.name, '') "
+    "FROM shop_product p "
+    "JOIN shop_category c ON c.id = p.category_id "
+    "LEFT JOIN shop_brand b ON b.id = p.brand_id"
+)
+POSTGRES_CREATE = (
+    "CREATE INDEX IF NOT EXISTS shop_product_search_gin ON shop_product USING GIN (("
+    "setweight(to_tsvector('simple', coalesce(shop_product.name, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(shop_product.description, '')), 'C')))"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_CREATE)
+        schema_editor.execute(SQLITE_POPULATE)
+    elif vendor == 'postgresql':
+        schema_editor.execute(POSTGRES_CREATE)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS shop_product_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS shop_product_search_gin")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_product_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
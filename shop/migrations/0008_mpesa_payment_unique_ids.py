@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:23
+
+from django.db import migrations, models
+from django.db.models import Case, Count, Value, When
+
+
+def clear_blank_and_duplicate_ids(apps, schema_editor):
+    """
+    Make the ids unique before the constraints go on: blank ids become NULL,
+    and of payments sharing an id only one (a completed one if any, then
+    the oldest) keeps it. A cleared receipt is noted in result_description.
+    """
+    MpesaPayment = apps.get_model('shop', 'MpesaPayment')
+    for field in ('checkout_request_id', 'mpesa_receipt_number'):
+        MpesaPayment.objects.filter(**{field: ''}).update(**{field: None})
+        duplicates = (
+            MpesaPayment.objects.exclude(**{f'{field}__isnull': True})
+            .values(field).annotate(n=Count('pk')).filter(n__gt=1).values_list(field, flat=True)
+        )
+        for value in list(duplicates):
+            keep, *others = MpesaPayment.objects.filter(**{field: value}).order_by(
+                Case(When(status='completed', then=Value(0)), default=Value(1)), 'pk'
+            )
+            for payment in others:
+                setattr(payment, field, None)
+                if field == 'mpesa_receipt_number':
+                    payment.result_description = f"Duplicate receipt {value} cleared; kept on payment {keep.pk}"
+                payment.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_stk_push_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_blank_and_duplicate_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='mpesapayment',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='mpesapayment',
+            name='mpesa_receipt_number',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
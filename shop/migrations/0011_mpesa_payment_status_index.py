@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mpesapayment',
+            index=models.Index(fields=['status', 'created_at'], name='shop_payment_status_idx'),
+        ),
+    ]
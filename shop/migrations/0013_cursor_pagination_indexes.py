@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0012_hot_lookup_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='order',
+            name='shop_order_user_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='order',
+            name='shop_order_user_status_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='shop_product_featured_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='shop_product_cat_featured_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='shop_product_instock_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='product',
+            name='shop_product_newest_idx',
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='shop_order_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'status', '-created_at', '-id'], name='shop_order_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-is_featured', '-sold_count', '-view_count', '-id'], name='shop_product_featured_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['category', '-is_featured', '-sold_count', '-view_count', '-id'], name='shop_product_cat_featured_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True), ('stock__gt', 0)), fields=['-is_featured', '-sold_count', '-view_count', '-id'], name='shop_product_instock_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['-created_at', '-id'], name='shop_product_newest_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:54
+
+from django.db import migrations, models
+
+
+def backfill_category_paths(apps, schema_editor):
+    Category = apps.get_model('shop', 'Category')
+
+    children = {}
+    for pk, parent_id in Category.objects.values_list('pk', 'parent_id'):
+        children.setdefault(parent_id, []).append(pk)
+
+    paths = {}
+    pending = [(pk, '') for pk in children.get(None, [])]
+    while pending:
+        pk, parent_path = pending.pop()
+        paths[pk] = f'{parent_path}{pk}/'
+        pending.extend((child, paths[pk]) for child in children.get(pk, []))
+
+    Category.objects.bulk_update(
+        [Category(pk=pk, path=path) for pk, path in paths.items()], ['path'], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0013_cursor_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill_category_paths, migrations.RunPython.noop),
+    ]
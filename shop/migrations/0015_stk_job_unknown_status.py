@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0014_category_path'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stkpushjob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('sent', 'Sent'), ('unknown', 'Outcome unknown'), ('failed', 'Failed')], default='queued', max_length=20),
+        ),
+    ]
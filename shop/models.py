@@ -1,19 +1,40 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models import Avg
+from django.db.models import Exists, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Concat, NullIf, Substr
+from django.utils.functional import cached_property
+
+from . import pricing
+
+class CategoryQuerySet(models.QuerySet):
+    def subtree(self, category):
+        """``category`` and its descendants at any depth: one range scan of the path index"""
+        if not category.path:
+            # Not saved through save() (bulk_create, raw fixture loads): the
+            # empty range would match every other category without a path
+            return self.filter(pk=category.pk)
+        # Paths are digits and '/', and '0' sorts right after '/'
+        return self.filter(path__gte=category.path, path__lt=category.path[:-1] + '0')
+
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True , null=True, blank=True )
     description = models.TextField(blank=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='subcategories')
+    # Materialized path: the ids from the root down to this category, e.g.
+    # "3/17/42/". Maintained by save(); moving a category rewrites its subtree.
+    path = models.CharField(max_length=255, default='', editable=False, db_index=True)
     image = models.ImageField(upload_to='categories/', blank=True, null=True)
     is_active = models.BooleanField(default=True, blank=True, null=True)
     display_order = models.IntegerField(default=0, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CategoryQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Categories"
         ordering = ['display_order', 'name']
@@ -21,6 +42,47 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def depth(self):
+        return self.path.count('/') - 1
+
+    @property
+    def ancestor_ids(self):
+        return [int(pk) for pk in self.path.split('/')[:-2]]
+
+    def ancestors(self):
+        """Root first, down to the parent (for breadcrumbs)"""
+        return sorted(Category.objects.filter(pk__in=self.ancestor_ids), key=lambda c: len(c.path))
+
+    def is_in_subtree_of(self, category):
+        return bool(category.path) and self.path.startswith(category.path)
+
+    def clean(self):
+        super().clean()
+        if self.pk and self.parent_id:
+            parent = Category.objects.only('path').get(pk=self.parent_id)
+            if parent.pk == self.pk or parent.is_in_subtree_of(self):
+                raise ValidationError({'parent': 'A category cannot be moved under itself or its subcategories.'})
+
+    def save(self, *args, **kwargs):
+        # Trust the stored paths over this instance's, which may predate a move
+        stored = Category.objects.filter(pk=self.pk).values_list('path', flat=True).first() if self.pk else None
+        self.path = stored or ''
+        parent_path = ''
+        if self.parent_id:
+            parent_path = Category.objects.values_list('path', flat=True).get(pk=self.parent_id)
+            if self.path and parent_path.startswith(self.path):
+                raise ValueError(f'{self} cannot be moved under itself or its subcategories')
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+            path = f'{parent_path}{self.pk}/'
+            if path != self.path:
+                subtree = Category.objects.subtree(self) if self.path else Category.objects.filter(pk=self.pk)
+                subtree.update(path=Concat(Value(path), Substr('path', len(self.path) + 1)))
+                self.path = path
+
 
 class Brand(models.Model):
     name = models.CharField(max_length=100)
@@ -34,6 +96,35 @@ class Brand(models.Model):
         return self.name
 
 
+class ProductQuerySet(models.QuerySet):
+
+    def with_card_data(self, user=None):
+        """
+        Everything a product grid card renders, fetched in one SQL round trip.
+
+        Ratings come from the denormalized columns on Product; this adds the
+        category and brand joins, the card's main image (the product image,
+        falling back to its first gallery image) and whether the product is
+        in the given user's wishlist.
+        """
+        gallery_image = ProductImage.objects.filter(
+            product=OuterRef('pk')
+        ).order_by('display_order', 'pk').values('image')[:1]
+
+        if user is not None and user.is_authenticated:
+            in_wishlist = Exists(Wishlist.objects.filter(user=user, product=OuterRef('pk')))
+        else:
+            in_wishlist = Value(False, output_field=models.BooleanField())
+
+        return self.select_related('category', 'brand').annotate(
+            main_image=Coalesce(
+                NullIf('image', Value('')), Subquery(gallery_image),
+                output_field=models.CharField(),
+            ),
+            in_wishlist=in_wishlist,
+        )
+
+
 class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     brand = models.ForeignKey(Brand, on_delete=models.SET_NULL, null=True, blank=True, related_name='products')
@@ -69,6 +160,15 @@ class Product(models.Model):
     # Stats
     view_count = models.IntegerField(default=0, blank=True, null=True)
     sold_count = models.IntegerField(default=0, blank=True, null=True)
+
+    # Rating aggregates (maintained from approved reviews, see shop/ratings.py)
+    rating_avg = models.FloatField(default=0)
+    rating_count = models.IntegerField(default=0)
+    rating_1_count = models.IntegerField(default=0)
+    rating_2_count = models.IntegerField(default=0)
+    rating_3_count = models.IntegerField(default=0)
+    rating_4_count = models.IntegerField(default=0)
+    rating_5_count = models.IntegerField(default=0)
     
     # Shipping
     free_shipping = models.BooleanField(default=False, blank=True, null=True)
@@ -81,6 +181,31 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['is_active', '-rating_avg'], name='shop_product_rating_idx'),
+            # product_list/category pages: default "featured" sort, price
+            # and newest sorts. Partial, since only active products are listed.
+            # Descending sorts end in -id, the cursor pagination tiebreaker
+            # (SQLite only appends the rowid ascending).
+            models.Index(
+                fields=['-is_featured', '-sold_count', '-view_count', '-id'],
+                name='shop_product_featured_idx', condition=models.Q(is_active=True),
+            ),
+            models.Index(
+                fields=['category', '-is_featured', '-sold_count', '-view_count', '-id'],
+                name='shop_product_cat_featured_idx', condition=models.Q(is_active=True),
+            ),
+            models.Index(
+                fields=['-is_featured', '-sold_count', '-view_count', '-id'],
+                name='shop_product_instock_idx', condition=models.Q(is_active=True, stock__gt=0),
+            ),
+            models.Index(fields=['price'], name='shop_product_price_idx', condition=models.Q(is_active=True)),
+            models.Index(fields=['-created_at', '-id'], name='shop_product_newest_idx', condition=models.Q(is_active=True)),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -98,16 +223,49 @@ class Product(models.Model):
             return int(((self.compare_at_price - self.price) / self.compare_at_price) * 100)
         return 0
     
+    @property
+    def review_summary(self):
+        from .ratings import ReviewSummary
+        return ReviewSummary.from_product(self)
+
     @property
     def average_rating(self):
-        avg = self.reviews.filter(is_approved=True).aggregate(Avg('rating'))['rating__avg']
-        return round(avg, 1) if avg else 0
+        return self.review_summary.rounded_average
     
     @property
     def review_count(self):
-        return self.reviews.filter(is_approved=True).count()
+        return self.review_summary.total
+
+
+class Match(models.Lookup):
+    """``field MATCH query``: an SQLite full-text query"""
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', (*lhs_params, *rhs_params)
+
+
+class ProductSearchIndex(models.Model):
+    """
+    The SQLite FTS5 table kept by shop/search.py (created in migration
+    0006), so searches can join it. It doesn't exist on other databases.
+    """
+    product = models.OneToOneField(
+        Product, primary_key=True, db_column='rowid', db_constraint=False,
+        on_delete=models.DO_NOTHING, related_name='search_index',
+    )
+    # FTS5's hidden column named after the table: MATCH on it searches every column
+    document = models.TextField(db_column='shop_product_fts')
+
+    class Meta:
+        managed = False
+        db_table = 'shop_product_fts'
 
 
+ProductSearchIndex._meta.get_field('document').register_lookup(Match)
+
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='products/gallery/')
@@ -117,6 +275,10 @@ class ProductImage(models.Model):
 
     class Meta:
         ordering = ['display_order']
+        indexes = [
+            # A product card's first gallery image (Product.with_card_data)
+            models.Index(fields=['product', 'display_order', 'id'], name='shop_productimage_order_idx'),
+        ]
 
     def __str__(self):
         return f"Image for {self.product.name}"
@@ -167,6 +329,22 @@ class Review(models.Model):
     def __str__(self):
         return f"Review by {self.user.username} for {self.product.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what this review contributed to the product's rating
+        # aggregates so signals can apply an incremental delta on save.
+        if {'product_id', 'rating', 'is_approved'} <= set(field_names):
+            instance._rating_state = instance.rating_contribution
+        return instance
+
+    @property
+    def rating_contribution(self):
+        """(product_id, star) this review counts towards, or None if unapproved"""
+        if not self.is_approved or self.rating is None:
+            return None
+        return (self.product_id, int(self.rating))
+
 
 class ReviewImage(models.Model):
     review = models.ForeignKey(Review, on_delete=models.CASCADE, related_name='images')
@@ -240,6 +418,11 @@ class Order(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # orders_view/account_view: a user's orders, newest first, optionally by status
+            models.Index(fields=['user', '-created_at', '-id'], name='shop_order_user_idx'),
+            models.Index(fields=['user', 'status', '-created_at', '-id'], name='shop_order_user_status_idx'),
+        ]
 
     def __str__(self):
         return f"Order #{self.order_number or self.id} - {self.user.username}"
@@ -297,8 +480,8 @@ class MpesaPayment(models.Model):
     
     # M-Pesa Response Fields
     merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
-    checkout_request_id = models.CharField(max_length=100, blank=True, null=True)
-    mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True, unique=True)
+    mpesa_receipt_number = models.CharField(max_length=100, blank=True, null=True, unique=True)
     transaction_date = models.DateTimeField(blank=True, null=True)
     
     status = models.CharField(max_length=20, choices=PAYMENT_STATUS, default='pending')
@@ -308,10 +491,96 @@ class MpesaPayment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Stale pending payments, for reconcile_payments
+            models.Index(fields=['status', 'created_at'], name='shop_payment_status_idx'),
+        ]
+
     def __str__(self):
         return f"Payment for Order #{self.order.id} - {self.status}"
 
 
+class StkPushJob(models.Model):
+    """Outbox entry for an STK push; sent by the stk_worker command"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('sent', 'Sent'),
+        ('unknown', 'Outcome unknown'),
+        ('failed', 'Failed'),
+    ]
+
+    payment = models.OneToOneField(MpesaPayment, on_delete=models.CASCADE, related_name='stk_job')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['run_after']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='shop_stkjob_ready_idx'),
+        ]
+
+    def __str__(self):
+        return f"STK push for Order #{self.payment.order_id} - {self.status}"
+
+
+class StockReservation(models.Model):
+    """
+    Stock held for one line of an unpaid order. The quantity is already
+    taken out of Product/ProductVariant.stock; it goes back if the
+    reservation expires or the payment fails, and stays out once paid.
+    """
+    STATUS_CHOICES = [
+        ('active', 'Active'),
+        ('consumed', 'Consumed'),
+        ('released', 'Released'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    payment = models.ForeignKey(MpesaPayment, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
+    expires_at = models.DateTimeField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='shop_reservation_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity}x {self.product.name} for Order #{self.order_id} - {self.status}"
+
+
+class MpesaCallback(models.Model):
+    """An STK callback exactly as received; applied by the process_callbacks command"""
+    body = models.TextField()
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    result = models.CharField(max_length=255, blank=True, null=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='shop_callback_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"Callback {self.checkout_request_id or '(invalid)'} - {self.result or 'pending'}"
+
+
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='cart')
     created_at = models.DateTimeField(auto_now_add=True)
@@ -320,13 +589,17 @@ class Cart(models.Model):
     def __str__(self):
         return f"Cart - {self.user.username}"
 
+    @cached_property
+    def totals(self):
+        return pricing.cart_totals(self)
+
     @property
     def total_amount(self):
-        return sum(item.subtotal for item in self.items.all())
+        return self.totals.total_amount
 
     @property
     def total_items(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.totals.total_items
 
 
 class CartItem(models.Model):
@@ -344,8 +617,8 @@ class CartItem(models.Model):
     @property
     def subtotal(self):
         price = self.product.price
-        if self.variant:
-            price += self.variant.price_adjustment
+        if self.variant_id:
+            price += self.variant.price_adjustment or 0
         return self.quantity * price
 
 
@@ -0,0 +1,571 @@
+"""
+Daraja (M-Pesa) API helpers.
+
+All calls go through DarajaClient, which keeps a pooled keep-alive
+requests.Session, so checkouts reuse TCP/TLS connections to Safaricom
+instead of paying a handshake per call. It records per-endpoint latency
+and how many requests needed a new connection (``client.stats()``).
+
+Access tokens are valid for about an hour, so they are cached in process
+and in the shared Django cache (for other workers) together with their
+expiry. A token is refreshed MPESA_TOKEN_REFRESH_MARGIN seconds before it
+expires: one caller refreshes while everyone else keeps using the current
+token, and only when there is no usable token at all do callers wait, for
+a single refresh per process (and, through a cache lock, per deployment).
+"""
+import asyncio
+import base64
+import logging
+import threading
+import time
+import weakref
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+BASE_URLS = {
+    'sandbox': 'https://sandbox.safaricom.co.ke',
+    'production': 'https://api.safaricom.co.ke',
+}
+
+TOKEN_CACHE_KEY = 'mpesa:access_token'
+TOKEN_LOCK_KEY = 'mpesa:access_token:lock'
+TOKEN_LOCK_TIMEOUT = 30
+
+
+def base_url():
+    """Daraja host for MPESA_ENVIRONMENT, unless MPESA_BASE_URL overrides it"""
+    if settings.MPESA_BASE_URL:
+        return settings.MPESA_BASE_URL.rstrip('/')
+    if settings.MPESA_ENVIRONMENT == 'sandbox':
+        return BASE_URLS['sandbox']
+    return BASE_URLS['production']
+
+
+def generate_password():
+    """
+    Generate password and timestamp for STK Push
+    Password = Base64(Shortcode + Passkey + Timestamp)
+    """
+    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    data_to_encode = f"{settings.MPESA_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}"
+    password = base64.b64encode(data_to_encode.encode()).decode()
+    return password, timestamp
+
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    new_connections: int = 0
+    errors: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'reused_connections': self.requests - self.new_connections,
+            'new_connections': self.new_connections,
+            'errors': self.errors,
+            'mean_ms': round(self.total_time / self.requests * 1000, 2) if self.requests else 0,
+            'max_ms': round(self.max_time * 1000, 2),
+        }
+
+
+class InstrumentedClient:
+    """Per-endpoint latency and connection reuse, shared by both clients"""
+
+    def __init__(self, base_url=None):
+        self._base_url = base_url
+        self._stats = defaultdict(EndpointStats)
+        self._stats_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return self._base_url or base_url()
+
+    def record(self, method, path, elapsed, status_code, new_connection):
+        with self._stats_lock:
+            stats = self._stats[path.split('?')[0]]
+            stats.requests += 1
+            stats.new_connections += new_connection
+            stats.errors += status_code is None or status_code >= 400
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+        logger.debug(
+            f"Daraja {method} {path}: {status_code or 'error'} "
+            f"in {elapsed * 1000:.1f}ms ({'new' if new_connection else 'reused'} connection)"
+        )
+
+    def stats(self):
+        """Per-endpoint request count, latency and connection reuse"""
+        with self._stats_lock:
+            return {path: stats.as_dict() for path, stats in self._stats.items()}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+
+class DarajaClient(InstrumentedClient):
+    """
+    Keep-alive HTTP client for the Daraja API.
+
+    GETs are retried on connection errors and 429/5xx responses. POSTs are
+    only retried when the connection could not be opened, since a repeated
+    STK push would prompt the customer twice.
+    """
+
+    def __init__(self, base_url=None, pool_size=None, connect_timeout=None, read_timeout=None, retries=None):
+        super().__init__(base_url)
+        self.timeout = (
+            connect_timeout or settings.MPESA_CONNECT_TIMEOUT,
+            read_timeout or settings.MPESA_READ_TIMEOUT,
+        )
+        retries = settings.MPESA_HTTP_RETRIES if retries is None else retries
+        self.adapter = HTTPAdapter(
+            pool_maxsize=pool_size or settings.MPESA_HTTP_POOL_SIZE,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({'GET'}),
+                raise_on_status=False,
+            ),
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def request(self, method, path, timeout=None, **kwargs):
+        url = f'{self.base_url}{path}'
+        connections = self.connections_opened()
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            return response
+        finally:
+            # Approximate when several threads share the pool
+            self.record(
+                method, path, time.perf_counter() - started,
+                response.status_code if response is not None else None,
+                self.connections_opened() > connections,
+            )
+
+    def connections_opened(self):
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncDarajaClient(InstrumentedClient):
+    """
+    httpx counterpart of DarajaClient for async views, so a request waiting
+    on Daraja holds no thread. Connections are only retried when they could
+    not be opened. httpx clients are bound to an event loop, so one is kept
+    per loop.
+    """
+
+    def __init__(self, base_url=None, max_connections=None, connect_timeout=None, read_timeout=None, retries=None):
+        super().__init__(base_url)
+        self.timeout = httpx.Timeout(
+            read_timeout or settings.MPESA_READ_TIMEOUT,
+            connect=connect_timeout or settings.MPESA_CONNECT_TIMEOUT,
+        )
+        self.limits = httpx.Limits(
+            max_connections=max_connections or settings.MPESA_ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.MPESA_HTTP_POOL_SIZE,
+        )
+        self.retries = settings.MPESA_HTTP_RETRIES if retries is None else retries
+        self._clients = weakref.WeakKeyDictionary()
+
+    def client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            transport = httpx.AsyncHTTPTransport(limits=self.limits, retries=self.retries)
+            client = self._clients[loop] = httpx.AsyncClient(transport=transport, timeout=self.timeout)
+        return client
+
+    async def request(self, method, path, **kwargs):
+        new_connection = False
+
+        async def trace(event, info):
+            nonlocal new_connection
+            if event == 'connection.connect_tcp.complete':
+                new_connection = True
+
+        started = time.perf_counter()
+        response = None
+        try:
+            response = await self.client().request(
+                method, f'{self.base_url}{path}', extensions={'trace': trace}, **kwargs
+            )
+            return response
+        finally:
+            self.record(
+                method, path, time.perf_counter() - started,
+                response.status_code if response is not None else None,
+                new_connection,
+            )
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+
+client = DarajaClient()
+async_client = AsyncDarajaClient()
+
+
+@dataclass(frozen=True)
+class AccessToken:
+    value: str
+    fetched_at: float
+    expires_at: float
+
+    def expired(self, now):
+        return now >= self.expires_at
+
+    def due(self, now):
+        """Inside the proactive refresh window (or already expired)"""
+        return now >= self.expires_at - settings.MPESA_TOKEN_REFRESH_MARGIN
+
+    def age(self, now):
+        return now - self.fetched_at
+
+
+class TokenManager:
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._token = None
+
+    def get_token(self):
+        """A valid access token, or None if Daraja couldn't be reached"""
+        token = self._current()
+        now = self.clock()
+        if token and not token.due(now):
+            return token.value
+
+        if token and not token.expired(now):
+            # Refresh ahead of expiry without making anyone wait for it
+            if not self._lock.acquire(blocking=False):
+                return token.value
+            try:
+                refreshed = self._refresh(token)
+            finally:
+                self._lock.release()
+            return (refreshed or token).value
+
+        with self._lock:
+            token = self._current()
+            if token and not token.expired(self.clock()):
+                return token.value
+            refreshed = self._refresh(token)
+            return refreshed.value if refreshed else None
+
+    def invalidate(self, value=None):
+        """Drop a token Daraja rejected (401), unless it was already replaced"""
+        if self._token and value in (None, self._token.value):
+            self._token = None
+        shared = cache.get(TOKEN_CACHE_KEY)
+        if shared and value in (None, shared.value):
+            cache.delete(TOKEN_CACHE_KEY)
+
+    def token_age(self):
+        """Seconds since the current token was issued, or None"""
+        token = self._current()
+        return token.age(self.clock()) if token else None
+
+    def _current(self):
+        """The freshest of our token and the one other processes shared"""
+        token = self._token
+        if token is None or token.due(self.clock()):
+            shared = cache.get(TOKEN_CACHE_KEY)
+            if shared and (token is None or shared.fetched_at > token.fetched_at):
+                self._token = token = shared
+        return token
+
+    def _refresh(self, current):
+        if not cache.add(TOKEN_LOCK_KEY, 1, TOKEN_LOCK_TIMEOUT):
+            # Another process is refreshing; wait briefly for its token
+            deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT
+            while time.monotonic() < deadline:
+                shared = cache.get(TOKEN_CACHE_KEY)
+                if shared and (current is None or shared.fetched_at > current.fetched_at):
+                    self._token = shared
+                    return shared
+                if current and not current.expired(self.clock()):
+                    return None
+                time.sleep(0.1)
+
+        try:
+            token = self._fetch()
+        finally:
+            cache.delete(TOKEN_LOCK_KEY)
+
+        if token:
+            self._token = token
+            cache.set(TOKEN_CACHE_KEY, token, max(1, int(token.expires_at - token.fetched_at)))
+        return token
+
+    def _fetch(self):
+        """Request a new token from /oauth/v1/generate"""
+        try:
+            credentials = f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}"
+            headers = {
+                'Authorization': f'Basic {base64.b64encode(credentials.encode()).decode()}',
+                'Content-Type': 'application/json'
+            }
+
+            logger.info("Requesting M-Pesa access token...")
+            fetched_at = self.clock()
+            response = client.get(
+                '/oauth/v1/generate', params={'grant_type': 'client_credentials'},
+                headers=headers, timeout=(client.timeout[0], 30),
+            )
+            logger.info(f"Access token response status: {response.status_code}")
+
+            if response.status_code != 200:
+                logger.error(
+                    f"Failed to get access token. Status: {response.status_code}, "
+                    f"Response: {response.text}"
+                )
+                return None
+
+            result = response.json()
+            access_token = result.get('access_token')
+            if not access_token:
+                logger.error(f"No access token in response: {result}")
+                return None
+
+            logger.info("Successfully obtained M-Pesa access token")
+            expires_in = int(result.get('expires_in') or 3599)
+            return AccessToken(access_token, fetched_at, fetched_at + expires_in)
+
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Network error getting access token: {str(e)}")
+            return None
+        except Exception as e:
+            logger.error(f"Error getting M-Pesa access token: {str(e)}")
+            return None
+
+
+token_manager = TokenManager()
+
+
+def get_mpesa_access_token():
+    """
+    Get M-Pesa access token using Consumer Key and Secret
+    """
+    return token_manager.get_token()
+
+
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+
+
+def stk_headers(access_token):
+    return {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+
+
+def stk_payload(payment):
+    password, timestamp = generate_password()
+    return {
+        'BusinessShortCode': settings.MPESA_SHORTCODE,
+        'Password': password,
+        'Timestamp': timestamp,
+        'TransactionType': 'CustomerPayBillOnline',
+        'Amount': int(payment.amount),
+        'PartyA': payment.phone_number,
+        'PartyB': settings.MPESA_SHORTCODE,
+        'PhoneNumber': payment.phone_number,
+        'CallBackURL': settings.MPESA_CALLBACK_URL,
+        'AccountReference': payment.account_number,
+        'TransactionDesc': f'Order #{payment.order_id}'
+    }
+
+
+def parse_stk_response(response):
+    """
+    Daraja's JSON. A 429 was turned away before processing, so it is
+    ``retryable``; after a 5xx Daraja may still have prompted the customer,
+    so the outcome is ``unknown``.
+    """
+    logger.info(f"STK Push response status: {response.status_code}")
+    logger.info(f"STK Push response: {response.text}")
+
+    try:
+        result = response.json()
+    except ValueError:
+        result = {'errorMessage': f'Unexpected response ({response.status_code})'}
+
+    if response.status_code != 200:
+        logger.error(f"STK Push failed: {result.get('errorMessage', 'Unknown error')}")
+        result['retryable'] = response.status_code == 429
+        result['unknown'] = response.status_code >= 500
+    return result
+
+
+AUTH_FAILED = {'errorMessage': 'Failed to authenticate with M-Pesa', 'retryable': True}
+UNKNOWN_OUTCOME = 'No answer from M-Pesa; the payment request may have been sent'
+
+
+def never_connected(error):
+    """Whether a requests error happened before anything was sent"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    # A dropped connection while waiting for the reply is a ConnectionError too
+    reason = error.args[0] if error.args else None
+    return (
+        isinstance(error, requests.exceptions.ConnectionError)
+        and isinstance(reason, MaxRetryError) and isinstance(reason.reason, NewConnectionError)
+    )
+
+
+def post_with_token(path, payload):
+    """POST to Daraja with the access token, refreshing it once on 401; None without a token"""
+    access_token = get_mpesa_access_token()
+    if not access_token:
+        logger.error("Failed to get access token")
+        return None
+
+    response = client.post(path, json=payload, headers=stk_headers(access_token))
+
+    if response.status_code == 401:
+        # Token revoked or expired early: drop it and retry once
+        logger.warning("M-Pesa rejected the access token, refreshing")
+        token_manager.invalidate(access_token)
+        access_token = get_mpesa_access_token()
+        if not access_token:
+            return None
+        response = client.post(path, json=payload, headers=stk_headers(access_token))
+    return response
+
+
+def initiate_stk_push(payment):
+    """
+    Initiate M-Pesa STK Push for Paybill
+
+    Returns Daraja's response. Errors carry ``errorMessage``, plus
+    ``retryable: True`` when nothing reached Daraja and trying again later
+    may succeed (no connection, 429, no token), or ``unknown: True`` when
+    the request may have been accepted (read timeout, dropped connection,
+    5xx). Sending an unknown one again could prompt the customer twice.
+    """
+    try:
+        payload = stk_payload(payment)
+        logger.info(f"Initiating STK Push for order {payment.order_id}")
+        logger.info(f"Phone: {payment.phone_number}, Amount: {payment.amount}")
+
+        response = post_with_token(STK_PUSH_PATH, payload)
+        if response is None:
+            return dict(AUTH_FAILED)
+        return parse_stk_response(response)
+
+    except requests.exceptions.RequestException as e:
+        if never_connected(e):
+            logger.error(f"Could not connect to M-Pesa for STK Push: {str(e)}")
+            return {'errorMessage': f'Network error: {str(e)}', 'retryable': True}
+        logger.error(f"STK Push sent but not answered: {str(e)}")
+        return {'errorMessage': UNKNOWN_OUTCOME, 'unknown': True}
+    except Exception as e:
+        logger.error(f"STK Push error: {str(e)}")
+        return {'errorMessage': f'Error: {str(e)}'}
+
+
+async def ainitiate_stk_push(payment):
+    """
+    Async initiate_stk_push for async views, with the same ``retryable``
+    and ``unknown`` errors. The token usually comes from memory; a refresh
+    runs the sync TokenManager in a worker thread.
+    """
+    get_token = sync_to_async(get_mpesa_access_token, thread_sensitive=False)
+    try:
+        access_token = await get_token()
+        if not access_token:
+            logger.error("Failed to get access token")
+            return dict(AUTH_FAILED)
+
+        payload = stk_payload(payment)
+        logger.info(f"Initiating STK Push for order {payment.order_id}")
+
+        response = await async_client.post(STK_PUSH_PATH, json=payload, headers=stk_headers(access_token))
+
+        if response.status_code == 401:
+            logger.warning("M-Pesa rejected the access token, refreshing")
+            token_manager.invalidate(access_token)
+            access_token = await get_token()
+            if not access_token:
+                return dict(AUTH_FAILED)
+            response = await async_client.post(STK_PUSH_PATH, json=payload, headers=stk_headers(access_token))
+
+        return parse_stk_response(response)
+
+    except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+        logger.error(f"Could not connect to M-Pesa for STK Push: {str(e)}")
+        return {'errorMessage': f'Network error: {str(e)}', 'retryable': True}
+    except httpx.HTTPError as e:
+        # Read timeouts and dropped connections may come after Daraja took the request
+        logger.error(f"STK Push sent but not answered: {str(e)}")
+        return {'errorMessage': UNKNOWN_OUTCOME, 'unknown': True}
+    except Exception as e:
+        logger.error(f"STK Push error: {str(e)}")
+        return {'errorMessage': f'Error: {str(e)}'}
+
+
+STK_QUERY_PATH = '/mpesa/stkpushquery/v1/query'
+
+
+def query_stk_push(checkout_request_id):
+    """
+    Ask Daraja for the outcome of an STK push (STK Push Query API)
+
+    Returns Daraja's response, which has ``ResultCode``/``ResultDesc`` once
+    the customer has answered or the prompt has timed out. Anything else
+    (still being processed, network trouble) comes back as ``errorMessage``.
+    """
+    password, timestamp = generate_password()
+    payload = {
+        'BusinessShortCode': settings.MPESA_SHORTCODE,
+        'Password': password,
+        'Timestamp': timestamp,
+        'CheckoutRequestID': checkout_request_id,
+    }
+    try:
+        response = post_with_token(STK_QUERY_PATH, payload)
+        if response is None:
+            return dict(AUTH_FAILED)
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+        if response.status_code != 200 and 'errorMessage' not in result:
+            result['errorMessage'] = f'Unexpected response ({response.status_code})'
+        return result
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Network error during STK Push Query: {str(e)}")
+        return {'errorMessage': f'Network error: {str(e)}'}
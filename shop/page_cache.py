@@ -0,0 +1,123 @@
+"""
+Page and fragment caching for the catalog pages.
+
+Catalog views are decorated with ``cache_catalog_page(*tags)``. Each tag is
+a versioned namespace from shop/cache.py that signals bump after a
+committed Product, Category, Brand or Review change, so the cache key of a
+page (path + tag versions + normalized query string) moves on by itself
+and stale entries simply expire.
+
+* Anonymous GET requests are served whole from the cache.
+* Logged-in users get a fresh render, since wishlist hearts and the cart
+  count are per user, but the key is exposed as ``request.catalog_cache_key``
+  so user-independent fragments (filter sidebars, category grids) can be
+  wrapped in ``{% cache ... request.catalog_cache_key %}``.
+"""
+import hashlib
+from functools import wraps
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache as default_cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from . import cache
+
+PRODUCTS = 'products'
+CATEGORIES = 'categories'
+BRANDS = 'brands'
+REVIEWS = 'reviews'
+
+CATALOG_TAGS = (PRODUCTS, CATEGORIES, BRANDS, REVIEWS)
+
+# Query parameters that pick a page, not the result set
+PAGING_PARAMS = ('cursor', 'page', 'partial', 'sort')
+
+
+def normalize_query(query_dict):
+    """Stable query string: empty values dropped, keys and values sorted"""
+    return urlencode(sorted(
+        (key, value)
+        for key, values in query_dict.lists()
+        for value in values
+        if value != ''
+    ))
+
+
+def tag_versions(tags):
+    return '.'.join(str(cache.get_version(tag)) for tag in tags)
+
+
+def catalog_cache_key(request, tags):
+    query = hashlib.md5(normalize_query(request.GET).encode()).hexdigest()
+    return f'catalog_page:{request.path}:{tag_versions(tags)}:{query}'
+
+
+def catalog_summary_key(request, ignore=(), tags=CATALOG_TAGS):
+    """
+    Key for totals over a filtered listing (counts, price range): the same
+    on every page and sort, and for any value of the ``ignore`` parameters
+    """
+    filters = request.GET.copy()
+    for param in (*PAGING_PARAMS, *ignore):
+        filters.pop(param, None)
+    query = hashlib.md5(normalize_query(filters).encode()).hexdigest()
+    return f'catalog_summary:{request.path}:{tag_versions(tags)}:{query}'
+
+
+def invalidate(*tags):
+    for tag in tags:
+        cache.bump_version(tag)
+
+
+def is_cacheable_request(request):
+    return (
+        request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        # A pending flash message would be baked into the page
+        and 'messages' not in request.COOKIES
+    )
+
+
+def is_cacheable_response(request, response):
+    return (
+        response.status_code == 200
+        and not response.streaming
+        and not response.cookies
+        # {% csrf_token %} was rendered; the token must not be shared
+        and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE')
+    )
+
+
+def cache_catalog_page(*tags, timeout=None):
+    """Serve anonymous GETs from the cache until one of ``tags`` changes"""
+    tags = tags or CATALOG_TAGS
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = catalog_cache_key(request, tags)
+            request.catalog_cache_key = key
+
+            if not is_cacheable_request(request):
+                return view(request, *args, **kwargs)
+
+            cached = default_cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+                patch_vary_headers(response, ('Cookie',))
+                return response
+
+            response = view(request, *args, **kwargs)
+            if is_cacheable_response(request, response):
+                default_cache.set(
+                    key,
+                    (response.content, response['Content-Type']),
+                    settings.CATALOG_PAGE_CACHE_TIMEOUT if timeout is None else timeout,
+                )
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapper
+    return decorator
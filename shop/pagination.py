@@ -0,0 +1,169 @@
+"""
+Keyset (cursor) pagination.
+
+Paginator pages with COUNT(*) plus OFFSET, and OFFSET makes the database
+walk past every skipped row, so page 200 of the catalog costs 200 pages of
+work. CursorPaginator instead remembers the sort values of the last row
+shown and asks for the rows that sort after it
+(``WHERE (price, id) > (last_price, last_id)``), which an index on the
+sort columns answers directly however deep the page is.
+
+The page's ordering is the queryset's own order_by() with the primary key
+appended as a tiebreaker, so every row has a unique position. Cursors are
+signed, opaque tokens holding the boundary row's sort values; a tampered
+token, or one made for a different ordering, gives the first page. Sort
+fields may be nullable: NULLs are placed where the database sorts them
+(first or last, see nulls_order_largest).
+
+There is no page count. Views that show a total count it separately and
+cache it (product_list takes it from its facet counts, see shop/facets.py).
+"""
+from datetime import date, datetime, time
+from decimal import Decimal
+
+from django.core import signing
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q
+
+SALT = 'shop.pagination'
+
+
+def ordering_of(queryset):
+    """(field name, descending) pairs for the queryset's ordering plus a pk tiebreaker"""
+    keys = []
+    for name in queryset.query.order_by or queryset.model._meta.ordering:
+        if not isinstance(name, str) or '__' in name or name.lstrip('-') == '?':
+            raise ValueError(f'Cursor pagination needs plain field orderings, not {name!r}')
+        keys.append((name.lstrip('-'), name.startswith('-')))
+    if not keys or keys[-1][0] not in ('pk', queryset.model._meta.pk.name):
+        keys.append(('pk', keys[-1][1] if keys else False))
+    return keys
+
+
+def to_json(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def after(name, value, descending, nullable, nulls_largest, inclusive=False):
+    """Rows that sort after ``value`` on one key (or level with it, when ``inclusive``)"""
+    nulls_last = nullable and nulls_largest != descending
+    if value is None:
+        if nulls_last:
+            return Q(**{f'{name}__isnull': True}) if inclusive else Q(pk__in=[])
+        return Q() if inclusive else Q(**{f'{name}__isnull': False})
+    condition = Q(**{f'{name}__{"lt" if descending else "gt"}{"e" if inclusive else ""}': value})
+    if nulls_last:
+        condition |= Q(**{f'{name}__isnull': True})
+    return condition
+
+
+def keyset_filter(keys, values, nullable, nulls_largest):
+    """
+    Rows after ``values`` in ``keys`` order, written
+    ``a >= x AND (a > x OR (b >= y AND (b > y OR ...)))`` rather than the
+    equivalent ``a > x OR (a = x AND b > y) OR ...`` so the database can
+    seek to ``x`` in an index on the sort columns instead of walking it
+    from the start.
+    """
+    (name, descending), value = keys[0], values[0]
+    strictly = after(name, value, descending, nullable[name], nulls_largest)
+    if len(keys) == 1:
+        return strictly
+    rest = keyset_filter(keys[1:], values[1:], nullable, nulls_largest)
+    return after(name, value, descending, nullable[name], nulls_largest, inclusive=True) & (strictly | rest)
+
+
+class CursorPage:
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class CursorPaginator:
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = ordering_of(queryset)
+        self.nullable = {name: getattr(self.field(name), 'null', True) for name, _ in self.keys}
+        self.nulls_largest = connections[queryset.db].features.nulls_order_largest
+
+    def field(self, name):
+        meta = self.queryset.model._meta
+        try:
+            return meta.pk if name == 'pk' else meta.get_field(name)
+        except FieldDoesNotExist:
+            # An annotation: its value went through JSON unchanged
+            return None
+
+    def encode(self, obj, backwards):
+        values = [to_json(getattr(obj, name)) for name, _ in self.keys]
+        return signing.dumps({'k': [name for name, _ in self.keys], 'v': values, 'b': backwards}, salt=SALT)
+
+    def decode(self, cursor):
+        """(values, backwards) for a cursor of this ordering, or None"""
+        try:
+            data = signing.loads(cursor, salt=SALT)
+            if data['k'] != [name for name, _ in self.keys] or len(data['v']) != len(self.keys):
+                return None
+            values = []
+            for (name, _), value in zip(self.keys, data['v']):
+                field = self.field(name)
+                values.append(value if field is None or value is None else field.to_python(value))
+            return values, bool(data['b'])
+        except (signing.BadSignature, KeyError, TypeError, ValueError, ValidationError):
+            return None
+
+    def query(self, position=None):
+        """The page after ``position`` (from decode()) plus one row, to tell whether there are more"""
+        backwards = bool(position and position[1])
+        keys = [(name, descending != backwards) for name, descending in self.keys]
+        rows = self.queryset.order_by(*(f'-{name}' if descending else name for name, descending in keys))
+        if position:
+            rows = rows.filter(keyset_filter(keys, position[0], self.nullable, self.nulls_largest))
+        return rows[:self.per_page + 1]
+
+    def page(self, cursor=None):
+        position = self.decode(cursor) if cursor else None
+        backwards = bool(position and position[1])
+        rows = list(self.query(position))
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+
+        if backwards:
+            rows.reverse()
+            has_next, has_previous = True, more
+        else:
+            has_next, has_previous = more, position is not None
+
+        return CursorPage(
+            rows,
+            next_cursor=self.encode(rows[-1], False) if rows and has_next else None,
+            previous_cursor=self.encode(rows[0], True) if rows and has_previous else None,
+        )
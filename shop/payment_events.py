@@ -0,0 +1,110 @@
+"""
+Push channel for payment outcomes.
+
+When a payment reaches a final state (M-Pesa callback, or the STK push
+being given up on) its status payload is published: handed straight to
+any waiter in this process and stored in the cache, where waiters check
+every PAYMENT_EVENTS_POLL_INTERVAL seconds. The checkout page listens on
+the payment_events Server-Sent Events stream, which reads the order once
+and then waits here, so a pending payment costs one DB lookup per
+keepalive instead of one per poll.
+
+An outcome applied in another process (process_callbacks,
+reconcile_payments, release_reservations, import_statement) reaches this
+one through the cache only if CACHES is shared between processes, so the
+stream also re-reads the payment from the database at every keepalive
+and before giving up (current_status).
+"""
+import asyncio
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Order
+
+EVENT_TTL = 60 * 10
+
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def event_key(order_id):
+    return f'payment_event:{order_id}'
+
+
+def status_payload(order, payment):
+    """The check_payment_status response for an order and its payment"""
+    return {
+        'success': True,
+        'status': payment.status,
+        'order_status': order.status,
+        'result_description': payment.result_description,
+        'mpesa_receipt': payment.mpesa_receipt_number,
+        'transaction_date': payment.transaction_date.strftime('%Y-%m-%d %H:%M:%S') if payment.transaction_date else None
+    }
+
+
+async def current_status(order_id):
+    """The status payload as stored in the database right now"""
+    order = await Order.objects.select_related('mpesa_payment').aget(pk=order_id)
+    return status_payload(order, order.mpesa_payment)
+
+
+class PaymentEvents:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = defaultdict(set)
+
+    def publish(self, order_id, payload):
+        cache.set(event_key(order_id), payload, EVENT_TTL)
+        with self._lock:
+            waiters = self._waiters.pop(order_id, ())
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._resolve, future, payload)
+
+    @staticmethod
+    def _resolve(future, payload):
+        if not future.done():
+            future.set_result(payload)
+
+    async def wait(self, order_id, timeout):
+        """The published payload for ``order_id``, or None after ``timeout`` seconds"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            self._waiters[order_id].add(waiter)
+
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                # Registered before checking, so a publish can't slip in between
+                payload = await cache.aget(event_key(order_id))
+                if payload is not None:
+                    return payload
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    return await asyncio.wait_for(
+                        asyncio.shield(future), min(remaining, settings.PAYMENT_EVENTS_POLL_INTERVAL)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(order_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[order_id]
+
+
+payment_events = PaymentEvents()
+
+
+def publish_payment(payment):
+    """Publish a payment's final state to waiting clients"""
+    payment_events.publish(payment.order_id, status_payload(payment.order, payment))
@@ -0,0 +1,193 @@
+"""
+Applying M-Pesa results to payments and orders.
+
+Safaricom retries STK callbacks, and a retry can arrive while the original
+is still being handled. Every change here runs in one transaction that
+first locks the payment row (select_for_update; on SQLite the IMMEDIATE
+transaction mode serializes writers instead) and only ever moves a payment
+out of 'pending', so a repeated callback finds the payment final and is a
+no-op. CheckoutRequestID and MpesaReceiptNumber are unique on MpesaPayment,
+so one M-Pesa transaction can't be recorded against two payments either.
+
+A push whose reply never reached us (StkPushJob 'unknown') has no
+CheckoutRequestID; its success callback is matched on phone number and
+amount instead, when exactly one such payment fits.
+"""
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import inventory
+from .models import MpesaPayment, StkPushJob
+from .payment_events import publish_payment
+
+logger = logging.getLogger(__name__)
+
+ACCEPTED = {'ResultCode': 0, 'ResultDesc': 'Accepted'}
+
+
+def lock_payment(**lookup):
+    """Fetch and lock a payment; call inside transaction.atomic()"""
+    return MpesaPayment.objects.select_for_update().select_related('order').get(**lookup)
+
+
+def release_order(payment, result_desc):
+    """Fail a pending payment, cancel its order and put the stock back"""
+    order = payment.order
+    inventory.release_order_stock(order)
+    # Don't prompt the customer for an order that no longer exists
+    StkPushJob.objects.filter(payment=payment, status='queued').update(
+        status='failed', last_error=result_desc, updated_at=timezone.now()
+    )
+
+    order.status = 'cancelled'
+    order.save()
+    payment.status = 'failed'
+    payment.result_description = result_desc
+    payment.save()
+    transaction.on_commit(lambda: publish_payment(payment))
+
+
+def callback_metadata(stk_callback):
+    items = stk_callback.get('CallbackMetadata', {}).get('Item', [])
+    return {item.get('Name'): item.get('Value') for item in items}
+
+
+def complete_payment(payment, receipt, transaction_date=None, amount=None):
+    """
+    Complete a locked pending payment: the order moves to processing, its
+    reserved stock is sold and an STK push still queued for it is dropped.
+    Returns False, changing nothing, if the receipt is already recorded on
+    another payment.
+    """
+    if receipt and MpesaPayment.objects.filter(mpesa_receipt_number=receipt).exclude(pk=payment.pk).exists():
+        logger.error(f"Receipt {receipt} is already recorded on another payment; not completing order {payment.order_id}")
+        return False
+
+    payment.mpesa_receipt_number = receipt
+    if transaction_date:
+        payment.transaction_date = transaction_date
+    if amount is not None and float(amount) != float(payment.amount):
+        # Verify amount matches
+        logger.warning(
+            f"Amount mismatch for order {payment.order_id}: "
+            f"Expected {payment.amount}, got {amount}"
+        )
+
+    payment.status = 'completed'
+    payment.order.status = 'processing'
+    payment.order.save()
+    inventory.consume(payment.order)
+    # Paid before the push went out (e.g. straight to the Paybill): don't prompt
+    StkPushJob.objects.filter(payment=payment, status='queued').delete()
+    payment.save()
+    transaction.on_commit(lambda: publish_payment(payment))
+
+    logger.info(
+        f"Payment completed for order {payment.order_id}. "
+        f"Receipt: {payment.mpesa_receipt_number}"
+    )
+    return True
+
+
+def complete_from_callback(payment, stk_callback):
+    """complete_payment() with a success callback's metadata; returns its result"""
+    metadata = callback_metadata(stk_callback)
+    transaction_date = None
+    if metadata.get('TransactionDate'):
+        transaction_date = datetime.strptime(str(metadata['TransactionDate']), '%Y%m%d%H%M%S')
+    return complete_payment(payment, metadata.get('MpesaReceiptNumber'), transaction_date, metadata.get('Amount'))
+
+
+def find_unanswered_payment(stk_callback):
+    """Lock the one pending payment with an unknown push that a success callback fits, or None"""
+    metadata = callback_metadata(stk_callback)
+    if stk_callback.get('ResultCode') != 0 or not metadata.get('PhoneNumber'):
+        return None
+    try:
+        amount = Decimal(str(metadata['Amount']))
+    except (KeyError, InvalidOperation):
+        return None
+
+    candidates = list(
+        MpesaPayment.objects.select_for_update().select_related('order').filter(
+            status='pending', checkout_request_id__isnull=True, stk_job__status='unknown',
+            phone_number=str(metadata['PhoneNumber']), amount=amount,
+        )[:2]
+    )
+    if len(candidates) != 1:
+        return None
+    payment = candidates[0]
+    payment.checkout_request_id = stk_callback.get('CheckoutRequestID')
+    payment.merchant_request_id = stk_callback.get('MerchantRequestID')
+    logger.warning(f"Matched callback {payment.checkout_request_id} to unanswered STK push for order {payment.order_id}")
+    return payment
+
+
+def apply_stk_callback(stk_callback):
+    """Record an STK callback on its payment and order; returns the reply for Daraja"""
+    checkout_request_id = stk_callback.get('CheckoutRequestID')
+    result_code = stk_callback.get('ResultCode')
+    result_desc = stk_callback.get('ResultDesc')
+
+    with transaction.atomic():
+        try:
+            payment = lock_payment(checkout_request_id=checkout_request_id)
+        except MpesaPayment.DoesNotExist:
+            payment = find_unanswered_payment(stk_callback)
+            if payment is None:
+                logger.error(f"Payment not found for CheckoutRequestID: {checkout_request_id}")
+                return {'ResultCode': 1, 'ResultDesc': 'Payment not found'}
+
+        if payment.status != 'pending':
+            if result_code == 0 and payment.status == 'failed':
+                # e.g. paid after the order's reservation expired
+                logger.error(
+                    f"Payment for cancelled order {payment.order_id} succeeded ({checkout_request_id}); "
+                    f"needs a refund or manual fulfilment"
+                )
+            else:
+                # A retried callback, or one that lost the race to its duplicate
+                logger.info(f"Ignoring callback for {checkout_request_id}: payment already {payment.status}")
+            return ACCEPTED
+
+        payment.result_code = str(result_code)
+        if result_code == 0:
+            payment.result_description = result_desc
+            if not complete_from_callback(payment, stk_callback):
+                # Keep the payment pending, but record the conflict on it for review
+                receipt = callback_metadata(stk_callback).get('MpesaReceiptNumber')
+                payment.result_description = f"{result_desc} (receipt {receipt} is recorded on another payment)"
+                payment.save()
+                logger.error(
+                    f"Callback {checkout_request_id} for order {payment.order_id} carries receipt {receipt}, "
+                    f"already recorded on another payment; left pending for review"
+                )
+        else:
+            # Payment failed or cancelled
+            release_order(payment, result_desc)
+            logger.warning(
+                f"Payment failed for order {payment.order_id}. "
+                f"Result: {result_desc}"
+            )
+
+    return ACCEPTED
+
+
+def expire_reservations(limit):
+    """Release up to ``limit`` orders' expired reservations; returns how many orders"""
+    order_ids = inventory.expired_orders(limit)
+    for order_id in order_ids:
+        with transaction.atomic():
+            payment = lock_payment(order_id=order_id)
+            if payment.status == 'pending':
+                release_order(payment, 'Payment not received in time')
+                logger.warning(f"Reservation for order {order_id} expired; order cancelled")
+            elif payment.status == 'completed':
+                inventory.consume(payment.order)
+            else:
+                inventory.release_order_stock(payment.order)
+    return len(order_ids)
@@ -0,0 +1,50 @@
+"""
+Cart pricing.
+
+A line costs quantity * (product price + variant price adjustment).
+cart_totals() works that out for a whole cart either from items already
+prefetched on it (no queries) or with one aggregate query, so
+Cart.total_amount/total_items no longer load every item, product and
+variant on each access. Cart caches the result for the life of the
+instance, i.e. the request.
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F, Prefetch, Sum, Value
+from django.db.models.functions import Coalesce
+
+PRICE_FIELD = DecimalField(max_digits=12, decimal_places=2)
+
+
+@dataclass(frozen=True)
+class CartTotals:
+    total_amount: Decimal
+    total_items: int
+
+
+def line_subtotal():
+    """SQL for a CartItem's subtotal"""
+    unit_price = F('product__price') + Coalesce(F('variant__price_adjustment'), Value(Decimal('0')), output_field=PRICE_FIELD)
+    return ExpressionWrapper(F('quantity') * unit_price, output_field=PRICE_FIELD)
+
+
+def priced_items():
+    """Prefetch for Cart.items that makes the cart page and totals query-free"""
+    from .models import CartItem
+    return Prefetch('items', queryset=CartItem.objects.select_related('product', 'variant'))
+
+
+def cart_totals(cart):
+    prefetched = getattr(cart, '_prefetched_objects_cache', {}).get('items')
+    if prefetched is not None:
+        return CartTotals(
+            total_amount=sum((item.subtotal for item in prefetched), Decimal('0')),
+            total_items=sum(item.quantity for item in prefetched),
+        )
+
+    totals = cart.items.aggregate(total_amount=Sum(line_subtotal()), total_items=Sum('quantity'))
+    return CartTotals(
+        total_amount=totals['total_amount'] or Decimal('0'),
+        total_items=totals['total_items'] or 0,
+    )
@@ -0,0 +1,130 @@
+"""
+Denormalized rating aggregates on Product.
+
+Every approved review contributes one star to ``Product.rating_<n>_count``.
+``rating_count`` and ``rating_avg`` are derived from those per-star columns,
+so the listing filters and sorts can run as plain indexed SQL instead of
+aggregating the reviews table for each product.
+
+``ReviewSummary`` is the read side: the detail page, listing cards and the
+related-products strip all render ratings from one immutable summary.
+"""
+from dataclasses import dataclass
+
+from django.db.models import Count, F, FloatField, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from .models import Product, Review
+
+STARS = range(1, 6)
+
+
+def star_field(star):
+    return f'rating_{star}_count'
+
+
+@dataclass(frozen=True)
+class ReviewSummary:
+    """Histogram, mean and total of a product's approved reviews"""
+    average: float = 0.0
+    total: int = 0
+    histogram: tuple = (0, 0, 0, 0, 0)  # counts for 1..5 stars
+
+    @classmethod
+    def from_product(cls, product):
+        """Build the summary from the denormalized columns, without a query"""
+        return cls(
+            average=product.rating_avg or 0.0,
+            total=product.rating_count or 0,
+            histogram=tuple(getattr(product, star_field(s)) or 0 for s in STARS),
+        )
+
+    @property
+    def rounded_average(self):
+        return round(self.average, 1) if self.average else 0
+
+    def count(self, star):
+        return self.histogram[star - 1]
+
+    def percentage(self, star):
+        return self.count(star) / self.total * 100 if self.total else 0
+
+    @property
+    def breakdown(self):
+        """Rows for the star histogram, highest star first"""
+        return tuple(
+            {'star': s, 'count': self.count(s), 'percentage': self.percentage(s)}
+            for s in reversed(STARS)
+        )
+
+
+def apply_rating_delta(product_id, star, delta):
+    """
+    Add ``delta`` (+1 / -1) reviews of ``star`` to a product's aggregates.
+
+    Runs as a single UPDATE built from F() expressions so concurrent review
+    writes never clobber each other. The average is computed from the
+    pre-update column values plus the delta, since SQL evaluates every SET
+    expression against the old row.
+    """
+    weighted_sum = sum(F(star_field(s)) * s for s in STARS) + Value(star * delta)
+    new_count = F('rating_count') + delta
+
+    # Division by zero yields NULL, which covers the last review going away.
+    average = Coalesce(
+        Cast(weighted_sum, FloatField()) / NullIf(Cast(new_count, FloatField()), Value(0.0)),
+        Value(0.0),
+    )
+
+    Product.objects.filter(pk=product_id).update(**{
+        star_field(star): F(star_field(star)) + delta,
+        'rating_count': new_count,
+        'rating_avg': average,
+    })
+
+
+def rebuild_rating_aggregates(batch_size=500):
+    """
+    Recompute every product's rating aggregates from the reviews table.
+
+    Uses one grouped query over approved reviews and bulk updates the
+    products in batches. Returns the number of products that changed.
+    """
+    histogram = {}
+    rows = (
+        Review.objects.filter(is_approved=True)
+        .values('product_id', 'rating')
+        .annotate(total=Count('id'))
+        .order_by()
+    )
+    for row in rows:
+        histogram.setdefault(row['product_id'], {})[row['rating']] = row['total']
+
+    fields = ['rating_avg', 'rating_count'] + [star_field(s) for s in STARS]
+    changed = []
+    updated = 0
+
+    for product in Product.objects.only('id', *fields).order_by('pk').iterator(chunk_size=batch_size):
+        counts = histogram.get(product.id, {})
+        values = {star_field(s): counts.get(s, 0) for s in STARS}
+        values['rating_count'] = sum(counts.values())
+        values['rating_avg'] = (
+            sum(s * n for s, n in counts.items()) / values['rating_count']
+            if values['rating_count'] else 0
+        )
+
+        if any(getattr(product, name) != value for name, value in values.items()):
+            for name, value in values.items():
+                setattr(product, name, value)
+            changed.append(product)
+
+        if len(changed) >= batch_size:
+            Product.objects.bulk_update(changed, fields)
+            updated += len(changed)
+            changed = []
+
+    if changed:
+        Product.objects.bulk_update(changed, fields)
+        updated += len(changed)
+
+    return updated
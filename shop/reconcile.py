@@ -0,0 +1,96 @@
+"""
+Reconciliation of payments whose callback never arrived.
+
+Payments still pending RECONCILE_AFTER seconds after checkout are looked
+up with Daraja's STK Push Query API, oldest first, from a bounded pool of
+threads sharing one rate limit. A final answer is applied exactly like
+the callback would have been (payments.apply_stk_callback), so a callback
+that turns up later is a harmless duplicate. Payments Daraja is still
+processing are left for the next pass.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import MpesaPayment
+from .mpesa import query_stk_push
+from .payments import apply_stk_callback
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart, across threads"""
+
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.interval = 1 / rate if rate else 0
+        self.clock = clock
+        self.sleep = sleep
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = self.clock()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            self.sleep(slot - now)
+
+
+def stale_payments(limit, older_than=None):
+    cutoff = timezone.now() - timedelta(seconds=settings.RECONCILE_AFTER if older_than is None else older_than)
+    return list(
+        MpesaPayment.objects.filter(status='pending', created_at__lte=cutoff, checkout_request_id__isnull=False)
+        .order_by('created_at')[:limit]
+    )
+
+
+def reconcile_payment(payment):
+    """Query one payment and apply a final result; returns 'completed', 'failed' or 'pending'"""
+    result = query_stk_push(payment.checkout_request_id)
+    try:
+        result_code = int(result['ResultCode'])
+    except (KeyError, TypeError, ValueError):
+        logger.info(f"Payment for order {payment.order_id} not settled yet: {result.get('errorMessage')}")
+        return 'pending'
+
+    apply_stk_callback({
+        'CheckoutRequestID': payment.checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': result.get('ResultDesc'),
+    })
+    logger.info(f"Reconciled payment for order {payment.order_id}: {result.get('ResultDesc')}")
+    return 'completed' if result_code == 0 else 'failed'
+
+
+def reconcile(limit, workers, rate, older_than=None):
+    """Reconcile up to ``limit`` stale payments; returns a Counter of outcomes"""
+    limiter = RateLimiter(rate)
+
+    def run(payment):
+        limiter.wait()
+        try:
+            return reconcile_payment(payment)
+        except Exception as e:
+            logger.error(f"Reconciling payment for order {payment.order_id} failed: {str(e)}")
+            return 'error'
+
+    def run_in_thread(payment):
+        try:
+            return run(payment)
+        finally:
+            close_old_connections()
+
+    payments = stale_payments(limit, older_than)
+    if workers == 1:
+        return Counter(map(run, payments))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return Counter(pool.map(run_in_thread, payments))
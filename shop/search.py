@@ -0,0 +1,187 @@
+"""
+Product search engine.
+
+Replaces the ``icontains`` scans over name/description/category/brand with
+a real full-text index:
+
+* SQLite: an FTS5 table (``shop_product_fts``) keyed by product id,
+  joined through the unmanaged ProductSearchIndex model and ranked with
+  bm25().
+* PostgreSQL: ``to_tsvector`` over the same columns, backed by a GIN
+  expression index and ranked with ``ts_rank``.
+* Anything else falls back to the old ``icontains`` lookups.
+
+Every search term is prefix-matched, so "sams gal" finds "Samsung Galaxy".
+The index is kept in sync with Product, Category and Brand saves by
+signals (see shop/signals.py).
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q, Value
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+FTS_TABLE = 'shop_product_fts'
+
+# Column weights for name, description, category and brand
+FTS_WEIGHTS = (10.0, 1.0, 3.0, 5.0)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+class SearchBackend:
+    """
+    Index maintenance hooks are no-ops unless the backend keeps its own
+    index table.
+    """
+
+    def index_products(self, product_ids):
+        pass
+
+    def index_category(self, category_id):
+        pass
+
+    def index_brand(self, brand_id):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def filter(self, queryset, query):
+        raise NotImplementedError
+
+
+class SQLiteSearchBackend(SearchBackend):
+
+    def reindex(self, where='', params=()):
+        """(Re)index the products matching a SQL condition on ``p``"""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT p.id FROM shop_product p {where})",
+                params,
+            )
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, description, category, brand) "
+                "SELECT p.id, p.name, p.description, c.name, COALESCE(b.name, '') "
+                "FROM shop_product p "
+                "JOIN shop_category c ON c.id = p.category_id "
+                f"LEFT JOIN shop_brand b ON b.id = p.brand_id {where}",
+                params,
+            )
+
+    def index_products(self, product_ids):
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        self.reindex(f'WHERE p.id IN ({placeholders})', list(product_ids))
+
+    def index_category(self, category_id):
+        self.reindex('WHERE p.category_id = %s', [category_id])
+
+    def index_brand(self, brand_id):
+        if brand_id is None:
+            self.reindex('WHERE p.brand_id IS NULL')
+        else:
+            self.reindex('WHERE p.brand_id = %s', [brand_id])
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [product_id])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        self.reindex()
+
+    def filter(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.annotate(search_rank=Value(0.0)).none()
+
+        match = ' '.join(f'"{term}"*' for term in terms)
+        weights = ', '.join(str(w) for w in FTS_WEIGHTS)
+        # Join the FTS table (ProductSearchIndex) rather than ranking in a
+        # correlated subquery, so MATCH runs once per query instead of once
+        # per candidate row. bm25() takes the joined table's name, which is
+        # its alias as long as it is joined once. It is lower-is-better;
+        # negate so higher search_rank is more relevant.
+        return queryset.filter(search_index__document__match=match).annotate(
+            search_rank=RawSQL(f'-bm25({FTS_TABLE}, {weights})', ())
+        )
+
+
+class PostgresSearchBackend(SearchBackend):
+    # Must match the expression of the GIN index created in migration 0006.
+    # The index is maintained by PostgreSQL itself, and category and brand
+    # names are matched live.
+    DOCUMENT = (
+        "setweight(to_tsvector('simple', coalesce({p}.name, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce({p}.description, '')), 'C')"
+    )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("REINDEX INDEX shop_product_search_gin")
+
+    def filter(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.annotate(search_rank=Value(0.0)).none()
+
+        tsquery = ' & '.join(f'{term}:*' for term in terms)
+        document = self.DOCUMENT.format(p=Product._meta.db_table)
+        # Category and brand names live in other tables, so match them
+        # separately and rank them below a name hit. As in the other
+        # backends, every term has to match somewhere.
+        for term in terms:
+            queryset = queryset.filter(
+                Q(id__in=RawSQL(
+                    f"SELECT id FROM {Product._meta.db_table} "
+                    f"WHERE ({document}) @@ to_tsquery('simple', %s)", [f'{term}:*']
+                )) |
+                Q(category__name__istartswith=term) |
+                Q(brand__name__istartswith=term)
+            )
+
+        rank = RawSQL(f"ts_rank(({document}), to_tsquery('simple', %s))", [tsquery])
+        return queryset.annotate(search_rank=rank)
+
+
+class FallbackSearchBackend(SearchBackend):
+
+    def filter(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return queryset.annotate(search_rank=Value(0.0)).none()
+
+        for term in terms:
+            queryset = queryset.filter(
+                Q(name__icontains=term) |
+                Q(description__icontains=term) |
+                Q(category__name__icontains=term) |
+                Q(brand__name__icontains=term)
+            )
+        return queryset.annotate(search_rank=Value(0.0))
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_backend(vendor=None):
+    return BACKENDS.get(vendor or connection.vendor, FallbackSearchBackend)()
+
+
+def apply_search(queryset, query):
+    """Restrict a Product queryset to matches for ``query``, annotated with ``search_rank``"""
+    return get_backend().filter(queryset, query)
+
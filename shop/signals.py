@@ -0,0 +1,116 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import autocomplete, cache, page_cache
+from .models import Brand, CartItem, Category, Product, Review
+from .ratings import apply_rating_delta
+from .search import get_backend
+
+
+@receiver(pre_save, sender=Review)
+def capture_review_rating_state(sender, instance, **kwargs):
+    """Load the stored contribution for reviews that weren't fetched via the ORM"""
+    if instance._state.adding or hasattr(instance, '_rating_state'):
+        return
+    previous = Review.objects.filter(pk=instance.pk).first()
+    instance._rating_state = previous.rating_contribution if previous else None
+
+
+@receiver(post_save, sender=Review)
+def update_rating_aggregates_on_save(sender, instance, created, **kwargs):
+    """Keep Product rating aggregates in sync when a review is created, edited or (un)approved"""
+    old = None if created else getattr(instance, '_rating_state', None)
+    new = instance.rating_contribution
+
+    if old != new:
+        if old:
+            apply_rating_delta(old[0], old[1], -1)
+        if new:
+            apply_rating_delta(new[0], new[1], 1)
+        invalidate_review_pages()
+
+    instance._rating_state = new
+
+
+@receiver(post_delete, sender=Review)
+def update_rating_aggregates_on_delete(sender, instance, **kwargs):
+    contribution = getattr(instance, '_rating_state', instance.rating_contribution)
+    if contribution:
+        apply_rating_delta(contribution[0], contribution[1], -1)
+        invalidate_review_pages()
+
+
+def invalidate_review_pages():
+    # Ratings on product cards come from aggregates updated without a Product save
+    transaction.on_commit(lambda: page_cache.invalidate(page_cache.REVIEWS))
+
+
+@receiver(post_save, sender=Product)
+def index_product_for_search(sender, instance, **kwargs):
+    get_backend().index_products([instance.pk])
+    transaction.on_commit(lambda: autocomplete.product_changed(instance))
+
+
+@receiver(post_delete, sender=Product)
+def remove_product_from_search(sender, instance, **kwargs):
+    pk = instance.pk
+    get_backend().remove_product(pk)
+    transaction.on_commit(lambda: autocomplete.product_removed(pk))
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, **kwargs):
+    if not created:
+        get_backend().index_category(instance.pk)
+    transaction.on_commit(lambda: autocomplete.group_changed('category', instance))
+
+
+@receiver(post_save, sender=Brand)
+def reindex_brand_products(sender, instance, created, **kwargs):
+    if not created:
+        get_backend().index_brand(instance.pk)
+    transaction.on_commit(lambda: autocomplete.group_changed('brand', instance))
+
+
+@receiver(post_delete, sender=Category)
+def remove_category_from_autocomplete(sender, instance, **kwargs):
+    pk = instance.pk
+    transaction.on_commit(lambda: autocomplete.group_removed('category', pk))
+
+
+@receiver(post_delete, sender=Brand)
+def reindex_unbranded_products(sender, instance, **kwargs):
+    # Products were moved to brand=NULL by an UPDATE that sends no signals
+    get_backend().index_brand(None)
+    pk = instance.pk
+    transaction.on_commit(lambda: autocomplete.group_removed('brand', pk))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_tree(sender, **kwargs):
+    transaction.on_commit(cache.invalidate_category_tree)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_pages(sender, **kwargs):
+    transaction.on_commit(lambda: page_cache.invalidate(page_cache.PRODUCTS))
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+def invalidate_brand_pages(sender, **kwargs):
+    transaction.on_commit(lambda: page_cache.invalidate(page_cache.BRANDS))
+
+
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def invalidate_cart_count(sender, instance, **kwargs):
+    # Items loaded through cart.items already have their cart cached. Drop
+    # the count now for this request and again on commit, in case a
+    # concurrent request re-cached the old value in between.
+    user_id = instance.cart.user_id
+    cache.invalidate_cart_count(user_id)
+    transaction.on_commit(lambda: cache.invalidate_cart_count(user_id))
@@ -0,0 +1,296 @@
+"""
+Matching M-Pesa Paybill statements against payments.
+
+Customers sometimes pay the Paybill directly (business number + account
+number) instead of answering the STK prompt, so no callback ever links
+the money to an order. import_statement streams an M-Pesa statement export
+(CSV, or XLSX with openpyxl installed) row by row and matches each
+paid-in row:
+
+* by receipt number against payments that already have one (only the
+  amount is checked), then
+* by account reference and amount against payments still waiting for
+  their money.
+
+Rows are handled in chunks of ``batch_size``. Payments without a receipt,
+pending or failed (cancelled orders), are held in memory by account (the
+account index, built once per run); recorded receipts are looked up with
+one query per chunk, so memory doesn't grow with the statement or with
+completed payments. Duplicate receipts are caught
+within a chunk and against the receipts this run matched. Matches complete
+their payment through payments.complete_payment, the same path as an STK
+callback, each in its own savepoint. Every row that didn't simply match is
+written to the discrepancy report as it is found.
+"""
+import csv
+import logging
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import MpesaPayment
+from .payments import complete_payment, lock_payment
+
+logger = logging.getLogger(__name__)
+
+RECEIPT = 'receipt no.'
+COMPLETED_AT = 'completion time'
+STATUS = 'transaction status'
+PAID_IN = 'paid in'
+ACCOUNT = 'a/c no.'
+
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M')
+
+REPORT_FIELDS = ['kind', 'receipt', 'account', 'amount', 'expected_amount', 'payment_id', 'order_id', 'detail']
+
+
+class StatementError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class StatementRow:
+    receipt: str
+    account: str
+    amount: Decimal
+    # Raw cell; only matched rows pay for parse_time()
+    completed_at: object
+
+
+def normalize_account(value):
+    return ''.join(str(value or '').split()).upper()
+
+
+def parse_amount(value):
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    try:
+        return Decimal(str(value or '').replace(',', '').strip() or '0')
+    except InvalidOperation:
+        return Decimal('0')
+
+
+def parse_time(value):
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        for fmt in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(str(value).strip(), fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            return None
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def csv_records(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        yield from csv.reader(f)
+
+
+def xlsx_records(path):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise StatementError('Reading XLSX statements requires openpyxl (pip install openpyxl)')
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def read_statement(path):
+    """Completed paid-in rows of a statement export, one at a time"""
+    records = xlsx_records(path) if Path(path).suffix.lower() == '.xlsx' else csv_records(path)
+
+    # Exports start with a few lines of account details before the header
+    for record in records:
+        header = [str(cell or '').strip().lower() for cell in record]
+        if RECEIPT in header:
+            break
+    else:
+        raise StatementError(f'No "Receipt No." header row found in {path}')
+
+    missing = {RECEIPT, PAID_IN, ACCOUNT} - set(header)
+    if missing:
+        raise StatementError(f'Statement is missing columns: {", ".join(sorted(missing))}')
+    column = {name: header.index(name) for name in (RECEIPT, COMPLETED_AT, STATUS, PAID_IN, ACCOUNT) if name in header}
+
+    for record in records:
+        values = {name: record[i] if i < len(record) else None for name, i in column.items()}
+        receipt = str(values[RECEIPT] or '').strip()
+        amount = parse_amount(values[PAID_IN])
+        if not receipt or amount <= 0:
+            continue
+        if STATUS in values and str(values[STATUS] or '').strip().lower() != 'completed':
+            continue
+        yield StatementRow(
+            receipt=receipt,
+            account=normalize_account(values[ACCOUNT]),
+            amount=amount,
+            completed_at=values.get(COMPLETED_AT),
+        )
+
+
+@dataclass
+class OpenPayment:
+    id: int
+    order_id: int
+    amount: Decimal
+    status: str
+
+
+class PaymentIndex:
+    """Pending and failed payments without a receipt, by normalized account reference"""
+
+    def __init__(self):
+        self.pending = defaultdict(list)
+        self.cancelled = defaultdict(list)
+        for pk, order_id, amount, status, account in MpesaPayment.objects.filter(
+            mpesa_receipt_number__isnull=True, status__in=['pending', 'failed']
+        ).order_by('created_at').values_list('pk', 'order_id', 'amount', 'status', 'account_number').iterator():
+            by_account = self.pending if status == 'pending' else self.cancelled
+            by_account[normalize_account(account)].append(OpenPayment(pk, order_id, amount, status))
+
+    def take(self, row):
+        """
+        The payment for ``row``'s account and amount, pending first, then
+        cancelled (taken out of the index), and all candidates left
+        """
+        pending = self.pending.get(row.account, [])
+        cancelled = self.cancelled.get(row.account, [])
+        for pool in (pending, cancelled):
+            for payment in pool:
+                if payment.amount == row.amount:
+                    pool.remove(payment)
+                    return payment, pending + cancelled
+        return None, pending + cancelled
+
+
+def recorded_receipts(receipts):
+    """Payments already holding one of ``receipts``, by receipt"""
+    return {
+        receipt: OpenPayment(pk, order_id, amount, status)
+        for pk, order_id, amount, status, receipt in MpesaPayment.objects.filter(
+            mpesa_receipt_number__in=receipts
+        ).values_list('pk', 'order_id', 'amount', 'status', 'mpesa_receipt_number')
+    }
+
+
+class StatementImport:
+    """
+    Match statement rows and apply matches to pending payments in batches.
+    ``report`` is a csv.DictWriter (REPORT_FIELDS), or None.
+    """
+
+    def __init__(self, report=None, batch_size=1000, dry_run=False):
+        self.report = report
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.counts = Counter()
+        self.index = PaymentIndex()
+        # Receipts this run matched: at most one per payment, so bounded like the index
+        self.matched = set()
+
+    def run(self, rows):
+        chunk = []
+        for row in rows:
+            self.counts['rows'] += 1
+            chunk.append(row)
+            if len(chunk) >= self.batch_size:
+                self.process(chunk)
+                chunk = []
+        self.process(chunk)
+        return self.counts
+
+    def discrepancy(self, kind, row, payment=None, detail=''):
+        self.counts[kind] += 1
+        if self.report:
+            self.report.writerow({
+                'kind': kind,
+                'receipt': row.receipt,
+                'account': row.account,
+                'amount': row.amount,
+                'expected_amount': payment.amount if payment else '',
+                'payment_id': payment.id if payment else '',
+                'order_id': payment.order_id if payment else '',
+                'detail': detail,
+            })
+
+    def process(self, chunk):
+        if not chunk:
+            return
+        known = recorded_receipts({row.receipt for row in chunk})
+        seen = set()
+        batch = []
+        for row in chunk:
+            if row.receipt in seen or row.receipt in self.matched:
+                self.discrepancy('duplicate', row, detail='Receipt appears more than once in the statement')
+                continue
+            seen.add(row.receipt)
+            match = self.match(row, known)
+            if match:
+                self.matched.add(row.receipt)
+                batch.append((match, row))
+        self.flush(batch)
+
+    def match(self, row, known):
+        """The pending payment ``row`` pays, or None after counting or reporting the row"""
+        recorded = known.get(row.receipt)
+        if recorded:
+            if recorded.amount != row.amount:
+                self.discrepancy('amount_mismatch', row, recorded, 'Recorded payment has a different amount')
+            else:
+                self.counts['already_recorded'] += 1
+            return None
+
+        payment, candidates = self.index.take(row)
+        if payment is None:
+            if candidates:
+                self.discrepancy('amount_mismatch', row, candidates[0], 'No payment for this account with this amount')
+            else:
+                self.discrepancy('unmatched', row, detail='No payment for this account reference')
+            return None
+        if payment.status != 'pending':
+            self.discrepancy('order_cancelled', row, payment, 'Paid after the order was cancelled')
+            return None
+        return payment
+
+    def flush(self, batch):
+        if not batch:
+            return
+        if self.dry_run:
+            self.counts['matched'] += len(batch)
+            return
+
+        matched = 0
+        with transaction.atomic():
+            for open_payment, row in batch:
+                try:
+                    # A savepoint per row: one bad row doesn't undo the batch
+                    with transaction.atomic():
+                        payment = lock_payment(pk=open_payment.id)
+                        if payment.status != 'pending':
+                            # Settled (callback, reconciliation) since the index was built
+                            self.discrepancy('settled_elsewhere', row, open_payment, 'Payment was settled while importing')
+                            continue
+                        payment.result_description = 'Matched from Paybill statement'
+                        if not complete_payment(payment, row.receipt, parse_time(row.completed_at), row.amount):
+                            self.discrepancy('receipt_conflict', row, open_payment, 'Receipt is recorded on another payment')
+                            continue
+                except IntegrityError as e:
+                    self.discrepancy('receipt_conflict', row, open_payment, f'Could not record receipt: {e}')
+                    continue
+                matched += 1
+        self.counts['matched'] += matched
+        logger.info(f"Statement import: {matched} payment(s) matched")
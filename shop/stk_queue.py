@@ -0,0 +1,156 @@
+"""
+Durable outbox for STK push requests.
+
+checkout creates an StkPushJob in the same transaction as the order and
+payment, so the request to Daraja (up to 60 seconds) happens outside the
+transaction. The async checkout view then sends its job straight away; the
+stk_worker command picks up everything else that is ready (retries, jobs
+from crashed requests). Sending either records the CheckoutRequestID,
+schedules a retry with exponential backoff, or fails the payment and
+cancels the order once the error is permanent or STK_PUSH_MAX_ATTEMPTS is
+reached.
+
+Only requests that never reached Daraja are retried. When Daraja may have
+accepted one (read timeout, 5xx, a worker that died mid-send) the job is
+marked 'unknown' and never sent again, since a second push would prompt
+the customer twice. Its payment stays pending: a success callback is
+matched to it by phone number and amount (payments.apply_stk_callback), a
+Paybill statement import by account reference, and otherwise the
+reservation expires and the order is cancelled.
+"""
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import StkPushJob
+from .mpesa import ainitiate_stk_push, initiate_stk_push
+from .payments import lock_payment, release_order
+
+logger = logging.getLogger(__name__)
+
+# A running job whose worker died is marked unknown after this long; it
+# must exceed the time one attempt can take (token fetch + two STK calls).
+STALE_AFTER = timedelta(minutes=5)
+STALE_ERROR = 'Worker stopped while sending; the payment request may have been sent'
+
+
+def enqueue(payment):
+    return StkPushJob.objects.create(payment=payment)
+
+
+def backoff(attempts):
+    return timedelta(seconds=settings.STK_PUSH_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def ready_jobs(now):
+    return Q(status='queued', run_after__lte=now)
+
+
+def expire_stale(now):
+    """Mark running jobs whose worker died as unknown; returns how many"""
+    return StkPushJob.objects.filter(status='running', locked_at__lt=now - STALE_AFTER).update(
+        status='unknown', last_error=STALE_ERROR, updated_at=now
+    )
+
+
+def claim(limit):
+    """
+    Mark up to ``limit`` ready jobs as running and return them. Each claim
+    is a conditional UPDATE, so concurrent workers never get the same job.
+    """
+    now = timezone.now()
+    if expire_stale(now):
+        logger.warning("STK jobs left running by a stopped worker marked unknown")
+    candidates = list(
+        StkPushJob.objects.filter(ready_jobs(now)).order_by('run_after').values_list('id', flat=True)[:limit]
+    )
+    claimed = [
+        pk for pk in candidates
+        if StkPushJob.objects.filter(ready_jobs(now), pk=pk).update(
+            status='running', locked_at=now, attempts=F('attempts') + 1, updated_at=now
+        )
+    ]
+    return list(StkPushJob.objects.filter(pk__in=claimed).select_related('payment__order'))
+
+
+def claim_job(pk):
+    """Claim one specific queued job (e.g. to send it straight from checkout)"""
+    now = timezone.now()
+    claimed = StkPushJob.objects.filter(pk=pk, status='queued').update(
+        status='running', locked_at=now, attempts=F('attempts') + 1, updated_at=now
+    )
+    return StkPushJob.objects.select_related('payment__order').get(pk=pk) if claimed else None
+
+
+def process(job):
+    """Send one claimed job; returns its new status"""
+    return record_result(job, initiate_stk_push(job.payment) or {})
+
+
+async def aprocess(job):
+    """process() for async callers; only the bookkeeping runs in a thread"""
+    result = await ainitiate_stk_push(job.payment) or {}
+    return await sync_to_async(record_result)(job, result)
+
+
+def record_result(job, result):
+    payment = job.payment
+    if result.get('ResponseCode') == '0':
+        with transaction.atomic():
+            payment.merchant_request_id = result.get('MerchantRequestID')
+            payment.checkout_request_id = result.get('CheckoutRequestID')
+            payment.save(update_fields=['merchant_request_id', 'checkout_request_id', 'updated_at'])
+            job.status = 'sent'
+            job.last_error = None
+            job.save(update_fields=['status', 'last_error', 'updated_at'])
+        logger.info(f"STK Push initiated for order {payment.order_id}")
+        return job.status
+
+    error_msg = result.get('errorMessage', 'Failed to initiate payment')
+    if result.get('unknown'):
+        mark_unknown(job, error_msg)
+    elif result.get('retryable') and job.attempts < settings.STK_PUSH_MAX_ATTEMPTS:
+        retry(job, error_msg)
+    else:
+        fail(job, error_msg)
+    return job.status
+
+
+def retry(job, error_msg):
+    job.status = 'queued'
+    job.run_after = timezone.now() + backoff(job.attempts)
+    job.last_error = error_msg
+    job.save(update_fields=['status', 'run_after', 'last_error', 'updated_at'])
+    logger.warning(
+        f"STK Push for order {job.payment.order_id} failed (attempt {job.attempts}), "
+        f"retrying at {job.run_after}: {error_msg}"
+    )
+
+
+def mark_unknown(job, error_msg):
+    """Daraja may have accepted the push: never send it again, leave the payment pending"""
+    job.status = 'unknown'
+    job.last_error = error_msg
+    job.save(update_fields=['status', 'last_error', 'updated_at'])
+    logger.warning(
+        f"STK Push for order {job.payment.order_id} has an unknown outcome; "
+        f"waiting for its callback: {error_msg}"
+    )
+
+
+def fail(job, error_msg):
+    """Give up: fail the payment, cancel the order and put the stock back"""
+    logger.error(f"STK Push failed: {error_msg}")
+    with transaction.atomic():
+        payment = lock_payment(pk=job.payment_id)
+        if payment.status == 'pending':
+            release_order(payment, error_msg)
+
+        job.status = 'failed'
+        job.last_error = error_msg
+        job.save(update_fields=['status', 'last_error', 'updated_at'])
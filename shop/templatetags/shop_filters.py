@@ -1,4 +1,5 @@
 from django import template
+from django.core.files.storage import default_storage
 
 register = template.Library()
 
@@ -22,3 +23,32 @@ def multiply(value, arg):
         return float(value) * float(arg)
     except (ValueError, TypeError):
         return 0
+
+
+@register.filter
+def media_url(path):
+    """
+    URL for a stored file path, e.g. an annotated image column
+    Example: {{ product.main_image|media_url }}
+    """
+    if not path:
+        return ''
+    return default_storage.url(path)
+
+
+@register.simple_tag
+def filter_query(query, **changes):
+    """
+    The query string with ``changes`` applied, for filter links. Paging
+    parameters are dropped, and a None or empty value removes a parameter.
+    Example: <a href="?{% filter_query request.GET brand=brand.id %}">
+    """
+    params = query.copy()
+    for key in ('cursor', 'page', 'partial'):
+        params.pop(key, None)
+    for key, value in changes.items():
+        if value is None or value == '':
+            params.pop(key, None)
+        else:
+            params[key] = str(value)
+    return params.urlencode()
@@ -1,3 +1,1526 @@
-from django.test import TestCase
+import asyncio
+import csv
+import os
+import re
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, close_old_connections, connection
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .context_processors import cart_processor, categories_processor
+from .daraja_stub import DarajaStub
+from .models import (
+    Brand, Cart, CartItem, Category, MpesaCallback, MpesaPayment, Order, OrderItem, Product, ProductImage,
+    ProductVariant, Review, StkPushJob, StockReservation, Wishlist,
+)
+from .mpesa import (
+    DarajaClient, TokenManager, async_client as async_daraja_client, client as daraja_client,
+    ainitiate_stk_push, initiate_stk_push, token_manager,
+)
+from . import callback_journal, inventory, page_cache, pricing, stk_queue
+from .autocomplete import MIN_REBUILD_INTERVAL, SCORE_REFRESH_INTERVAL, autocomplete, bump_version
+from .cache import bump_version as bump_shared_version, get_version
+from .payment_events import PaymentEvents, event_key
+from .pagination import CursorPaginator
+from .payments import ACCEPTED, apply_stk_callback, complete_payment
+from .ratings import ReviewSummary, rebuild_rating_aggregates
+from .reconcile import RateLimiter
+from .search import apply_search
+from .statements import StatementImport, read_statement
+from .view_counter import ViewCounterBuffer, view_counter
+
+
+def make_product(category, name='Widget', **kwargs):
+    kwargs.setdefault('price', Decimal('100.00'))
+    kwargs.setdefault('stock', 10)
+    kwargs.setdefault('slug', name.lower().replace(' ', '-'))
+    kwargs.setdefault('description', f'{name} description')
+    return Product.objects.create(category=category, name=name, **kwargs)
+
+
+class RatingAggregateTests(TestCase):
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Electronics', slug='electronics')
+        self.product = make_product(self.category)
+        self.users = [User.objects.create_user(f'user{i}', password='x') for i in range(3)]
+
+    def review(self, user, rating, **kwargs):
+        return Review.objects.create(product=self.product, user=user, rating=rating, comment='ok', **kwargs)
+
+    def test_create_approve_unapprove_delete(self):
+        first = self.review(self.users[0], 5)
+        self.review(self.users[1], 2)
+        pending = self.review(self.users[2], 4, is_approved=False)
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, 2)
+        self.assertEqual(self.product.average_rating, 3.5)
+        self.assertEqual(self.product.rating_4_count, 0)
+
+        pending.is_approved = True
+        pending.save()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_4_count), (3, 1))
+
+        first = Review.objects.get(pk=first.pk)
+        first.is_approved = False
+        first.save()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_5_count), (2, 0))
+        self.assertEqual(self.product.average_rating, 3.0)
+
+        Review.objects.filter(product=self.product).delete()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.rating_count, self.product.rating_avg), (0, 0))
+
+    def test_rebuild_matches_incremental(self):
+        self.review(self.users[0], 5)
+        self.review(self.users[1], 4)
+        Product.objects.update(rating_avg=0, rating_count=0, rating_4_count=0, rating_5_count=0)
+
+        self.assertEqual(rebuild_rating_aggregates(), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, 2)
+        self.assertEqual(self.product.average_rating, 4.5)
+
+    def test_product_list_rating_filter_runs_in_sql(self):
+        other = make_product(self.category, name='Gadget')
+        self.review(self.users[0], 5)
+        Review.objects.create(product=other, user=self.users[1], rating=2, comment='meh')
+
+        response = self.client.get('/products/', {'rating': 4, 'sort': 'rating'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p.pk for p in response.context['products']], [self.product.pk])
+
+    def test_review_summary_from_aggregates(self):
+        self.review(self.users[0], 5)
+        self.review(self.users[1], 5)
+        self.review(self.users[2], 3)
+        self.product.refresh_from_db()
+
+        with self.assertNumQueries(0):
+            summary = self.product.review_summary
+        self.assertEqual(summary, ReviewSummary(average=13 / 3, total=3, histogram=(0, 0, 1, 0, 2)))
+        self.assertEqual(summary.rounded_average, 4.3)
+        self.assertEqual(summary.breakdown[0], {'star': 5, 'count': 2, 'percentage': 2 / 3 * 100})
+
+    def test_product_detail_rating_breakdown(self):
+        self.review(self.users[0], 4)
+        self.addCleanup(view_counter.flush)
+        response = self.client.get(f'/product/{self.product.slug}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['review_summary'].total, 1)
+        self.assertContains(response, '<div class="rating-bar-fill" style="width: 100%"></div>', html=True)
+
+
+class ProductCardDataTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Phones', slug='phones')
+        self.user = User.objects.create_user('shopper', password='x')
+
+    def add_products(self, count):
+        start = Product.objects.count()
+        for i in range(start, start + count):
+            product = make_product(self.category, name=f'Phone {i}', compare_at_price=Decimal('150.00'))
+            ProductImage.objects.create(product=product, image=f'products/gallery/{i}.jpg')
+            Wishlist.objects.create(user=self.user, product=product)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_card_annotations(self):
+        self.add_products(1)
+        product = Product.objects.with_card_data(self.user).get()
+        self.assertTrue(product.in_wishlist)
+        self.assertEqual(product.main_image, 'products/gallery/0.jpg')
+        self.assertFalse(Product.objects.with_card_data(None).get().in_wishlist)
+
+    def test_grid_query_count_independent_of_page_size(self):
+        self.client.force_login(self.user)
+        for url in ['/products/', '/category/phones/', '/']:
+            self.add_products(2)
+            self.client.get(url)  # warm the context processor caches
+            small = self.count_queries(url)
+            self.add_products(22)
+            self.assertEqual(self.count_queries(url), small, url)
+
+
+@override_settings(VIEW_COUNT_FLUSH_INTERVAL=3600, VIEW_COUNT_MAX_PENDING=3)
+class ViewCounterTests(TestCase):
+
+    def setUp(self):
+        view_counter.flush()
+        self.product = make_product(Category.objects.create(name='Books', slug='books'))
+
+    def test_views_are_buffered_then_flushed_in_bulk(self):
+        for _ in range(2):
+            self.client.get(f'/product/{self.product.slug}/')
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.view_count, 0)
+        self.assertEqual(view_counter.pending(self.product.pk), 2)
+
+        # The third view reaches VIEW_COUNT_MAX_PENDING and triggers a flush
+        view_counter.record(self.product.pk)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.view_count, 3)
+        self.assertEqual(view_counter.pending(self.product.pk), 0)
+
+
+class ViewCounterFlusherTests(TransactionTestCase):
+
+    @override_settings(VIEW_COUNT_FLUSH_INTERVAL=0.1, VIEW_COUNT_MAX_PENDING=1000)
+    def test_buffered_views_are_written_without_further_traffic(self):
+        product = make_product(Category.objects.create(name='Books', slug='books'))
+        buffer = ViewCounterBuffer()
+        buffer.record(product.pk)
+
+        for _ in range(50):
+            product.refresh_from_db()
+            if product.view_count:
+                break
+            time.sleep(0.1)
+        self.assertEqual(product.view_count, 1)
+        self.assertEqual(buffer.pending(product.pk), 0)
+
+
+class ProductSearchTests(TestCase):
+
+    def setUp(self):
+        self.phones = Category.objects.create(name='Phones', slug='phones')
+        self.samsung = Brand.objects.create(name='Samsung')
+        self.galaxy = make_product(self.phones, name='Galaxy S23', brand=self.samsung)
+        self.case = make_product(
+            self.phones, name='Leather Case', description='Fits the Galaxy S23 perfectly'
+        )
+
+    def names(self, query, filters=None):
+        products = Product.objects.filter(is_active=True, **(filters or {}))
+        return [p.name for p in apply_search(products, query).order_by('-search_rank', '-sold_count', 'id')]
+
+    def test_prefix_match_ranks_name_above_description(self):
+        self.assertEqual(self.names('gal'), ['Galaxy S23', 'Leather Case'])
+        self.assertEqual(self.names('galaxy leather'), ['Leather Case'])
+        self.assertEqual(self.names('samsu'), ['Galaxy S23'])
+        self.assertEqual(self.names('   '), [])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.case.name = 'Silicone Cover'
+        self.case.save()
+        self.assertEqual(self.names('silic'), ['Silicone Cover'])
+
+        self.samsung.name = 'Sammy'
+        self.samsung.save()
+        self.assertEqual(self.names('sammy'), ['Galaxy S23'])
+
+        self.galaxy.delete()
+        self.assertEqual(self.names('gal'), ['Silicone Cover'])
+
+    def test_filters_and_inactive_products(self):
+        self.case.is_active = False
+        self.case.save()
+        self.assertEqual(self.names('gal'), ['Galaxy S23'])
+        self.assertEqual(self.names('gal', filters={'brand__isnull': True}), [])
+
+    def test_fts_table_is_joined_once(self):
+        plan = apply_search(Product.objects.all(), 'gal').order_by('-search_rank').explain()
+        self.assertEqual(plan.count('shop_product_fts'), 1, plan)
+        self.assertNotIn('CORRELATED', plan)
+
+    def test_product_list_search(self):
+        response = self.client.get('/products/', {'search': 'galax'})
+        self.assertEqual([p.name for p in response.context['products']], ['Galaxy S23', 'Leather Case'])
+
+
+class AutocompleteTests(TestCase):
+
+    def setUp(self):
+        self.phones = Category.objects.create(name='Phones', slug='phones')
+        self.galaxy = make_product(self.phones, name='Samsung Galaxy S23', sold_count=50)
+        self.tab = make_product(self.phones, name='Galaxy Tab', sold_count=5)
+        autocomplete.rebuild()
+
+    def names(self, query):
+        with self.assertNumQueries(0):
+            return [s['name'] for s in autocomplete.suggest(query)]
+
+    def test_prefix_lookup_ranked_by_popularity(self):
+        self.assertEqual(self.names('gal'), ['Samsung Galaxy S23', 'Galaxy Tab'])
+        self.assertEqual(self.names('tab gal'), ['Galaxy Tab'])
+        self.assertEqual(self.names('pho'), ['Phones'])
+        self.assertEqual(self.names('xyz'), [])
+
+    def test_incremental_updates_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            make_product(self.phones, name='Pixel 8')
+            self.tab.is_active = False
+            self.tab.save()
+            self.galaxy.delete()
+
+        self.assertEqual(self.names('pix'), ['Pixel 8'])
+        self.assertEqual(self.names('gal'), [])
+
+    def test_scores_refresh_on_a_timer(self):
+        Product.objects.filter(pk=self.tab.pk).update(sold_count=500)
+        autocomplete.ensure_current()
+        self.assertEqual(self.names('gal'), ['Samsung Galaxy S23', 'Galaxy Tab'])
+
+        autocomplete._built_at -= SCORE_REFRESH_INTERVAL
+        autocomplete.ensure_current()
+        self.assertEqual(self.names('gal'), ['Galaxy Tab', 'Samsung Galaxy S23'])
+
+    def test_bump_by_another_process_is_not_missed(self):
+        bump_version()
+        version = autocomplete._version
+        self.assertEqual(version, get_version('autocomplete'))
+
+        bump_shared_version('autocomplete')  # another process
+        bump_version()
+        self.assertEqual(autocomplete._version, version)
+        autocomplete._built_at -= MIN_REBUILD_INTERVAL
+        self.assertTrue(autocomplete.is_stale())
+
+    def test_endpoint(self):
+        response = self.client.get('/api/search-suggestions/', {'q': 'sams'})
+        self.assertEqual(response.json()['suggestions'], [{
+            'id': self.galaxy.id, 'name': 'Samsung Galaxy S23', 'type': 'product', 'slug': self.galaxy.slug,
+        }])
+
+
+class ContextProcessorCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Toys', slug='toys')
+        self.product = make_product(self.category)
+        self.user = User.objects.create_user('buyer', password='x')
+
+    def request(self, user):
+        return type('Request', (), {'user': user})()
+
+    def test_anonymous_render_is_query_free(self):
+        categories_processor(self.request(AnonymousUser()))
+        with self.assertNumQueries(0):
+            context = {
+                **cart_processor(self.request(AnonymousUser())),
+                **categories_processor(self.request(AnonymousUser())),
+            }
+        self.assertEqual(context['cart_count'], 0)
+        self.assertEqual([c.name for c in context['all_categories']], ['Toys'])
+
+    def test_category_tree_invalidated_on_save(self):
+        categories_processor(self.request(AnonymousUser()))
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.create(name='Games', slug='games')
+        names = [c.name for c in categories_processor(self.request(AnonymousUser()))['all_categories']]
+        self.assertEqual(names, ['Games', 'Toys'])
+
+    def test_cart_count_cached_and_updated_by_cart_views(self):
+        self.client.force_login(self.user)
+        response = self.client.post(
+            '/cart/add/', {'product_id': self.product.id, 'quantity': 2}, content_type='application/json'
+        )
+        self.assertEqual(response.json()['cart_total'], 2)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(cart_processor(self.request(self.user))['cart_count'], 2)
+
+        item = CartItem.objects.get()
+        response = self.client.post(f'/cart/remove/{item.id}/')
+        self.assertEqual(response.json()['cart_count'], 0)
+        self.assertEqual(cart_processor(self.request(self.user))['cart_count'], 0)
+
+
+class CatalogPageCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Audio', slug='audio')
+        self.product = make_product(self.category, name='Studio Headphones')
+        self.user = User.objects.create_user('listener', password='x')
+
+    def test_anonymous_pages_served_from_cache(self):
+        first = self.client.get('/products/?sort=price_low&category=audio&page=')
+        with self.assertNumQueries(0):
+            second = self.client.get('/products/?category=audio&sort=price_low')
+        self.assertEqual(first.content, second.content)
+        self.assertIn('Cookie', second['Vary'])
+
+    def test_tagged_changes_invalidate(self):
+        self.client.get('/products/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Review.objects.create(product=self.product, user=self.user, rating=5, comment='Great')
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/products/')
+        self.assertGreater(len(ctx.captured_queries), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Studio Monitors'
+            self.product.save()
+        self.assertContains(self.client.get('/products/'), 'Studio Monitors')
+
+    def test_helpful_votes_keep_cached_pages(self):
+        review = Review.objects.create(product=self.product, user=self.user, rating=5, comment='Great')
+        self.client.force_login(self.user)
+        with mock.patch.object(page_cache, 'invalidate') as invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                data = self.client.post(f'/reviews/{review.id}/helpful/').json()
+        self.assertEqual(data, {'success': True, 'helpful_count': 1})
+        invalidate.assert_not_called()
+
+    def test_logged_in_users_get_their_own_wishlist_state(self):
+        self.client.get('/products/')
+        Wishlist.objects.create(user=self.user, product=self.product)
+        self.client.force_login(self.user)
+        response = self.client.get('/products/')
+        self.assertTrue(response.context['products'][0].in_wishlist)
+
+
+class MpesaTokenManagerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.stub = DarajaStub().start()
+        self.addCleanup(self.stub.stop)
+        override = override_settings(MPESA_BASE_URL=self.stub.url, MPESA_TOKEN_REFRESH_MARGIN=300)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_token_cached_in_process_and_shared(self):
+        manager = TokenManager()
+        self.assertEqual(manager.get_token(), 'stub-token-1')
+        self.assertEqual(manager.get_token(), 'stub-token-1')
+        # Another worker picks the token up from the shared cache
+        self.assertEqual(TokenManager().get_token(), 'stub-token-1')
+        self.assertEqual(self.stub.token_requests, 1)
+        self.assertLess(manager.token_age(), 5)
+
+    def test_concurrent_callers_trigger_one_refresh(self):
+        self.stub.delay = 0.2
+        manager = TokenManager()
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ['stub-token-1'] * 10)
+        self.assertEqual(self.stub.token_requests, 1)
+
+    def test_refreshes_ahead_of_expiry(self):
+        now = [1000.0]
+        manager = TokenManager(clock=lambda: now[0])
+        self.assertEqual(manager.get_token(), 'stub-token-1')
+        now[0] += 3599 - 300 - 1
+        self.assertEqual(manager.get_token(), 'stub-token-1')
+        now[0] += 2
+        self.assertEqual(manager.get_token(), 'stub-token-2')
+        self.assertEqual(manager.token_age(), 0)
+
+    def test_rejected_token_is_replaced(self):
+        user = User.objects.create_user('payer', password='x')
+        order = Order.objects.create(
+            user=user, total_amount=Decimal('100.00'), phone_number='254712345678', delivery_address='Nairobi'
+        )
+        payment = MpesaPayment.objects.create(
+            order=order, phone_number='254712345678', amount=Decimal('100.00'),
+            business_number='174379', account_number='ORDER1',
+        )
+        self.addCleanup(token_manager.invalidate)
+        self.assertEqual(initiate_stk_push(payment)['ResponseCode'], '0')
+        self.stub.revoke_tokens()
+        with self.assertLogs('shop.mpesa', 'WARNING'):
+            self.assertEqual(initiate_stk_push(payment)['ResponseCode'], '0')
+        self.assertEqual(self.stub.token_requests, 2)
+        self.assertEqual(len(self.stub.stk_requests), 2)
+
+
+@override_settings(STK_PUSH_MAX_ATTEMPTS=2, STK_PUSH_RETRY_DELAY=60)
+class StkPushQueueTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(token_manager.invalidate)
+        self.stub = self.start_stub()
+        self.user = User.objects.create_user('checkout', password='x')
+        self.product = make_product(Category.objects.create(name='Books', slug='books'), stock=5)
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        self.client.force_login(self.user)
+        for patch in (
+            mock.patch.object(daraja_client.adapter, 'max_retries', daraja_client.adapter.max_retries.new(total=0)),
+            mock.patch.object(async_daraja_client, 'retries', 0),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def start_stub(self):
+        stub = DarajaStub().start()
+        self.addCleanup(stub.stop)
+        override = override_settings(MPESA_BASE_URL=stub.url)
+        override.enable()
+        self.addCleanup(override.disable)
+        return stub
+
+    def checkout(self):
+        response = self.client.post('/checkout/', {
+            'phone_number': '254712345678', 'account_number': 'ACC1', 'delivery_address': 'Nairobi',
+        })
+        self.assertTrue(response.json()['success'])
+        return response.json()
+
+    def run_worker(self):
+        StkPushJob.objects.filter(status='queued').update(run_after=timezone.now())
+        call_command('stk_worker', once=True, threads=1, stdout=StringIO())
+
+    def test_checkout_sends_push_right_away(self):
+        data = self.checkout()
+        self.assertEqual(data['checkout_request_id'], 'ws_CO_stub_1')
+        payment = MpesaPayment.objects.get(order_id=data['order_id'])
+        self.assertEqual(payment.status, 'pending')
+        self.assertEqual(payment.stk_job.status, 'sent')
+
+    def test_worker_sends_jobs_checkout_could_not(self):
+        self.stub.stop()
+        with self.assertLogs('shop', 'WARNING'):
+            data = self.checkout()
+        job = StkPushJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_after, timezone.now())
+
+        stub = self.start_stub()
+        self.run_worker()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'sent')
+        self.assertEqual(MpesaPayment.objects.get(order_id=data['order_id']).checkout_request_id, 'ws_CO_stub_1')
+        self.assertEqual(len(stub.stk_requests), 1)
+
+    def test_retries_then_fails_and_restores_stock(self):
+        self.stub.stop()
+        with self.assertLogs('shop', 'WARNING'):
+            order = Order.objects.get(pk=self.checkout()['order_id'])
+            self.product.refresh_from_db()
+            self.assertEqual(self.product.stock, 3)
+            self.run_worker()
+
+        job = StkPushJob.objects.get()
+        order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+        self.assertEqual(order.status, 'cancelled')
+        self.assertEqual(order.mpesa_payment.status, 'failed')
+        self.assertEqual(self.product.stock, 5)
+
+    def test_payment_status_and_callback(self):
+        data = self.checkout()
+        self.assertEqual(self.client.get(f"/check-payment-status/{data['order_id']}/").json()['status'], 'pending')
+
+        response = self.client.post('/mpesa/callback/', {'Body': {'stkCallback': {
+            'CheckoutRequestID': data['checkout_request_id'], 'ResultCode': 0, 'ResultDesc': 'Processed',
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'QAB123'}]},
+        }}}, content_type='application/json')
+        self.assertEqual(response.json()['ResultCode'], 0)
+        call_command('process_callbacks', once=True, stdout=StringIO())
+
+        status = self.client.get(f"/check-payment-status/{data['order_id']}/").json()
+        self.assertEqual((status['status'], status['mpesa_receipt']), ('completed', 'QAB123'))
+
+    def test_push_daraja_may_have_accepted_is_not_sent_again(self):
+        self.stub.stk_status = 500
+        with self.assertLogs('shop', 'WARNING'):
+            data = self.checkout()
+            self.run_worker()
+        job = StkPushJob.objects.get()
+        self.assertEqual((job.status, job.attempts), ('unknown', 1))
+        self.assertEqual(len(self.stub.stk_requests), 1)
+        payment = MpesaPayment.objects.get(order_id=data['order_id'])
+        self.assertEqual((payment.status, payment.checkout_request_id), ('pending', None))
+
+        # The customer paid the one prompt they got
+        with self.assertLogs('shop', 'WARNING'):
+            apply_stk_callback({
+                'MerchantRequestID': 'm-1', 'CheckoutRequestID': 'ws_CO_late', 'ResultCode': 0, 'ResultDesc': 'Processed',
+                'CallbackMetadata': {'Item': [
+                    {'Name': 'Amount', 'Value': float(payment.amount)}, {'Name': 'MpesaReceiptNumber', 'Value': 'QLATE1'},
+                    {'Name': 'PhoneNumber', 'Value': 254712345678},
+                ]},
+            })
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.checkout_request_id), ('completed', 'ws_CO_late'))
+
+    def test_read_timeout_is_unknown_not_retryable(self):
+        self.stub.delay = 0.5
+        payment = MpesaPayment(order_id=1, phone_number='254712345678', amount=Decimal('10'), account_number='A')
+        with mock.patch.object(daraja_client, 'timeout', (5, 0.1)), self.assertLogs('shop', 'ERROR'):
+            result = initiate_stk_push(payment)
+        self.assertTrue(result['unknown'])
+        self.assertFalse(result.get('retryable'))
+
+    def test_async_read_timeout_is_unknown_not_retryable(self):
+        self.stub.delay = 0.5
+        payment = MpesaPayment(order_id=1, phone_number='254712345678', amount=Decimal('10'), account_number='A')
+        token_manager.get_token()
+        timeout = httpx.Timeout(0.1, connect=5)
+        with mock.patch.object(async_daraja_client, 'timeout', timeout), self.assertLogs('shop', 'ERROR'):
+            result = asyncio.run(ainitiate_stk_push(payment))
+        self.assertTrue(result['unknown'])
+        self.assertFalse(result.get('retryable'))
+
+    def test_running_job_of_stopped_worker_is_not_resent(self):
+        self.stub.stop()
+        with self.assertLogs('shop', 'WARNING'):
+            self.checkout()
+        StkPushJob.objects.update(status='running', locked_at=timezone.now() - stk_queue.STALE_AFTER * 2)
+
+        stub = self.start_stub()
+        with self.assertLogs('shop', 'WARNING'):
+            self.run_worker()
+        self.assertEqual(StkPushJob.objects.get().status, 'unknown')
+        self.assertEqual(stub.stk_requests, [])
+
+
+class DuplicateCallbackTests(TransactionTestCase):
+    """Safaricom retries callbacks; replaying one concurrently must apply it once"""
+
+    def setUp(self):
+        cache.clear()
+        self.product = make_product(Category.objects.create(name='Books', slug='books'), stock=3)
+        user = User.objects.create_user('buyer', password='x')
+        self.order = Order.objects.create(
+            user=user, total_amount=Decimal('200.00'), phone_number='254712345678', delivery_address='Nairobi'
+        )
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=2, price=self.product.price)
+        self.payment = MpesaPayment.objects.create(
+            order=self.order, phone_number='254712345678', amount=Decimal('200.00'),
+            business_number='174379', account_number='ORDER1', checkout_request_id='ws_CO_dup',
+        )
+
+    def replay(self, stk_callback, times=12):
+        barrier = threading.Barrier(times)
+        results = []
+
+        def deliver():
+            barrier.wait()
+            try:
+                results.append(apply_stk_callback(stk_callback))
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=deliver) for _ in range(times)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_failed_callback_restores_stock_once(self):
+        with self.assertLogs('shop', 'WARNING') as logs:
+            results = self.replay({'CheckoutRequestID': 'ws_CO_dup', 'ResultCode': 1032, 'ResultDesc': 'Cancelled'})
+
+        self.assertEqual(results, [{'ResultCode': 0, 'ResultDesc': 'Accepted'}] * 12)
+        self.assertEqual(len([r for r in logs.records if r.levelname == 'WARNING']), 1)
+        self.product.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertEqual(self.order.status, 'cancelled')
+
+    def test_success_callback_applied_once_and_receipts_unique(self):
+        callback = {'CheckoutRequestID': 'ws_CO_dup', 'ResultCode': 0, 'ResultDesc': 'Processed', 'CallbackMetadata': {
+            'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'QDUP1'}, {'Name': 'Amount', 'Value': 200}],
+        }}
+        with self.assertLogs('shop', 'INFO') as logs:
+            self.replay(callback)
+        self.assertEqual(len([r for r in logs.records if 'Payment completed' in r.getMessage()]), 1)
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.mpesa_receipt_number), ('completed', 'QDUP1'))
+
+        # A late failure callback for the same push changes nothing
+        apply_stk_callback({'CheckoutRequestID': 'ws_CO_dup', 'ResultCode': 1, 'ResultDesc': 'Late'})
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+
+        # The same receipt can't complete a second payment
+        other = Order.objects.create(
+            user=self.order.user, total_amount=Decimal('200.00'), phone_number='254712345678', delivery_address='Nairobi'
+        )
+        MpesaPayment.objects.create(
+            order=other, phone_number='254712345678', amount=Decimal('200.00'),
+            business_number='174379', account_number='ORDER2', checkout_request_id='ws_CO_other',
+        )
+        with self.assertLogs('shop', 'ERROR') as logs:
+            self.assertEqual(apply_stk_callback({**callback, 'CheckoutRequestID': 'ws_CO_other'}), ACCEPTED)
+        self.assertIn('left pending for review', logs.output[-1])
+        conflicted = MpesaPayment.objects.get(order=other)
+        self.assertEqual((conflicted.status, conflicted.result_code), ('pending', '0'))
+        self.assertEqual(conflicted.result_description, 'Processed (receipt QDUP1 is recorded on another payment)')
+
+
+class InventoryTests(TestCase):
+
+    def setUp(self):
+        self.product = make_product(Category.objects.create(name='Shirts', slug='shirts'), stock=5, sku='SHIRT')
+        self.variant = ProductVariant.objects.create(
+            product=self.product, name='Red - L', sku='SHIRT-RL', stock=1, price_adjustment=Decimal('20.00')
+        )
+        self.cart = Cart.objects.create(user=User.objects.create_user('buyer', password='x'))
+
+    def test_reserve_reports_short_lines_and_takes_variant_stock(self):
+        plain = CartItem.objects.create(cart=self.cart, product=self.product, quantity=2)
+        red = CartItem.objects.create(cart=self.cart, product=self.product, variant=self.variant, quantity=2)
+
+        self.assertEqual(inventory.reserve([plain, red]), [red])
+        self.product.refresh_from_db()
+        self.variant.refresh_from_db()
+        self.assertEqual((self.product.stock, self.variant.stock), (3, 1))
+
+        red.quantity = 1
+        self.assertEqual(inventory.reserve([red]), [])
+        self.product.refresh_from_db()
+        self.variant.refresh_from_db()
+        self.assertEqual((self.product.stock, self.variant.stock), (2, 0))
+
+    def test_sold_out_variants_take_the_product_out_of_stock(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=1)
+        red = CartItem.objects.create(cart=self.cart, product=self.product, variant=self.variant, quantity=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            inventory.reserve_or_fail([red])
+        self.assertNotContains(self.client.get('/products/?in_stock=1'), self.product.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            inventory.release([red])
+        self.product.refresh_from_db()
+        self.variant.refresh_from_db()
+        self.assertEqual((self.product.stock, self.variant.stock), (1, 1))
+        self.assertContains(self.client.get('/products/?in_stock=1'), self.product.name)
+
+    def test_catalog_pages_invalidated_only_when_availability_changes(self):
+        line = CartItem.objects.create(cart=self.cart, product=self.product, quantity=3)
+        with mock.patch.object(page_cache, 'invalidate') as invalidate:
+            with self.captureOnCommitCallbacks(execute=True):
+                inventory.reserve([line])
+            invalidate.assert_not_called()
+
+            line.quantity = 2
+            with self.captureOnCommitCallbacks(execute=True):
+                inventory.reserve([line])
+            with self.captureOnCommitCallbacks(execute=True):
+                inventory.release([line])
+        self.assertEqual(invalidate.call_count, 2)
+
+    def test_checkout_copies_lines_and_rolls_back_when_short(self):
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=1)
+        red = CartItem.objects.create(cart=self.cart, product=self.product, variant=self.variant, quantity=3)
+        self.client.force_login(self.cart.user)
+        form = {'phone_number': '254712345678', 'account_number': 'ACC1', 'delivery_address': 'Nairobi'}
+
+        data = self.client.post('/checkout/', form).json()
+        self.assertFalse(data['success'])
+        self.assertEqual(data['out_of_stock'], [red.id])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+        self.assertFalse(Order.objects.exists())
+
+        red.quantity = 1
+        red.save()
+        with mock.patch.object(stk_queue, 'aprocess', return_value='queued'):
+            data = self.client.post('/checkout/', form).json()
+        self.assertTrue(data['success'])
+        items = {item.product_sku: item for item in Order.objects.get().items.all()}
+        self.assertEqual(items['SHIRT-RL'].product_name, 'Widget - Red - L')
+        self.assertEqual(items['SHIRT-RL'].price, Decimal('120.00'))
+        self.assertEqual(items['SHIRT'].variant, None)
+
+
+class CartPricingTests(TestCase):
+
+    def setUp(self):
+        category = Category.objects.create(name='Shirts', slug='shirts')
+        self.user = User.objects.create_user('buyer', password='x')
+        self.cart = Cart.objects.create(user=self.user)
+        self.products = [make_product(category, f'Shirt {i}', price=Decimal('100.00')) for i in range(4)]
+        variant = ProductVariant.objects.create(product=self.products[0], name='XL', price_adjustment=Decimal('15.50'), stock=5)
+        CartItem.objects.create(cart=self.cart, product=self.products[0], variant=variant, quantity=2)
+        CartItem.objects.create(cart=self.cart, product=self.products[1], quantity=1)
+
+    def test_totals_in_one_query_and_cached_on_the_cart(self):
+        cart = Cart.objects.get(pk=self.cart.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.total_amount, Decimal('331.00'))
+            self.assertEqual(cart.total_items, 3)
+            self.assertEqual(cart.total_amount, Decimal('331.00'))
+
+        cart = Cart.objects.prefetch_related(pricing.priced_items()).get(pk=self.cart.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual((cart.total_amount, cart.total_items), (Decimal('331.00'), 3))
+
+    def test_cart_page_queries_do_not_grow_with_items(self):
+        self.client.force_login(self.user)
+        self.client.get('/cart/')  # warm the category and item count caches
+        with CaptureQueriesContext(connection) as few:
+            self.assertEqual(self.client.get('/cart/').status_code, 200)
+        for product in self.products[2:]:
+            CartItem.objects.create(cart=self.cart, product=product, quantity=1)
+        self.client.get('/cart/')  # re-cache the item count
+        with CaptureQueriesContext(connection) as more:
+            response = self.client.get('/cart/')
+        self.assertContains(response, '531.00')
+        self.assertEqual(len(more), len(few))
+
+        item = self.cart.items.get(product=self.products[1])
+        data = self.client.post(f'/cart/update/{item.pk}/', {'quantity': 3}, content_type='application/json').json()
+        self.assertEqual((data['subtotal'], data['cart_total']), (300.0, 731.0))
+
+
+class QueryPlanTests(TestCase):
+    """
+    EXPLAIN the hot lookups against a synthetic catalog and order history
+    and fail if one falls back to a full table scan or a sort. Add new
+    hot queries to ``hot_queries``.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # 8 top-level categories with 4 subcategories each, with the paths save() would give them
+        categories = Category.objects.bulk_create(
+            Category(name=f'Category {i}', slug=f'category-{i}') for i in range(8)
+        )
+        categories += Category.objects.bulk_create(
+            Category(name=f'Category {i}', slug=f'category-{i}', parent=categories[i % 8]) for i in range(8, 40)
+        )
+        for category in categories:
+            category.path = f'{category.parent.path if category.parent else ""}{category.pk}/'
+        Category.objects.bulk_update(categories, ['path'])
+        Product.objects.bulk_create(
+            Product(
+                category=categories[i % 40], name=f'Product {i}', slug=f'product-{i}', description='',
+                price=Decimal(100 + i % 900), stock=i % 7, is_active=i % 10 != 0, is_featured=i % 25 == 0,
+                sold_count=i % 113, view_count=i % 71,
+            )
+            for i in range(5000)
+        )
+        users = User.objects.bulk_create(User(username=f'customer{i}') for i in range(100))
+        statuses = [status for status, _ in Order.STATUS_CHOICES]
+        orders = Order.objects.bulk_create(
+            Order(user=users[i % 100], total_amount=Decimal('100.00'), phone_number='254712345678',
+                  delivery_address='Nairobi', status=statuses[i % len(statuses)])
+            for i in range(5000)
+        )
+        MpesaPayment.objects.bulk_create(
+            MpesaPayment(order=order, phone_number='254712345678', amount=Decimal('100.00'), business_number='174379',
+                         account_number='ACC', checkout_request_id=f'ws_CO_{order.pk}',
+                         status='pending' if order.pk % 20 == 0 else 'completed')
+            for order in orders
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def hot_queries(self):
+        # category-0 only holds inactive products
+        category = Category.objects.get(slug='category-1')
+        user = User.objects.first()
+        # As product_list builds it, card annotations included
+        products = Product.objects.filter(is_active=True).with_card_data(AnonymousUser())
+        featured = ('-is_featured', '-sold_count', '-view_count')
+
+        def pages(name, queryset, per_page=24):
+            # The first page and the one after it, as CursorPaginator asks for them
+            paginator = CursorPaginator(queryset, per_page)
+            first = paginator.query()
+            after = paginator.decode(paginator.encode(first[per_page - 1], False))
+            return {name: first, f'{name}_page_2': paginator.query(after)}
+
+        return {
+            **pages('product_list', products.order_by(*featured)),
+            **pages('product_list_category', products.filter(
+                category__in=Category.objects.subtree(category)
+            ).order_by(*featured)),
+            'category_subtree': Category.objects.subtree(category).order_by(),
+            **pages('product_list_in_stock', products.filter(stock__gt=0).order_by(*featured)),
+            'product_list_featured': products.filter(is_featured=True).order_by(*featured)[:24],
+            **pages('product_list_price_low', products.order_by('price')),
+            'product_list_price_range': products.filter(price__gte=200, price__lte=210).order_by('price')[:24],
+            **pages('product_list_newest', products.order_by('-created_at')),
+            **pages('orders_view', Order.objects.filter(user=user).order_by('-created_at'), 10),
+            **pages('orders_view_status', Order.objects.filter(user=user, status='pending').order_by('-created_at'), 2),
+            'mpesa_callback': MpesaPayment.objects.filter(checkout_request_id='ws_CO_42'),
+            'reconcile_payments': MpesaPayment.objects.filter(
+                status='pending', created_at__lte=timezone.now()
+            ).order_by('created_at')[:100],
+        }
+
+    def test_hot_queries_use_indexes(self):
+        for name, queryset in self.hot_queries().items():
+            with self.subTest(name):
+                plan = queryset.explain()
+                # "SCAN t" alone is a full table scan; "SCAN t USING INDEX" walks an index in order
+                full_scans = [line for line in plan.splitlines() if re.search(r'SCAN \w+$', line.strip())]
+                self.assertEqual(full_scans, [], plan)
+                self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_cursor_pages_seek_into_the_index(self):
+        # The featured sort's columns are nullable, so its later pages walk the index instead
+        queries = self.hot_queries()
+        for name in ('product_list_price_low_page_2', 'product_list_newest_page_2', 'orders_view_page_2'):
+            with self.subTest(name):
+                plan = queries[name].explain()
+                self.assertRegex(plan, r'SEARCH shop_(product|order) USING INDEX \w+ \(.*[<>]\?\)', plan)
+
+
+class CursorPaginationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Audio', slug='audio')
+        # Ties on price and NULLs in the featured sort keys
+        self.products = [
+            make_product(self.category, name=f'Speaker {i}', price=Decimal(100 + i % 3),
+                         sold_count=None if i % 4 == 0 else i % 5, is_featured=None if i % 6 == 0 else i % 2 == 0)
+            for i in range(25)
+        ]
+
+    def walk(self, queryset, per_page=4):
+        paginator = CursorPaginator(queryset, per_page)
+        page, seen, pages = paginator.page(), [], []
+        while True:
+            seen.extend(page)
+            pages.append(page)
+            if not page.has_next:
+                return seen, pages
+            page = paginator.page(page.next_cursor)
+
+    def test_pages_follow_the_sort_with_ties_and_nulls(self):
+        products = Product.objects.all()
+        for ordering in [('price',), ('-price',), ('-is_featured', '-sold_count', '-view_count'), ('-created_at',)]:
+            with self.subTest(ordering):
+                seen, _ = self.walk(products.order_by(*ordering))
+                self.assertEqual(seen, list(products.order_by(*ordering, '-pk' if ordering[-1][0] == '-' else 'pk')))
+
+    def test_previous_cursor_returns_the_same_page(self):
+        paginator = CursorPaginator(Product.objects.order_by('-sold_count'), 4)
+        _, pages = self.walk(Product.objects.order_by('-sold_count'))
+        for earlier, later in zip(pages, pages[1:]):
+            self.assertEqual(list(paginator.page(later.previous_cursor)), list(earlier))
+        self.assertFalse(pages[0].has_previous)
+        self.assertFalse(paginator.page(pages[1].previous_cursor).has_previous)
+
+    def test_bad_or_foreign_cursors_give_the_first_page(self):
+        price = CursorPaginator(Product.objects.order_by('price'), 4)
+        first = list(price.page())
+        cursor = CursorPaginator(Product.objects.order_by('-created_at'), 4).page().next_cursor
+        self.assertEqual(list(price.page(cursor)), first)
+        self.assertEqual(list(price.page(cursor[:-2] + 'xx')), first)
+        self.assertEqual(list(price.page('garbage')), first)
+
+    def test_product_list_load_more(self):
+        response = self.client.get('/products/?sort=price_low')
+        self.assertEqual(response.context['total_results'], 25)
+        page = response.context['products']
+        self.assertEqual(len(page), 24)
+        self.assertContains(response, 'load-more-btn')
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/products/', {'sort': 'price_low', 'cursor': page.next_cursor, 'partial': '1'})
+        self.assertEqual(len(response.context['products']), 1)
+        self.assertContains(response, 'product-card', count=1)
+        self.assertNotContains(response, 'load-more-btn')
+
+    def test_search_keeps_numbered_pages(self):
+        response = self.client.get('/products/?search=speaker')
+        self.assertTrue(response.context['products'].paginator)
+        self.assertEqual(response.context['total_results'], 25)
+
+    def test_listing_loads_one_page_of_rows(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/products/?sort=newest&rating=0')
+        product_rows = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT "shop_product"."id"')]
+        self.assertEqual(len(product_rows), 1)
+        self.assertIn('LIMIT 25', product_rows[0])
+        aggregates = [q['sql'] for q in ctx.captured_queries if 'MIN("shop_product"."price")' in q['sql']]
+        self.assertEqual(len(aggregates), 1)
+        self.assertIn('COUNT(', aggregates[0])
+
+        self.assertEqual(response.context['total_results'], 25)
+        self.assertEqual((response.context['price_min'], response.context['price_max']), (100, 102))
+
+
+class CategoryTreeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.electronics = Category.objects.create(name='Electronics', slug='electronics')
+        self.audio = Category.objects.create(name='Audio', slug='audio', parent=self.electronics)
+        self.headphones = Category.objects.create(name='Headphones', slug='headphones', parent=self.audio)
+        self.home = Category.objects.create(name='Home', slug='home', display_order=1)
+
+    def test_paths_and_subtree(self):
+        self.assertEqual(self.headphones.path, f'{self.electronics.pk}/{self.audio.pk}/{self.headphones.pk}/')
+        self.assertEqual(self.headphones.depth, 2)
+        self.assertEqual(
+            set(Category.objects.subtree(self.electronics)), {self.electronics, self.audio, self.headphones}
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(self.headphones.ancestors(), [self.electronics, self.audio])
+
+    def test_subtree_of_a_category_without_a_path(self):
+        # e.g. bulk_create()d or loaded from a fixture without paths
+        orphans = Category.objects.bulk_create([
+            Category(name='Garden', slug='garden'), Category(name='Toys', slug='toys'),
+        ])
+        self.assertEqual(list(Category.objects.subtree(orphans[0])), [orphans[0]])
+
+    def test_moving_a_category_moves_its_subtree(self):
+        self.audio.parent = self.home
+        self.audio.save()
+        self.headphones.refresh_from_db()
+        self.assertEqual(self.headphones.path, f'{self.home.pk}/{self.audio.pk}/{self.headphones.pk}/')
+        self.assertEqual(set(Category.objects.subtree(self.electronics)), {self.electronics})
+
+        # A stale instance doesn't write its old path back
+        stale = Category.objects.get(pk=self.headphones.pk)
+        self.audio.parent = None
+        self.audio.save()
+        stale.name = 'Earphones'
+        stale.save()
+        self.assertEqual(stale.path, f'{self.audio.pk}/{self.headphones.pk}/')
+
+    def test_cannot_move_under_own_subtree(self):
+        self.electronics.parent = self.headphones
+        with self.assertRaises(ValidationError):
+            self.electronics.full_clean()
+        with self.assertRaises(ValueError):
+            self.electronics.save()
+
+    def test_product_list_includes_every_level(self):
+        make_product(self.headphones, name='Studio Headphones')
+        make_product(self.home, name='Kettle')
+        response = self.client.get('/products/?category=electronics')
+        self.assertEqual([p.name for p in response.context['products']], ['Studio Headphones'])
+        self.assertEqual(
+            [(c.name, c.depth) for c in response.context['categories']],
+            [('Electronics', 0), ('Audio', 1), ('Headphones', 2), ('Home', 0)],
+        )
+
+        response = self.client.get('/category/electronics/')
+        self.assertEqual([p.name for p in response.context['products']], ['Studio Headphones'])
+
+
+class FacetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        electronics = Category.objects.create(name='Electronics', slug='electronics')
+        audio = Category.objects.create(name='Audio', slug='audio', parent=electronics)
+        headphones = Category.objects.create(name='Headphones', slug='headphones', parent=audio)
+        home = Category.objects.create(name='Home', slug='home')
+        self.sony = Brand.objects.create(name='Sony')
+        self.acme = Brand.objects.create(name='Acme')
+        make_product(headphones, name='Studio Headphones', brand=self.sony, price=Decimal('500'),
+                     free_shipping=True, rating_avg=4.5)
+        make_product(audio, name='Speaker', brand=self.acme, price=Decimal('3000'), stock=0, rating_avg=3.2)
+        make_product(home, name='Fridge', brand=self.acme, price=Decimal('60000'), is_featured=True)
+
+    def test_counts_for_the_filter_set(self):
+        response = self.client.get(f'/products/?category=electronics&brand={self.sony.pk}')
+        context = response.context
+        self.assertEqual(context['total_results'], 1)
+        # Brands ignore the brand filter, categories the category filter
+        self.assertEqual([(b.name, n) for b, n in context['brand_facets']], [('Acme', 1), ('Sony', 1)])
+        self.assertEqual(
+            [(c.name, n) for c, n in context['category_facets']],
+            [('Electronics', 1), ('Audio', 1), ('Headphones', 1)],
+        )
+        self.assertEqual([b.count for b in context['price_buckets']], [1, 0, 0, 0, 0])
+        self.assertEqual(context['rating_facets'], [(4, 1), (3, 1), (2, 1), (1, 1)])
+        self.assertEqual(context['flag_counts']['free_shipping'], 1)
+        self.assertEqual(context['flag_counts']['featured'], 0)
+        self.assertContains(response, 'Sony <span class="facet-count">(1)</span>')
+
+        response = self.client.get('/products/?min_price=1000')
+        self.assertEqual(response.context['total_results'], 2)
+        self.assertEqual(response.context['flag_counts']['in_stock'], 1)
+        self.assertEqual([b.count for b in response.context['price_buckets']], [0, 1, 0, 0, 1])
+
+    def test_price_on_a_bucket_boundary_is_counted_once(self):
+        make_product(Category.objects.get(slug='home'), name='Kettle', price=Decimal('1000'))
+        response = self.client.get('/products/')
+        buckets = response.context['price_buckets']
+        self.assertEqual([b.count for b in buckets], [1, 2, 0, 0, 1])
+        self.assertEqual(sum(b.count for b in buckets), response.context['total_results'])
+        self.assertContains(response, '?min_price=1000&amp;max_price=4999.99"')
+
+        response = self.client.get('/products/?max_price=999.99')
+        self.assertEqual(response.context['total_results'], buckets[0].count)
+
+    def test_rating_filter_matches_the_rounded_average(self):
+        make_product(Category.objects.get(slug='home'), name='Toaster', rating_avg=3.96)
+        response = self.client.get('/products/?rating=4')
+        self.assertEqual(sorted(p.name for p in response.context['products']), ['Studio Headphones', 'Toaster'])
+        self.assertEqual(response.context['rating_facets'][0], (4, 2))
+
+    def test_rows_are_cached_across_brand_and_category_choices(self):
+        self.client.get('/products/?category=electronics')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(f'/products/?brand={self.acme.pk}&category=home')
+        self.assertFalse([q for q in ctx.captured_queries if 'GROUP BY' in q['sql']])
+        self.assertEqual(response.context['total_results'], 1)
+
+    def test_category_page_brand_counts(self):
+        response = self.client.get(f'/category/electronics/?brand={self.sony.pk}')
+        self.assertEqual([(b.name, n) for b, n in response.context['brands']], [('Acme', 1), ('Sony', 1)])
+        self.assertEqual([p.name for p in response.context['products']], ['Studio Headphones'])
+
+
+class StockReservationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.product = make_product(Category.objects.create(name='Books', slug='books'), stock=5)
+        self.client.force_login(User.objects.create_user('buyer', password='x'))
+
+    def place_order(self, quantity):
+        cart, _ = Cart.objects.get_or_create(user_id=self.client.session['_auth_user_id'])
+        CartItem.objects.create(cart=cart, product=self.product, quantity=quantity)
+        with mock.patch.object(stk_queue, 'aprocess', return_value='queued'):
+            data = self.client.post('/checkout/', {
+                'phone_number': '254712345678', 'account_number': 'ACC1', 'delivery_address': 'Nairobi',
+            }).json()
+        return Order.objects.get(pk=data['order_id'])
+
+    def expire(self):
+        StockReservation.objects.update(expires_at=timezone.now() - timezone.timedelta(seconds=1))
+        call_command('release_reservations', once=True, stdout=StringIO())
+
+    def test_unpaid_order_is_cancelled_when_reservation_expires(self):
+        order = self.place_order(2)
+        self.assertEqual(order.reservations.get().status, 'active')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        # Waiting to retry the push
+        StkPushJob.objects.update(status='queued')
+
+        with self.assertLogs('shop', 'WARNING'):
+            self.expire()
+
+        order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(order.status, 'cancelled')
+        self.assertEqual(order.mpesa_payment.status, 'failed')
+        self.assertEqual(order.mpesa_payment.stk_job.status, 'failed')
+        self.assertEqual(order.reservations.get().status, 'released')
+        self.assertEqual(self.product.stock, 5)
+
+        # Paid after all: flagged, not applied
+        MpesaPayment.objects.filter(order=order).update(checkout_request_id='ws_CO_late')
+        with self.assertLogs('shop', 'ERROR'):
+            apply_stk_callback({'CheckoutRequestID': 'ws_CO_late', 'ResultCode': 0, 'ResultDesc': 'Processed'})
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+
+    def test_paid_order_keeps_its_stock(self):
+        order = self.place_order(2)
+        MpesaPayment.objects.filter(order=order).update(checkout_request_id='ws_CO_paid')
+        apply_stk_callback({'CheckoutRequestID': 'ws_CO_paid', 'ResultCode': 0, 'ResultDesc': 'Processed'})
+        self.assertEqual(order.reservations.get().status, 'consumed')
+
+        self.expire()
+        order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(order.status, 'processing')
+        self.assertEqual(self.product.stock, 3)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(token_manager.invalidate)
+        stub = DarajaStub().start()
+        self.addCleanup(stub.stop)
+        override = override_settings(MPESA_BASE_URL=stub.url)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.product = make_product(Category.objects.create(name='Books', slug='books'), stock=3)
+        self.users = [User.objects.create_user(f'buyer{i}', password='x') for i in range(8)]
+        for user in self.users:
+            CartItem.objects.create(cart=Cart.objects.create(user=user), product=self.product, quantity=1)
+
+    def test_last_units_are_not_oversold(self):
+        barrier = threading.Barrier(len(self.users))
+        results = []
+
+        def checkout(user):
+            client = Client()
+            client.force_login(user)
+            barrier.wait()
+            try:
+                results.append(client.post('/checkout/', {
+                    'phone_number': '254712345678', 'account_number': 'ACC1', 'delivery_address': 'Nairobi',
+                }).json())
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=checkout, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(result['success'] for result in results), 3)
+        self.assertEqual(sum('out_of_stock' in result for result in results), 5)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(OrderItem.objects.count(), 3)
+
+
+class CallbackJournalTests(TestCase):
+
+    def setUp(self):
+        self.product = make_product(Category.objects.create(name='Books', slug='books'), stock=3)
+        user = User.objects.create_user('buyer', password='x')
+        self.order = Order.objects.create(
+            user=user, total_amount=Decimal('100.00'), phone_number='254712345678', delivery_address='Nairobi'
+        )
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=1, price=self.product.price)
+        self.payment = MpesaPayment.objects.create(
+            order=self.order, phone_number='254712345678', amount=Decimal('100.00'),
+            business_number='174379', account_number='ORDER1', checkout_request_id='ws_CO_journal',
+        )
+
+    def post_callback(self, body):
+        return self.client.post('/mpesa/callback/', body, content_type='application/json').json()
+
+    def test_callback_is_journaled_and_acknowledged_without_applying(self):
+        with self.assertNumQueries(1):
+            reply = self.post_callback({'Body': {'stkCallback': {
+                'CheckoutRequestID': 'ws_CO_journal', 'ResultCode': 1032, 'ResultDesc': 'Cancelled',
+            }}})
+        self.assertEqual(reply['ResultCode'], 0)
+        self.assertEqual(MpesaCallback.objects.get().checkout_request_id, 'ws_CO_journal')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'pending')
+
+    def test_processor_applies_batches_and_reports_lag(self):
+        failure = {'Body': {'stkCallback': {'CheckoutRequestID': 'ws_CO_journal', 'ResultCode': 1032, 'ResultDesc': 'Cancelled'}}}
+        self.post_callback(failure)
+        self.post_callback(failure)  # Safaricom retry
+        self.client.post('/mpesa/callback/', 'not json', content_type='application/json')
+        self.assertEqual(callback_journal.lag()['pending'], 3)
+
+        with self.assertLogs('shop', 'WARNING'):
+            call_command('process_callbacks', once=True, batch_size=2, stdout=StringIO())
+
+        self.assertEqual(
+            list(MpesaCallback.objects.values_list('result', flat=True)),
+            ['Accepted', 'Accepted', 'Invalid callback data'],
+        )
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 4)
+        lag = callback_journal.lag()
+        self.assertEqual((lag['pending'], lag['oldest_pending_age']), (0, 0.0))
+        self.assertGreaterEqual(lag['last_processing_delay'], 0)
+
+        out = StringIO()
+        call_command('process_callbacks', lag=True, stdout=out)
+        self.assertIn('Pending callbacks: 0', out.getvalue())
+
+    def test_replay_restores_lost_payment_state(self):
+        self.post_callback({'Body': {'stkCallback': {
+            'CheckoutRequestID': 'ws_CO_journal', 'ResultCode': 0, 'ResultDesc': 'Processed',
+            'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'QJRN1'}]},
+        }}})
+        call_command('process_callbacks', once=True, stdout=StringIO())
+        # e.g. payments restored from a backup taken before the callback
+        MpesaPayment.objects.update(status='pending', mpesa_receipt_number=None)
+
+        out = StringIO()
+        call_command('process_callbacks', replay=True, stdout=out)
+        self.assertIn('Replayed 1 callback(s)', out.getvalue())
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.mpesa_receipt_number), ('completed', 'QJRN1'))
+
+
+class ReconcileTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(token_manager.invalidate)
+        self.stub = DarajaStub().start()
+        self.addCleanup(self.stub.stop)
+        override = override_settings(MPESA_BASE_URL=self.stub.url)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user('buyer', password='x')
+
+    def payment(self, checkout_request_id, age):
+        order = Order.objects.create(
+            user=self.user, total_amount=Decimal('100.00'), phone_number='254712345678', delivery_address='Nairobi'
+        )
+        payment = MpesaPayment.objects.create(
+            order=order, phone_number='254712345678', amount=Decimal('100.00'),
+            business_number='174379', account_number='ACC1', checkout_request_id=checkout_request_id,
+        )
+        MpesaPayment.objects.filter(pk=payment.pk).update(created_at=timezone.now() - timezone.timedelta(seconds=age))
+        return payment
+
+    def test_stale_payments_settled_like_callbacks(self):
+        paid = self.payment('ws_CO_paid', 600)
+        cancelled = self.payment('ws_CO_cancelled', 600)
+        processing = self.payment('ws_CO_processing', 600)
+        self.payment('ws_CO_fresh', 10)
+        self.stub.query_results = {'ws_CO_paid': (0, 'Processed'), 'ws_CO_cancelled': (1032, 'Request cancelled by user')}
+
+        out = StringIO()
+        with self.assertLogs('shop', 'INFO'):
+            call_command('reconcile_payments', workers=1, rate=0, stdout=out)
+
+        self.assertIn('Checked 3 payment(s): 1 completed, 1 failed, 1 pending', out.getvalue())
+        self.assertEqual(sorted(self.stub.query_requests), ['ws_CO_cancelled', 'ws_CO_paid', 'ws_CO_processing'])
+        statuses = dict(MpesaPayment.objects.values_list('checkout_request_id', 'status'))
+        self.assertEqual(statuses, {
+            'ws_CO_paid': 'completed', 'ws_CO_cancelled': 'failed', 'ws_CO_processing': 'pending', 'ws_CO_fresh': 'pending',
+        })
+        self.assertEqual(Order.objects.get(pk=cancelled.order_id).status, 'cancelled')
+        self.assertEqual(Order.objects.get(pk=paid.order_id).status, 'processing')
+        self.assertEqual(Order.objects.get(pk=processing.order_id).status, 'pending')
+
+    def test_rate_limiter_spaces_calls(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = RateLimiter(4, clock=lambda: now[0], sleep=sleep)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(sleeps, [0.25, 0.25])
+
+
+class StatementImportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='x')
+        self.recorded = self.payment('ACC1', '100.00', mpesa_receipt_number='QREC1', status='completed')
+        self.waiting = self.payment('shop 42', '250.00')
+        self.cancelled = self.payment('ACC3', '80.00', status='failed')
+
+    def payment(self, account, amount, **kwargs):
+        order = Order.objects.create(
+            user=self.user, total_amount=Decimal(amount), phone_number='254712345678', delivery_address='Nairobi'
+        )
+        return MpesaPayment.objects.create(
+            order=order, phone_number='254712345678', amount=Decimal(amount),
+            business_number='174379', account_number=account, **kwargs,
+        )
+
+    def write_statement(self, rows):
+        path = os.path.join(self.enterContext(tempfile.TemporaryDirectory()), 'statement.csv')
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerows([['Account Name', 'Paybill 174379'], []])
+            writer.writerow(['Receipt No.', 'Completion Time', 'Details', 'Transaction Status', 'Paid In', 'Withdrawn', 'A/C No.'])
+            writer.writerows(rows)
+        return path
+
+    def test_statement_rows_matched_and_discrepancies_reported(self):
+        path = self.write_statement([
+            ['QREC1', '2024-05-01 10:00:00', 'STK payment', 'Completed', '100.00', '', 'ACC1'],
+            ['QPAY2', '2024-05-01 11:30:00', 'Pay Bill', 'Completed', '250.00', '', 'SHOP42'],
+            ['QPAY2', '2024-05-01 11:30:00', 'Pay Bill', 'Completed', '250.00', '', 'SHOP42'],
+            ['QLATE', '2024-05-01 12:00:00', 'Pay Bill', 'Completed', '80.00', '', 'acc3'],
+            ['QNONE', '2024-05-01 12:30:00', 'Pay Bill', 'Completed', '1,000.00', '', 'UNKNOWN'],
+            ['QWDRL', '2024-05-01 13:00:00', 'Withdrawal', 'Completed', '', '500.00', ''],
+            ['QFAIL', '2024-05-01 13:30:00', 'Pay Bill', 'Failed', '250.00', '', 'SHOP42'],
+        ])
+        report = os.path.join(os.path.dirname(path), 'report.csv')
+        err = StringIO()
+        call_command('import_statement', path, report=report, batch_size=1, stdout=StringIO(), stderr=err)
+
+        self.waiting.refresh_from_db()
+        self.assertEqual((self.waiting.status, self.waiting.mpesa_receipt_number), ('completed', 'QPAY2'))
+        self.assertEqual(self.waiting.transaction_date.hour, 11)
+        self.assertEqual(Order.objects.get(pk=self.waiting.order_id).status, 'processing')
+        self.assertEqual(MpesaPayment.objects.get(pk=self.cancelled.pk).status, 'failed')
+
+        with open(report, newline='') as f:
+            kinds = {row['receipt']: row['kind'] for row in csv.DictReader(f)}
+        self.assertEqual(kinds, {'QPAY2': 'duplicate', 'QLATE': 'order_cancelled', 'QNONE': 'unmatched'})
+        self.assertIn('5 paid-in row(s): 1 already_recorded, 1 duplicate, 1 matched', err.getvalue())
+
+    def test_amount_mismatches_and_dry_run(self):
+        path = self.write_statement([
+            ['QREC1', '2024-05-01 10:00:00', 'STK payment', 'Completed', '90.00', '', 'ACC1'],
+            ['QPAY3', '2024-05-01 11:00:00', 'Pay Bill', 'Completed', '200.00', '', 'SHOP 42'],
+        ])
+        out = StringIO()
+        call_command('import_statement', path, dry_run=True, stdout=out, stderr=StringIO())
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual([(row['receipt'], row['kind'], row['expected_amount']) for row in rows], [
+            ('QREC1', 'amount_mismatch', '100.00'), ('QPAY3', 'amount_mismatch', '250.00'),
+        ])
+        self.assertEqual(MpesaPayment.objects.get(pk=self.waiting.pk).status, 'pending')
+
+    def test_accounts_indexed_once_per_run(self):
+        rows = [
+            [f'QX{i}', '2024-05-01 12:00:00', 'Pay Bill', 'Completed', '80.00', '', account]
+            for i, account in enumerate(['ACC3', 'ACC3', 'SHOP42', 'UNKNOWN'])
+        ]
+        statement = read_statement(self.write_statement(rows))
+        # The account index, then one receipt lookup per chunk
+        with self.assertNumQueries(5):
+            counts = StatementImport(batch_size=1, dry_run=True).run(statement)
+        self.assertEqual((counts['order_cancelled'], counts['amount_mismatch'], counts['unmatched']), (1, 1, 2))
+
+    def test_matches_complete_like_callbacks_and_conflicts_are_per_row(self):
+        StkPushJob.objects.create(payment=self.waiting)
+        other = self.payment('ACC5', '60.00')
+        path = self.write_statement([
+            ['QPAY2', '2024-05-01 11:30:00', 'Pay Bill', 'Completed', '250.00', '', 'SHOP42'],
+            ['QPAY5', '2024-05-01 11:40:00', 'Pay Bill', 'Completed', '60.00', '', 'ACC5'],
+        ])
+
+        def racing(payment, receipt, *args):
+            # A callback recorded the receipt first
+            if receipt == 'QPAY5':
+                raise IntegrityError('UNIQUE constraint failed: shop_mpesapayment.mpesa_receipt_number')
+            return complete_payment(payment, receipt, *args)
+
+        out = StringIO()
+        with mock.patch('shop.statements.complete_payment', racing), \
+                mock.patch('shop.payments.publish_payment') as publish, self.captureOnCommitCallbacks(execute=True):
+            call_command('import_statement', path, stdout=out, stderr=StringIO())
+
+        publish.assert_called_once()
+        self.assertEqual(MpesaPayment.objects.get(pk=self.waiting.pk).status, 'completed')
+        self.assertFalse(StkPushJob.objects.exists())
+        self.assertEqual(MpesaPayment.objects.get(pk=other.pk).status, 'pending')
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual([(row['receipt'], row['kind']) for row in rows], [('QPAY5', 'receipt_conflict')])
+
+
+class DarajaClientTests(TestCase):
+
+    def setUp(self):
+        self.stub = DarajaStub().start()
+        self.addCleanup(self.stub.stop)
+
+    def test_connections_reused_and_timed_per_endpoint(self):
+        client = DarajaClient(base_url=self.stub.url)
+        self.addCleanup(client.close)
+        for _ in range(3):
+            self.assertEqual(client.get('/oauth/v1/generate').status_code, 200)
+        client.post('/mpesa/stkpush/v1/processrequest', json={}, headers={'Authorization': 'Bearer bad'})
+
+        stats = client.stats()
+        self.assertEqual(stats['/oauth/v1/generate']['requests'], 3)
+        self.assertEqual(stats['/oauth/v1/generate']['new_connections'], 1)
+        self.assertEqual(stats['/mpesa/stkpush/v1/processrequest']['reused_connections'], 1)
+        self.assertEqual(stats['/mpesa/stkpush/v1/processrequest']['errors'], 1)
+
+
+class PaymentStatusStreamTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('streamer', password='x')
+        self.order = Order.objects.create(
+            user=self.user, total_amount=Decimal('100.00'), phone_number='254712345678', delivery_address='Nairobi'
+        )
+        self.payment = MpesaPayment.objects.create(
+            order=self.order, phone_number='254712345678', amount=Decimal('100.00'),
+            business_number='174379', account_number='ORDER1', checkout_request_id='ws_CO_stream',
+        )
+
+    def callback(self, stk_callback):
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_stk_callback(stk_callback)
+
+    def test_checkout_page_knows_the_final_statuses(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=make_product(Category.objects.create(name='Tea', slug='tea')))
+        self.client.force_login(self.user)
+        response = self.client.get('/checkout/')
+        self.assertContains(response, '<script id="final-statuses" type="application/json">'
+                                      '["completed", "failed", "cancelled"]</script>', html=False)
+
+    async def test_stream_pushes_callback_outcome(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(f'/payment-status-stream/{self.order.id}/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        chunks = aiter(response.streaming_content)
+        self.assertIn('"status": "pending"', (await anext(chunks)).decode())
+
+        await sync_to_async(self.callback)({
+            'CheckoutRequestID': 'ws_CO_stream', 'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user',
+        })
+        chunk = (await asyncio.wait_for(anext(chunks), 2)).decode()
+        self.assertTrue(chunk.startswith('event: status'))
+        self.assertIn('"status": "failed"', chunk)
+        self.assertIn('Request cancelled by user', chunk)
+
+    @override_settings(PAYMENT_EVENTS_KEEPALIVE=0.2)
+    async def test_stream_sees_outcome_applied_by_another_process(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(f'/payment-status-stream/{self.order.id}/')
+        chunks = aiter(response.streaming_content)
+        await anext(chunks)
+
+        # e.g. process_callbacks: nothing is published in this process
+        await MpesaPayment.objects.filter(pk=self.payment.pk).aupdate(status='completed', mpesa_receipt_number='QX1')
+        chunk = (await asyncio.wait_for(anext(chunks), 2)).decode()
+        if chunk.startswith(':'):
+            chunk = (await asyncio.wait_for(anext(chunks), 2)).decode()
+        self.assertTrue(chunk.startswith('event: status'))
+        self.assertIn('"mpesa_receipt": "QX1"', chunk)
+
+    @override_settings(PAYMENT_EVENTS_KEEPALIVE=0.2)
+    async def test_stream_sees_outcome_published_by_another_process(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(f'/payment-status-stream/{self.order.id}/')
+        chunks = aiter(response.streaming_content)
+        await anext(chunks)
+
+        # A callback processor shares neither our waiters nor our locmem cache
+        with mock.patch('shop.payment_events.payment_events', PaymentEvents()), \
+                mock.patch('shop.payment_events.cache', LocMemCache('other-process', {})):
+            await sync_to_async(self.callback)({
+                'CheckoutRequestID': 'ws_CO_stream', 'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user',
+            })
+        self.assertIsNone(await cache.aget(event_key(self.order.id)))
+
+        chunk = (await asyncio.wait_for(anext(chunks), 2)).decode()
+        if chunk.startswith(':'):
+            chunk = (await asyncio.wait_for(anext(chunks), 2)).decode()
+        self.assertTrue(chunk.startswith('event: status'))
+        self.assertIn('"status": "failed"', chunk)
+
+    @override_settings(PAYMENT_EVENTS_TIMEOUT=0.2, PAYMENT_EVENTS_KEEPALIVE=1)
+    async def test_timeout_sends_current_status(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(f'/payment-status-stream/{self.order.id}/')
+        chunks = aiter(response.streaming_content)
+        await anext(chunks)
+        await anext(chunks)
+        await MpesaPayment.objects.filter(pk=self.payment.pk).aupdate(status='completed')
+        self.assertTrue((await anext(chunks)).decode().startswith('event: status'))
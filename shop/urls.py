@@ -9,7 +9,7 @@ urlpatterns = [
     path('category/<int:category_id>/', views.category_view, name='category'),
 
      path('product/<slug:slug>/', views.product_detail, name='product_detail'),
-    path('category/<slug:slug>/', views.category_products, name='category'),
+    path('category/<slug:slug>/', views.category_products, name='category_products'),
     path('brand/<slug:slug>/', views.brand_products, name='brand'),
     path('search/', views.search_products, name='search'),
     
@@ -31,6 +31,7 @@ urlpatterns = [
     # Checkout & Payment URLs
     path('checkout/', views.checkout, name='checkout'),
     path('check-payment-status/<int:order_id>/', views.check_payment_status, name='check_payment_status'),
+    path('payment-status-stream/<int:order_id>/', views.payment_status_stream, name='payment_status_stream'),
     path('mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
     
     # Order URLs
@@ -0,0 +1,102 @@
+"""
+Write-behind buffer for Product.view_count.
+
+product_detail records a view in memory instead of issuing an UPDATE on
+every hit. Pending increments are applied in bulk with F() expressions by a
+background thread every VIEW_COUNT_FLUSH_INTERVAL seconds, by the request
+that brings VIEW_COUNT_MAX_PENDING views, and again at interpreter exit. A
+crash loses at most one interval's (or one batch's) worth of views.
+
+Each process has its own buffer, so the stored view_count trails the real
+count by up to one interval per worker.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCounterBuffer:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._total = 0
+        self._last_flush = time.monotonic()
+        self._flusher = None
+
+    def record(self, product_id):
+        """Buffer one view, flushing if the interval or batch limit is reached"""
+        with self._lock:
+            self._pending[product_id] += 1
+            self._total += 1
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_periodically, name='view-counter', daemon=True)
+                self._flusher.start()
+            due = (
+                time.monotonic() - self._last_flush >= settings.VIEW_COUNT_FLUSH_INTERVAL
+                or self._total >= settings.VIEW_COUNT_MAX_PENDING
+            )
+        if due:
+            self.flush()
+
+    def _flush_periodically(self):
+        """Flush once an interval has passed since the last flush, even when no views arrive"""
+        while True:
+            with self._lock:
+                wait = self._last_flush + settings.VIEW_COUNT_FLUSH_INTERVAL - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def pending(self, product_id):
+        """Views recorded in this process but not yet written to the database"""
+        with self._lock:
+            return self._pending.get(product_id, 0)
+
+    def flush(self):
+        """Apply buffered views with one UPDATE per distinct increment"""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            self._total = 0
+            self._last_flush = time.monotonic()
+
+        if not pending:
+            return 0
+
+        by_increment = defaultdict(list)
+        for product_id, views in pending.items():
+            by_increment[views].append(product_id)
+
+        try:
+            for views, product_ids in by_increment.items():
+                Product.objects.filter(pk__in=product_ids).update(
+                    view_count=Coalesce(F('view_count'), 0) + views
+                )
+        except Exception as e:
+            # Put the views back so the next flush retries them
+            logger.error(f"Error flushing product view counts: {str(e)}")
+            with self._lock:
+                self._pending.update(pending)
+                self._total += sum(pending.values())
+            return 0
+
+        return sum(pending.values())
+
+
+view_counter = ViewCounterBuffer()
+atexit.register(view_counter.flush)
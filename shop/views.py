@@ -1,17 +1,28 @@
-from django.shortcuts import render, redirect, get_object_or_404
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_http_methods
 from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, prefetch_related_objects
 from django.conf import settings
-import requests
-import base64
 import json
-from datetime import datetime
 import logging
 from .models import *
+from . import autocomplete, callback_journal, inventory, pricing, stk_queue
+from .payment_events import FINAL_STATUSES, current_status, payment_events, status_payload
+from .cache import get_cart_count, get_category_nav
+from .mpesa import get_mpesa_access_token, token_manager
+from .page_cache import cache_catalog_page, catalog_summary_key
+from .facets import get_facets, rating_filter
+from .pagination import CursorPaginator
+from .payments import ACCEPTED
+from .search import apply_search
+from .view_counter import view_counter
 
 logger = logging.getLogger(__name__)
 
@@ -26,22 +37,23 @@ def search_suggestions(request):
     if len(query) < 2:
         return JsonResponse({'suggestions': []})
     
-    # Search in product names and descriptions
-    products = Product.objects.filter(
-        Q(name__icontains=query) | Q(description__icontains=query),
-        is_active=True
-    ).values('id', 'name')[:10]
-    
-    suggestions = [{'id': p['id'], 'name': p['name']} for p in products]
+    # Served from the in-memory prefix index, ranked by popularity
+    suggestions = autocomplete.suggest(query, limit=10)
     
     return JsonResponse({'suggestions': suggestions})
 
 
+@cache_catalog_page()
 def home_view(request):
     """Home page view"""
-    categories = Category.objects.all()[:8]
-    featured_products = Product.objects.filter(is_active=True).order_by('-created_at')[:4]
-    bestsellers = Product.objects.filter(is_active=True).order_by('-id')[:8]
+    cover_image = Product.objects.filter(
+        category=OuterRef('pk')
+    ).exclude(image='').order_by('pk').values('image')[:1]
+    categories = Category.objects.annotate(cover_image=Subquery(cover_image))[:8]
+
+    products = Product.objects.filter(is_active=True).with_card_data(request.user)
+    featured_products = products.order_by('-created_at')[:4]
+    bestsellers = products.order_by('-id')[:8]
     
     context = {
         'categories': categories,
@@ -51,99 +63,21 @@ def home_view(request):
     
     return render(request, 'store/home.html', context)
 
-import requests
-import base64
 import logging
-from datetime import datetime
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
 
-def get_mpesa_access_token():
-    """
-    Get M-Pesa access token using Consumer Key and Secret
-    """
-    try:
-        # Determine the correct URL based on environment
-        if settings.MPESA_ENVIRONMENT == 'sandbox':
-            url = 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-        else:
-            url = 'https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-        
-        # Create Basic Auth credentials
-        consumer_key = settings.MPESA_CONSUMER_KEY
-        consumer_secret = settings.MPESA_CONSUMER_SECRET
-        
-        # Encode credentials in base64
-        credentials = f"{consumer_key}:{consumer_secret}"
-        encoded_credentials = base64.b64encode(credentials.encode()).decode()
-        
-        # Set headers
-        headers = {
-            'Authorization': f'Basic {encoded_credentials}',
-            'Content-Type': 'application/json'
-        }
-        
-        logger.info("Requesting M-Pesa access token...")
-        
-        # Make the request
-        response = requests.get(url, headers=headers, timeout=30)
-        
-        # Log response for debugging
-        logger.info(f"Access token response status: {response.status_code}")
-        
-        if response.status_code == 200:
-            result = response.json()
-            access_token = result.get('access_token')
-            
-            if access_token:
-                logger.info("Successfully obtained M-Pesa access token")
-                return access_token
-            else:
-                logger.error(f"No access token in response: {result}")
-                return None
-        else:
-            logger.error(
-                f"Failed to get access token. Status: {response.status_code}, "
-                f"Response: {response.text}"
-            )
-            return None
-            
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error getting access token: {str(e)}")
-        return None
-    except Exception as e:
-        logger.error(f"Error getting M-Pesa access token: {str(e)}")
-        return None
-
-
-def generate_password():
-    """
-    Generate password and timestamp for STK Push
-    Password = Base64(Shortcode + Passkey + Timestamp)
-    """
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    
-    # Concatenate: Shortcode + Passkey + Timestamp
-    data_to_encode = f"{settings.MPESA_SHORTCODE}{settings.MPESA_PASSKEY}{timestamp}"
-    
-    # Encode in base64
-    password = base64.b64encode(data_to_encode.encode()).decode()
-    
-    return password, timestamp
-
-
-
 
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 from django.views.decorators.http import require_POST
-from django.db.models import Q, Avg
+from django.db.models import Q
 from django.contrib import messages
 from .models import (
-    Product, ProductImage, ProductSpecification, ProductVariant,
+    Product, ProductVariant,
     Review, ReviewImage, Wishlist, Cart, CartItem, Order, OrderItem
 )
 import json
@@ -156,15 +90,14 @@ def product_detail(request, slug):
     # Get the product
     product = get_object_or_404(Product, slug=slug, is_active=True)
     
-    # Increment view count
-    product.view_count = (product.view_count or 0) + 1
-    product.save(update_fields=['view_count'])
+    # Increment view count (buffered, written in bulk)
+    view_counter.record(product.id)
     
     # Get related products (same category)
     related_products = Product.objects.filter(
         category=product.category,
         is_active=True
-    ).exclude(id=product.id)[:4]
+    ).exclude(id=product.id).with_card_data(request.user)[:4]
     
     # Get all images
     product_images = product.images.all()
@@ -176,17 +109,12 @@ def product_detail(request, slug):
     variants = product.variants.filter(is_active=True)
     
     # Get approved reviews
-    reviews = product.reviews.filter(is_approved=True).order_by('-created_at')
-    
-    # Calculate rating breakdown
-    rating_breakdown = {}
-    for i in range(1, 6):
-        count = reviews.filter(rating=i).count()
-        percentage = (count / reviews.count() * 100) if reviews.count() > 0 else 0
-        rating_breakdown[i] = {
-            'count': count,
-            'percentage': percentage
-        }
+    reviews = product.reviews.filter(
+        is_approved=True
+    ).select_related('user').prefetch_related('images').order_by('-created_at')
+    
+    # Rating breakdown comes from the product's maintained aggregates
+    review_summary = product.review_summary
     
     # Check if user has purchased this product (for verified purchase badge)
     has_purchased = False
@@ -211,7 +139,7 @@ def product_detail(request, slug):
         'specifications': specifications,
         'variants': variants,
         'reviews': reviews,
-        'rating_breakdown': rating_breakdown,
+        'review_summary': review_summary,
         'related_products': related_products,
         'has_purchased': has_purchased,
         'user_review': user_review,
@@ -273,7 +201,7 @@ def add_to_cart(request):
         return JsonResponse({
             'success': True,
             'message': 'Product added to cart',
-            'cart_total': cart.total_items
+            'cart_total': get_cart_count(request.user)
         })
         
     except Exception as e:
@@ -411,13 +339,13 @@ def mark_review_helpful(request, review_id):
     Mark a review as helpful
     """
     try:
-        review = get_object_or_404(Review, id=review_id)
-        review.helpful_count += 1
-        review.save()
+        reviews = Review.objects.filter(id=review_id)
+        if not reviews.update(helpful_count=F('helpful_count') + 1):
+            raise Http404('No Review matches the given query.')
         
         return JsonResponse({
             'success': True,
-            'helpful_count': review.helpful_count
+            'helpful_count': reviews.values_list('helpful_count', flat=True).get()
         })
         
     except Exception as e:
@@ -427,21 +355,20 @@ def mark_review_helpful(request, review_id):
         })
 
 
+@cache_catalog_page()
 def category_products(request, slug):
     """
     Display products by category
     """
     category = get_object_or_404(Category, slug=slug, is_active=True)
     
-    # Get products in this category and subcategories
-    categories = [category]
-    if category.subcategories.exists():
-        categories.extend(category.subcategories.filter(is_active=True))
+    # Get products in this category and its subcategories, at any depth
+    categories = Category.objects.subtree(category).filter(is_active=True)
     
     products = Product.objects.filter(
         category__in=categories,
         is_active=True
-    ).order_by('-created_at')
+    )
     
     # Filters
     min_price = request.GET.get('min_price')
@@ -453,8 +380,13 @@ def category_products(request, slug):
         products = products.filter(price__gte=min_price)
     if max_price:
         products = products.filter(price__lte=max_price)
+    
+    # Brand counts for the filter, before the brand filter itself
+    facets = get_facets(products, catalog_summary_key(request, ignore=('brand',)))
+    
     if brand_id:
         products = products.filter(brand_id=brand_id)
+    products = products.with_card_data(request.user).order_by('-created_at')
     
     # Sorting
     if sort_by == 'price_low':
@@ -464,24 +396,20 @@ def category_products(request, slug):
     elif sort_by == 'popular':
         products = products.order_by('-sold_count')
     elif sort_by == 'rating':
-        products = products.annotate(avg_rating=Avg('reviews__rating')).order_by('-avg_rating')
-    
-    # Get brands for filter
-    brands = Brand.objects.filter(
-        products__category__in=categories,
-        is_active=True
-    ).distinct()
+        products = products.order_by('-rating_avg', '-rating_count')
     
     context = {
         'category': category,
         'products': products,
-        'brands': brands,
+        'brands': facets.brand_list(),
         'subcategories': category.subcategories.filter(is_active=True),
+        'breadcrumbs': category.ancestors(),
     }
     
     return render(request, 'products/category.html', context)
 
 
+@cache_catalog_page()
 def brand_products(request, slug):
     """
     Display products by brand
@@ -491,7 +419,7 @@ def brand_products(request, slug):
     products = Product.objects.filter(
         brand=brand,
         is_active=True
-    ).order_by('-created_at')
+    ).with_card_data(request.user).order_by('-created_at')
     
     context = {
         'brand': brand,
@@ -507,15 +435,10 @@ def search_products(request):
     """
     query = request.GET.get('q', '')
     
-    products = Product.objects.filter(is_active=True)
+    products = Product.objects.filter(is_active=True).with_card_data(request.user)
     
     if query:
-        products = products.filter(
-            Q(name__icontains=query) |
-            Q(description__icontains=query) |
-            Q(category__name__icontains=query) |
-            Q(brand__name__icontains=query)
-        ).distinct()
+        products = apply_search(products, query).order_by('-search_rank', '-sold_count')
     
     context = {
         'products': products,
@@ -545,7 +468,9 @@ def cart_view(request):
     Display shopping cart
     """
     cart, created = Cart.objects.get_or_create(user=request.user)
-    cart_items = cart.items.all().select_related('product', 'variant')
+    # Items, products and variants in one go; the totals reuse them
+    prefetch_related_objects([cart], pricing.priced_items())
+    cart_items = cart.items.all()
     
     context = {
         'cart': cart,
@@ -565,13 +490,16 @@ def update_cart_item(request, item_id):
         data = json.loads(request.body)
         quantity = int(data.get('quantity', 1))
         
-        cart_item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
+        cart_item = get_object_or_404(
+            CartItem.objects.select_related('product', 'variant'), id=item_id, cart__user=request.user
+        )
         
         if quantity <= 0:
             cart_item.delete()
             return JsonResponse({
                 'success': True,
-                'message': 'Item removed from cart'
+                'message': 'Item removed from cart',
+                'cart_count': get_cart_count(request.user)
             })
         
         # Check stock
@@ -594,7 +522,8 @@ def update_cart_item(request, item_id):
         return JsonResponse({
             'success': True,
             'subtotal': float(cart_item.subtotal),
-            'cart_total': float(cart_item.cart.total_amount)
+            'cart_total': float(cart_item.cart.total_amount),
+            'cart_count': get_cart_count(request.user)
         })
         
     except Exception as e:
@@ -616,7 +545,8 @@ def remove_cart_item(request, item_id):
         
         return JsonResponse({
             'success': True,
-            'message': 'Item removed from cart'
+            'message': 'Item removed from cart',
+            'cart_count': get_cart_count(request.user)
         })
         
     except Exception as e:
@@ -627,43 +557,33 @@ def remove_cart_item(request, item_id):
 
 from django.shortcuts import render, get_object_or_404
 from django.core.paginator import Paginator
-from django.db.models import Q, Count, Avg
+from django.db.models import Q
 from .models import Product, Category, Brand, Wishlist
 from decimal import Decimal
 
 
+@cache_catalog_page()
 def product_list(request):
     """Amazon-style product listing with filters and search"""
     
     # Get all active products
-    products = Product.objects.filter(is_active=True).select_related('category', 'brand')
+    products = Product.objects.filter(is_active=True)
     
     # Search functionality
     search_query = request.GET.get('search', '')
     if search_query:
-        products = products.filter(
-            Q(name__icontains=search_query) |
-            Q(description__icontains=search_query) |
-            Q(category__name__icontains=search_query) |
-            Q(brand__name__icontains=search_query)
-        )
+        products = apply_search(products, search_query)
     
-    # Category filter
+    # Category and brand filters (applied after the facet counts below)
     category_slug = request.GET.get('category', '')
     selected_category = None
     if category_slug:
         selected_category = get_object_or_404(Category, slug=category_slug)
-        products = products.filter(
-            Q(category=selected_category) | 
-            Q(category__parent=selected_category)
-        )
     
-    # Brand filter
     brand_id = request.GET.get('brand', '')
     selected_brand = None
     if brand_id:
         selected_brand = get_object_or_404(Brand, id=brand_id)
-        products = products.filter(brand=selected_brand)
     
     # Price range filter
     min_price = request.GET.get('min_price', '')
@@ -685,11 +605,8 @@ def product_list(request):
     min_rating = request.GET.get('rating', '')
     if min_rating:
         try:
-            min_rating = int(min_rating)
-            # This is a simplified version - for better performance, 
-            # consider adding a cached average_rating field to Product model
-            products = [p for p in products if p.average_rating >= min_rating]
-        except:
+            products = products.filter(rating_filter(int(min_rating)))
+        except ValueError:
             pass
     
     # Special filters
@@ -708,10 +625,26 @@ def product_list(request):
     if request.GET.get('in_stock') == '1':
         products = products.filter(stock__gt=0)
     
+    # Sidebar counts, result total and price range: one grouped query, cached
+    # per filter set. Taken before the brand and category filters so the
+    # sidebar still offers the other brands and categories.
+    facets = get_facets(
+        products, catalog_summary_key(request, ignore=('brand', 'category')),
+        brand=selected_brand, category=selected_category,
+    )
+    
+    if selected_category:
+        products = products.filter(category__in=Category.objects.subtree(selected_category))
+    if selected_brand:
+        products = products.filter(brand=selected_brand)
+    products = products.with_card_data(request.user)
+    
     # Sorting
     sort_by = request.GET.get('sort', 'featured')
     
-    if sort_by == 'price_low':
+    if sort_by == 'featured' and search_query:
+        products = products.order_by('-search_rank', '-is_featured', '-sold_count')
+    elif sort_by == 'price_low':
         products = products.order_by('price')
     elif sort_by == 'price_high':
         products = products.order_by('-price')
@@ -720,53 +653,41 @@ def product_list(request):
     elif sort_by == 'name':
         products = products.order_by('name')
     elif sort_by == 'rating':
-        products = products.order_by('-sold_count')  # Using sold_count as proxy
+        products = products.order_by('-rating_avg', '-rating_count')
     else:  # featured (default)
         products = products.order_by('-is_featured', '-sold_count', '-view_count')
     
-    # Get all categories and brands for filters
-    categories = Category.objects.filter(
-        is_active=True, 
-        parent=None
-    ).prefetch_related('subcategories')
-    
-    brands = Brand.objects.filter(is_active=True).order_by('name')
-    
-    # Get price range for filter
-    if products:
-        if isinstance(products, list):
-            price_min = min(p.price for p in products)
-            price_max = max(p.price for p in products)
-        else:
-            price_range = products.aggregate(
-                min_price=models.Min('price'),
-                max_price=models.Max('price')
-            )
-            price_min = price_range['min_price'] or 0
-            price_max = price_range['max_price'] or 10000
+    # Only one page of rows is ever loaded
+    total_results = facets.total
+    
+    # Pagination
+    if search_query:
+        # Relevance comes from a raw SQL rank on some backends; page by number
+        paginator = Paginator(products, 24)  # 24 products per page
+        paginator.count = total_results  # already counted above
+        page_obj = paginator.get_page(request.GET.get('page', 1))
     else:
-        price_min = 0
-        price_max = 10000
+        page_obj = CursorPaginator(products, 24).page(request.GET.get('cursor'))
     
-    # Get user's wishlist if authenticated
-    wishlist_ids = []
-    if request.user.is_authenticated:
-        wishlist_ids = Wishlist.objects.filter(
-            user=request.user
-        ).values_list('product_id', flat=True)
+    if request.GET.get('partial') == '1':
+        # "Load more" / infinite scroll: just the next cards and controls
+        return render(request, 'products/product_list_partial.html', {'products': page_obj, 'partial': True})
     
-    # Pagination
-    page_number = request.GET.get('page', 1)
-    paginator = Paginator(products, 24)  # 24 products per page
-    page_obj = paginator.get_page(page_number)
+    # Get all categories and brands for filters
+    categories = get_category_nav()
     
-    # Calculate result count
-    total_results = paginator.count
+    # Price range for the filter (no results: the default range)
+    price_min = facets.price_min or 0
+    price_max = facets.price_max or 10000
     
     context = {
         'products': page_obj,
         'categories': categories,
-        'brands': brands,
+        'category_facets': facets.category_list(categories),
+        'brand_facets': facets.brand_list(),
+        'price_buckets': facets.price_buckets,
+        'rating_facets': facets.ratings,
+        'flag_counts': facets.flags,
         'selected_category': selected_category,
         'selected_brand': selected_brand,
         'search_query': search_query,
@@ -776,7 +697,6 @@ def product_list(request):
         'price_max': int(price_max),
         'current_min_price': min_price or '',
         'current_max_price': max_price or '',
-        'wishlist_ids': list(wishlist_ids),
         'page_obj': page_obj,
     }
     
@@ -786,10 +706,11 @@ from django.shortcuts import render, get_object_or_404
 from .models import Category, Product
 from django.core.paginator import Paginator
 
+@cache_catalog_page()
 def category_view(request, category_id):
     """Display products belonging to a specific category."""
     category = get_object_or_404(Category, id=category_id)
-    products = category.products.filter(is_active=True).order_by('-created_at')
+    products = category.products.filter(is_active=True).with_card_data(request.user).order_by('-created_at')
 
     # Optional pagination (6 products per page)
     paginator = Paginator(products, 6)
@@ -839,13 +760,42 @@ def remove_from_cart(request, item_id):
 
 # Checkout Views
 @login_required
-def checkout(request):
+async def checkout(request):
     """Checkout page with M-Pesa Paybill integration"""
-    cart = get_object_or_404(Cart, user=request.user)
+    response, job = await sync_to_async(place_order)(request)
+    if job is None:
+        return response
+
+    # Send the STK push right away; awaiting Daraja holds no thread. On a
+    # retryable error the job stays queued for the stk_worker command.
+    job = await sync_to_async(stk_queue.claim_job)(job.pk)
+    status = await stk_queue.aprocess(job) if job else None
+
+    if status == 'sent':
+        return JsonResponse({
+            'success': True,
+            'message': 'Payment request sent! Check your phone to complete payment.',
+            'order_id': job.payment.order_id,
+            'checkout_request_id': job.payment.checkout_request_id
+        })
+    if status == 'failed':
+        return JsonResponse({
+            'success': False,
+            'error': f"Payment failed: {job.last_error}"
+        })
+    return response
+
+
+def place_order(request):
+    """
+    Synchronous part of checkout: renders the page or validates the form and
+    commits the order, payment and queued STK push. Returns (response, job).
+    """
+    cart = get_object_or_404(Cart.objects.prefetch_related(pricing.priced_items()), user=request.user)
     
-    if not cart.items.exists():
+    if not cart.items.all():
         messages.error(request, 'Your cart is empty')
-        return redirect('cart')
+        return redirect('cart'), None
     
     if request.method == 'POST':
         phone_number = request.POST.get('phone_number', '').strip()
@@ -857,20 +807,21 @@ def checkout(request):
             return JsonResponse({
                 'success': False,
                 'error': 'Phone number must start with 254 (e.g., 254712345678)'
-            })
+            }), None
         
         if len(phone_number) != 12:
             return JsonResponse({
                 'success': False,
                 'error': 'Invalid phone number format. Use 254XXXXXXXXX'
-            })
+            }), None
         
         if not account_number:
             return JsonResponse({
                 'success': False,
                 'error': 'Account number is required'
-            })
+            }), None
         
+        cart_items = list(cart.items.all())
         try:
             with transaction.atomic():
                 # Create order
@@ -882,19 +833,9 @@ def checkout(request):
                     status='pending'
                 )
                 
-                # Create order items
-                for cart_item in cart.items.all():
-                    OrderItem.objects.create(
-                        order=order,
-                        product=cart_item.product,
-                        quantity=cart_item.quantity,
-                        price=cart_item.product.price
-                    )
-                    
-                    # Reduce stock
-                    product = cart_item.product
-                    product.stock -= cart_item.quantity
-                    product.save()
+                # Take the stock (rolled back with the order if any line is short)
+                inventory.reserve_or_fail(cart_items)
+                inventory.create_order_items(order, cart_items)
                 
                 # Clear cart
                 cart.items.all().delete()
@@ -908,129 +849,41 @@ def checkout(request):
                     account_number=account_number,
                     status='pending'
                 )
+                inventory.hold(order, payment, cart_items)
                 
-                # Initiate STK Push
-                result = initiate_stk_push(payment)
-                
-                if result and result.get('ResponseCode') == '0':
-                    payment.merchant_request_id = result.get('MerchantRequestID')
-                    payment.checkout_request_id = result.get('CheckoutRequestID')
-                    payment.save()
-                    
-                    logger.info(f"STK Push initiated for order {order.id}")
-                    
-                    return JsonResponse({
-                        'success': True,
-                        'message': 'Payment request sent! Check your phone to complete payment.',
-                        'order_id': order.id,
-                        'checkout_request_id': payment.checkout_request_id
-                    })
-                else:
-                    error_msg = result.get('errorMessage', 'Failed to initiate payment') if result else 'Connection error'
-                    logger.error(f"STK Push failed: {error_msg}")
-                    
-                    # Rollback stock
-                    for item in order.items.all():
-                        product = item.product
-                        product.stock += item.quantity
-                        product.save()
-                    
-                    order.status = 'cancelled'
-                    order.save()
-                    payment.status = 'failed'
-                    payment.result_description = error_msg
-                    payment.save()
-                    
-                    return JsonResponse({
-                        'success': False,
-                        'error': f"Payment failed: {error_msg}"
-                    })
+                # The STK push is sent once this commits (by checkout, or
+                # stk_worker); the checkout page polls check_payment_status.
+                job = stk_queue.enqueue(payment)
+            
+            logger.info(f"Order {order.id} placed, STK Push queued")
+            
+            return JsonResponse({
+                'success': True,
+                'message': 'Order placed! A payment request is on its way to your phone.',
+                'order_id': order.id,
+            }), job
+        
+        except inventory.InsufficientStock as e:
+            return JsonResponse({
+                'success': False,
+                'error': f'Not enough stock for: {e}',
+                'out_of_stock': [item.id for item in e.lines],
+            }), None
                     
         except Exception as e:
             logger.error(f"Checkout error: {str(e)}")
             return JsonResponse({
                 'success': False,
                 'error': f'Error processing order: {str(e)}'
-            })
+            }), None
     
     context = {
         'cart': cart,
-        'paybill_number': settings.MPESA_SHORTCODE
+        'paybill_number': settings.MPESA_SHORTCODE,
+        'final_statuses': FINAL_STATUSES,
     }
-    return render(request, 'store/checkout.html', context)
-
-
+    return render(request, 'store/checkout.html', context), None
 
-def initiate_stk_push(payment):
-    """
-    Initiate M-Pesa STK Push for Paybill
-    """
-    try:
-        # Get access token
-        access_token = get_mpesa_access_token()
-        if not access_token:
-            logger.error("Failed to get access token")
-            return {'errorMessage': 'Failed to authenticate with M-Pesa'}
-        
-        # Generate password and timestamp
-        password, timestamp = generate_password()
-        
-        # Determine API URL
-        if settings.MPESA_ENVIRONMENT == 'sandbox':
-            url = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-        else:
-            url = 'https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-        
-        # Set headers
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Prepare payload
-        payload = {
-            'BusinessShortCode': settings.MPESA_SHORTCODE,
-            'Password': password,
-            'Timestamp': timestamp,
-            'TransactionType': 'CustomerPayBillOnline',
-            'Amount': int(payment.amount),
-            'PartyA': payment.phone_number,
-            'PartyB': settings.MPESA_SHORTCODE,
-            'PhoneNumber': payment.phone_number,
-            'CallBackURL': settings.MPESA_CALLBACK_URL,
-            'AccountReference': payment.account_number,
-            'TransactionDesc': f'Order #{payment.order.id}'
-        }
-        
-        logger.info(f"Initiating STK Push for order {payment.order.id}")
-        logger.info(f"Phone: {payment.phone_number}, Amount: {payment.amount}")
-        
-        # Make the request
-        response = requests.post(url, json=payload, headers=headers, timeout=60)
-        
-        # Log response
-        logger.info(f"STK Push response status: {response.status_code}")
-        logger.info(f"STK Push response: {response.text}")
-        
-        # Parse response
-        result = response.json()
-        
-        if response.status_code == 200:
-            return result
-        else:
-            error_msg = result.get('errorMessage', 'Unknown error')
-            logger.error(f"STK Push failed: {error_msg}")
-            return result
-            
-    except requests.exceptions.Timeout:
-        logger.error("STK Push request timed out")
-        return {'errorMessage': 'Request timed out. Please try again.'}
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Network error during STK Push: {str(e)}")
-        return {'errorMessage': f'Network error: {str(e)}'}
-    except Exception as e:
-        logger.error(f"STK Push error: {str(e)}")
-        return {'errorMessage': f'Error: {str(e)}'}
 
 
 def verify_credentials():
@@ -1048,6 +901,7 @@ def verify_credentials():
     if token:
         print("✓ Credentials are valid!")
         print(f"Access Token (first 20 chars): {token[:20]}...")
+        print(f"Token age: {token_manager.token_age():.0f}s")
         return True
     else:
         print("✗ Failed to get access token. Check your credentials.")
@@ -1057,105 +911,33 @@ def verify_credentials():
 
 @csrf_exempt
 @require_POST
-def mpesa_callback(request):
-    """Handle M-Pesa callback for payment confirmation"""
+async def mpesa_callback(request):
+    """Journal an M-Pesa callback and acknowledge it; process_callbacks applies it"""
     try:
-        data = json.loads(request.body)
-        logger.info(f"M-Pesa Callback received: {json.dumps(data, indent=2)}")
-        
-        stk_callback = data.get('Body', {}).get('stkCallback', {})
-        checkout_request_id = stk_callback.get('CheckoutRequestID')
-        result_code = stk_callback.get('ResultCode')
-        result_desc = stk_callback.get('ResultDesc')
-        
-        if not checkout_request_id:
-            logger.error("No CheckoutRequestID in callback")
-            return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid callback data'})
-        
-        try:
-            payment = MpesaPayment.objects.get(checkout_request_id=checkout_request_id)
-            payment.result_code = str(result_code)
-            payment.result_description = result_desc
-            
-            if result_code == 0:
-                # Payment successful
-                callback_metadata = stk_callback.get('CallbackMetadata', {}).get('Item', [])
-                
-                for item in callback_metadata:
-                    name = item.get('Name')
-                    value = item.get('Value')
-                    
-                    if name == 'MpesaReceiptNumber':
-                        payment.mpesa_receipt_number = value
-                    elif name == 'TransactionDate':
-                        transaction_date = str(value)
-                        payment.transaction_date = datetime.strptime(
-                            transaction_date, '%Y%m%d%H%M%S'
-                        )
-                    elif name == 'Amount':
-                        # Verify amount matches
-                        if float(value) != float(payment.amount):
-                            logger.warning(
-                                f"Amount mismatch for order {payment.order.id}: "
-                                f"Expected {payment.amount}, got {value}"
-                            )
-                
-                payment.status = 'completed'
-                payment.order.status = 'processing'
-                payment.order.save()
-                
-                logger.info(
-                    f"Payment completed for order {payment.order.id}. "
-                    f"Receipt: {payment.mpesa_receipt_number}"
-                )
-            else:
-                # Payment failed or cancelled
-                payment.status = 'failed'
-                payment.order.status = 'cancelled'
-                payment.order.save()
-                
-                # Restore stock
-                for item in payment.order.items.all():
-                    product = item.product
-                    product.stock += item.quantity
-                    product.save()
-                
-                logger.warning(
-                    f"Payment failed for order {payment.order.id}. "
-                    f"Result: {result_desc}"
-                )
-            
-            payment.save()
-            
-        except MpesaPayment.DoesNotExist:
-            logger.error(f"Payment not found for CheckoutRequestID: {checkout_request_id}")
-            return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Payment not found'})
-        
-        return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
-        
+        entry = await callback_journal.arecord(request.body)
     except Exception as e:
-        logger.error(f"Callback processing error: {str(e)}")
+        # Not stored: ask Safaricom to deliver it again
+        logger.error(f"Callback journaling error: {str(e)}")
         return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Processing error'})
 
+    logger.info(f"M-Pesa callback {entry.pk} received for {entry.checkout_request_id}")
+    return JsonResponse(ACCEPTED)
+
 
 @login_required
 @require_http_methods(["GET"])
-def check_payment_status(request, order_id):
+async def check_payment_status(request, order_id):
     """Check M-Pesa payment status via AJAX"""
     try:
-        order = get_object_or_404(Order, id=order_id, user=request.user)
+        user = await request.auser()
+        order = await aget_object_or_404(
+            Order.objects.select_related('mpesa_payment'), id=order_id, user=user
+        )
         
         try:
             payment = order.mpesa_payment
             
-            return JsonResponse({
-                'success': True,
-                'status': payment.status,
-                'order_status': order.status,
-                'result_description': payment.result_description,
-                'mpesa_receipt': payment.mpesa_receipt_number,
-                'transaction_date': payment.transaction_date.strftime('%Y-%m-%d %H:%M:%S') if payment.transaction_date else None
-            })
+            return JsonResponse(status_payload(order, payment))
         except MpesaPayment.DoesNotExist:
             return JsonResponse({
                 'success': False,
@@ -1170,6 +952,55 @@ def check_payment_status(request, order_id):
         })
 
 
+@login_required
+@require_http_methods(["GET"])
+async def payment_status_stream(request, order_id):
+    """
+    Server-Sent Events stream for the checkout page: sends the current
+    payment status, then the final one as soon as it is published in this
+    process, or at the next keepalive when it was applied elsewhere.
+    """
+    user = await request.auser()
+    order = await aget_object_or_404(Order.objects.select_related('mpesa_payment'), id=order_id, user=user)
+    try:
+        payment = order.mpesa_payment
+    except MpesaPayment.DoesNotExist:
+        return JsonResponse({'success': False, 'error': 'Payment record not found'}, status=404)
+
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    async def stream():
+        yield event('status', status_payload(order, payment))
+        if payment.status in FINAL_STATUSES:
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.PAYMENT_EVENTS_TIMEOUT
+        while (remaining := deadline - loop.time()) > 0:
+            payload = await payment_events.wait(order.id, min(remaining, settings.PAYMENT_EVENTS_KEEPALIVE))
+            if payload is None:
+                # Outcomes applied in another process (process_callbacks,
+                # reconcile_payments, ...) may only be in the database
+                payload = await current_status(order.id)
+            if payload['status'] in FINAL_STATUSES:
+                yield event('status', payload)
+                return
+            yield ": keepalive\n\n"
+
+        # The last keepalive may have waited on a slow client
+        payload = await current_status(order.id)
+        if payload['status'] in FINAL_STATUSES:
+            yield event('status', payload)
+        else:
+            yield event('timeout', {'status': payload['status']})
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @login_required
 def order_detail(request, order_id):
     """Display order details"""
@@ -1199,7 +1030,7 @@ from django.contrib.auth import login, logout, authenticate, update_session_auth
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.db.models import Count, Sum, Q
+from django.db.models import Q
 from django.core.paginator import Paginator
 from .models import Order, OrderItem, Address, Review, Wishlist, Product
 import re
@@ -1407,9 +1238,7 @@ def orders_view(request):
         ).distinct()
     
     # Pagination
-    paginator = Paginator(orders, 10)
-    page = request.GET.get('page', 1)
-    orders = paginator.get_page(page)
+    orders = CursorPaginator(orders, 10).page(request.GET.get('cursor'))
     
     context = {
         'orders': orders,
@@ -1638,9 +1467,7 @@ def reviews_view(request):
     reviews = Review.objects.filter(user=request.user).select_related('product').order_by('-created_at')
     
     # Pagination
-    paginator = Paginator(reviews, 10)
-    page = request.GET.get('page', 1)
-    reviews = paginator.get_page(page)
+    reviews = CursorPaginator(reviews, 10).page(request.GET.get('cursor'))
     
     context = {
         'reviews': reviews,